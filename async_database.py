@@ -0,0 +1,139 @@
+"""
+Author: Tomas Dal Farra
+Date: 16/01/2023
+Description: asyncio front-end for a synchronized database
+"""
+from storage import SET, DELETE
+from expiry import expiring
+import asyncio
+
+
+class AsyncDataBase:
+    """
+    Awaitable access to a SyncDataBase that never blocks the event loop.
+    Operations run in an executor thread. Writes arriving within 'window' seconds of each other are
+    coalesced into one transaction (one load and one persist) and concurrent reads of the same key
+    share one lookup. The file and its locking are the ones of the wrapped database, so other threads
+    and processes keep using it as before
+    """
+    def __init__(self, database, window=0.002, executor=None):
+        """
+        Initializer for the async database
+        :param database: SyncDataBase (or any database with transaction()) to use
+        :param window: Seconds to wait for more writes before writing a batch
+        :param executor: concurrent.futures executor for the blocking calls (default executor of the loop if None)
+        """
+        self.database = database
+        self.window = window
+        self._executor = executor
+        self._pending = []                  # writes waiting for the next batch: (operation, key, value, future)
+        self._flusher = None                # task writing the pending batches
+        self._reads = {}                    # key: future of the lookup in flight
+
+    async def _run(self, func, *args):
+        """
+        Runs a blocking call in the executor
+        :return: Result of the call
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _apply(self, batch) -> list:
+        """
+        Applies a batch of writes in one transaction (runs in the executor)
+        :param batch: List of (operation, key, value, future)
+        :return: Result of each write
+        """
+        with self.database.transaction() as txn:
+            return [txn.set_value(key, val) if op == SET else txn.delete_value(key) for op, key, val, _ in batch]
+
+    def _apply_each(self, batch) -> list:
+        """
+        Applies the writes of a failed batch in one transaction each, so only the writes that fail
+        raise (runs in the executor)
+        :param batch: List of (operation, key, value, future)
+        :return: (exception or None, result) of each write
+        """
+        outcomes = []
+        for write in batch:
+            try:
+                outcomes.append((None, self._apply([write])[0]))
+            except Exception as err:
+                outcomes.append((err, None))
+        return outcomes
+
+    async def _flush(self):
+        """
+        Waits the coalescing window and writes pending batches until there are none.
+        Writes that arrive while a batch is written go to the next batch. If a batch fails its writes are
+        written one by one, so a bad write doesn't fail the others
+        """
+        await asyncio.sleep(self.window)
+        while self._pending:
+            batch, self._pending = self._pending, []
+            try:
+                outcomes = [(None, result) for result in await self._run(self._apply, batch)]
+            except Exception as err:        # the transaction applied nothing, each write is tried alone
+                outcomes = [(err, None)] if len(batch) == 1 else await self._run(self._apply_each, batch)
+            for (*_, future), (error, result) in zip(batch, outcomes):
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+            for _, key, _, _ in batch:      # later reads must not join a lookup older than these writes
+                self._reads.pop(key, None)
+
+    async def _write(self, op, key, val=None):
+        """
+        Queues a write for the next batch and waits until it is written
+        :return: Result of the write
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((op, key, val, future))
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush())
+        return await future
+
+    async def set_value(self, key, val, ttl=None) -> bool:
+        """
+        Sets new key:value to database
+        :param key: Key for the database
+        :param val: Value of the key
+        :param ttl: Seconds until the key expires (None: never), counted from now
+        :return: If the operation was successful
+        """
+        return await self._write(SET, key, expiring(val, ttl))
+
+    async def delete_value(self, key):
+        """
+        Deletes value from database
+        :param key: Key for a database value
+        :return: Deleted value if existed
+        """
+        return await self._write(DELETE, key)
+
+    async def get_value(self, key):
+        """
+        Gets value according to the key of the database, joining a lookup of the same key in flight
+        If key doesn't exist None is returned
+        :param key: Key for the database element
+        :return: Value from the database if found
+        """
+        future = self._reads.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._run(self.database.get_value, key))
+            self._reads[key] = future
+
+            def forget(done):
+                if self._reads.get(key) is done:
+                    del self._reads[key]
+            future.add_done_callback(forget)
+        return await asyncio.shield(future)
+
+    async def close(self):
+        """
+        Waits for pending writes to be written
+        """
+        if self._flusher is not None:
+            await self._flusher
@@ -0,0 +1,225 @@
+"""
+Author: Tomas Dal Farra
+Date: 26/01/2023
+Description: Reproducible benchmark of the databases under concurrent load, compared against a baseline
+"""
+from dict_database import DataBase
+from file_database import FileDataBase
+from sync_database import SyncDataBase
+import multiprocessing
+import threading
+import itertools
+import tempfile
+import argparse
+import logging
+import random
+import json
+import time
+import sys
+import os
+
+TARGETS = ("dict", "file", "sync1", "sync0")     # DataBase, FileDataBase, SyncDataBase threads and processes
+OPERATIONS = ("read", "write", "delete")
+
+
+def zipf_weights(keys, s) -> list:
+    """
+    Cumulative weights of a zipfian distribution: key of rank r is chosen with probability ~ 1 / r^s
+    :param keys: Number of keys
+    :param s: Skew (0 is uniform)
+    :return: cumulative weights for random.choices
+    """
+    return list(itertools.accumulate(1 / rank ** s for rank in range(1, keys + 1)))
+
+
+def workload(config, worker) -> list:
+    """
+    Operations of a worker, the same every run for the same configuration and seed
+    :param config: Benchmark configuration
+    :param worker: Number of the worker
+    :return: list of (operation, key)
+    """
+    rng = random.Random(config["seed"] * 1000 + worker)
+    keys = range(config["keys"])
+    if config["distribution"] == "zipf":
+        chosen = rng.choices(keys, cum_weights=zipf_weights(config["keys"], config["zipf_s"]), k=config["ops"])
+    else:
+        chosen = rng.choices(keys, k=config["ops"])
+    operations = rng.choices(OPERATIONS, weights=config["mix"], k=config["ops"])
+    return list(zip(operations, chosen))
+
+
+def run_worker(database, operations, value) -> list:
+    """
+    Runs operations measuring each one
+    :param database: Database to use
+    :param operations: list of (operation, key)
+    :param value: Value written by writes
+    :return: latencies in nanoseconds
+    """
+    latencies = []
+    clock = time.perf_counter_ns
+    for op, key in operations:
+        start = clock()
+        if op == "read":
+            database.get_value(key)
+        elif op == "write":
+            database.set_value(key, value)
+        else:
+            database.delete_value(key)
+        latencies.append(clock() - start)
+    return latencies
+
+
+def _process_worker(database, operations, value, results):
+    """ Runs a worker in a child process and sends its latencies back """
+    results.put(run_worker(database, operations, value))
+
+
+def percentile(ordered, fraction) -> float:
+    """
+    Percentile of sorted values (nearest rank)
+    :param ordered: Sorted list of values
+    :param fraction: Percentile between 0 and 1
+    :return: value at that percentile
+    """
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def open_database(target, file_name, config):
+    """
+    Creates the database of a target filled with every key
+    :param target: One of TARGETS
+    :param file_name: Name of file for the database
+    :param config: Benchmark configuration
+    :return: database
+    """
+    items = {key: bytes(config["value_size"]) for key in range(config["keys"])}
+    if target == "dict":
+        database = DataBase()
+    elif target == "file":
+        database = FileDataBase(file_name, config["engine"])
+    else:
+        database = SyncDataBase(1 if target == "sync1" else 0, file_name, config["engine"])
+    database.set_many(items)
+    return database
+
+
+def run_target(target, config) -> dict:
+    """
+    Benchmarks one target. DataBase and FileDataBase are not synchronized so they run a single worker
+    :param target: One of TARGETS
+    :param config: Benchmark configuration
+    :return: Dictionary with operations per second and latency percentiles in microseconds
+    """
+    workers = config["workers"] if target.startswith("sync") else 1
+    plans = [workload(config, worker) for worker in range(workers)]
+    value = bytes(config["value_size"])
+    with tempfile.TemporaryDirectory() as directory:
+        database = open_database(target, os.path.join(directory, "bench.bin"), config)
+        start = time.perf_counter()
+        if target == "sync0":
+            context = multiprocessing.get_context("fork")       # children inherit the database and its locks
+            queue = context.Queue()
+            processes = [context.Process(target=_process_worker, args=(database, plan, value, queue))
+                         for plan in plans]
+            for p in processes:
+                p.start()
+            latencies = [latency for _ in processes for latency in queue.get()]
+            for p in processes:
+                p.join()
+        else:
+            results = [None] * workers
+
+            def work(n):
+                results[n] = run_worker(database, plans[n], value)
+            threads = [threading.Thread(target=work, args=(n,)) for n in range(workers)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            latencies = [latency for result in results for latency in result]
+        elapsed = time.perf_counter() - start
+        if hasattr(database, "close"):
+            database.close()
+    latencies.sort()
+    return {"workers": workers, "ops": len(latencies), "ops_per_sec": round(len(latencies) / elapsed, 1),
+            "p50_us": round(percentile(latencies, 0.5) / 1000, 2),
+            "p99_us": round(percentile(latencies, 0.99) / 1000, 2),
+            "p999_us": round(percentile(latencies, 0.999) / 1000, 2)}
+
+
+def compare(report, baseline, tolerance) -> list:
+    """
+    Compares a report with a baseline report
+    :param report: Report of this run
+    :param baseline: Stored report
+    :param tolerance: Fraction of throughput loss or p99 latency increase accepted
+    :return: list of regression descriptions (empty if there is none)
+    """
+    if report["config"] != baseline["config"]:
+        logging.warning("Baseline was run with another configuration, the comparison may not be meaningful")
+    regressions = []
+    for target, result in report["results"].items():
+        old = baseline["results"].get(target)
+        if old is None:
+            continue
+        if result["ops_per_sec"] < old["ops_per_sec"] * (1 - tolerance):
+            regressions.append(f"{target}: {result['ops_per_sec']} ops/s, baseline {old['ops_per_sec']}")
+        if result["p99_us"] > old["p99_us"] * (1 + tolerance):
+            regressions.append(f"{target}: p99 {result['p99_us']} us, baseline {old['p99_us']}")
+    return regressions
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line
+    :param argv: Arguments (sys.argv if None)
+    :return: argparse namespace
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks the databases and reports JSON")
+    parser.add_argument("--targets", nargs="+", choices=TARGETS, default=list(TARGETS), help="databases to run")
+    parser.add_argument("--engine", default="snapshot", choices=list(FileDataBase.ENGINES), help="storage engine")
+    parser.add_argument("--ops", type=int, default=2000, help="operations per worker")
+    parser.add_argument("--keys", type=int, default=1000, help="number of keys")
+    parser.add_argument("--value-size", type=int, default=100, help="bytes of every value")
+    parser.add_argument("--workers", type=int, default=4, help="threads (sync1) or processes (sync0)")
+    parser.add_argument("--mix", type=float, nargs=3, default=[80, 15, 5], metavar=("READ", "WRITE", "DELETE"),
+                        help="ratio of reads, writes and deletes")
+    parser.add_argument("--distribution", choices=("uniform", "zipf"), default="uniform", help="key distribution")
+    parser.add_argument("--zipf-s", type=float, default=0.99, help="skew of the zipfian distribution")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the workload")
+    parser.add_argument("--output", help="file where to write the JSON report (stdout if not given)")
+    parser.add_argument("--baseline", help="JSON report to compare with, exits with 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="accepted fraction of regression")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    """
+    Runs the benchmark
+    :param argv: Arguments (sys.argv if None)
+    :return: exit status
+    """
+    args = parse_args(argv)
+    config = {"engine": args.engine, "ops": args.ops, "keys": args.keys, "value_size": args.value_size,
+              "workers": args.workers, "mix": args.mix, "distribution": args.distribution,
+              "zipf_s": args.zipf_s, "seed": args.seed}
+    report = {"config": config, "results": {target: run_target(target, config) for target in args.targets}}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+"""
+Author: Tomas Dal Farra
+Date: 06/02/2023
+Description: Bloom filter of the keys of a database, persisted next to it, to answer lookups of missing keys
+"""
+import multiprocessing
+import hashlib
+import logging
+import struct
+import pickle
+import math
+import os
+
+MAGIC = b"SDBF"
+HEADER = struct.Struct(">4sQdQ?I")   # magic, capacity, false positive rate, keys added, opaque flag, stamp length
+DIGEST = struct.Struct(">QQ")        # two halves of the digest of a key for double hashing
+MIN_KEYS = 1 << 16                  # keys a filter is sized for at least
+
+
+def canonical(key):
+    """
+    Bytes of a key equal for keys that are equal in a dictionary (e.g. 1, 1.0 and True)
+    :param key: Key for the database
+    :return: bytes or None for keys of other types
+    """
+    if isinstance(key, str):
+        return b"s" + key.encode("utf-8", "surrogatepass")
+    if isinstance(key, bytes):
+        return b"b" + key
+    if isinstance(key, (int, float)):           # bool is an int
+        if isinstance(key, float) and not key.is_integer():
+            return b"f" + repr(key).encode()
+        return b"i" + str(int(key)).encode()
+    if isinstance(key, tuple):
+        parts = [canonical(part) for part in key]
+        if None in parts:
+            return None
+        return b"t" + b"".join(struct.pack(">I", len(part)) + part for part in parts)
+    return None
+
+
+class BloomFilter:
+    """
+    Bloom filter sized for a number of keys and a false positive rate. Keys are never removed, so deleted
+    keys stay as false positives until the filter is built again. Keys of types it can't hash the same way
+    as equal keys (see canonical) make it opaque: it then answers that any key may be there.
+    With shared=True the bits and counters live in shared memory, so processes forked after creating it
+    see the keys added by any of them
+    """
+    def __init__(self, capacity, fp_rate=0.01, shared=False):
+        """
+        Initializer for the Bloom filter
+        :param capacity: Number of keys it is sized for
+        :param fp_rate: Target false positive rate with capacity keys
+        :param shared: If it is shared between processes
+        """
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.shared = shared
+        self.size = max(int(-capacity * math.log(fp_rate) / math.log(2) ** 2), 64)     # bits
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        if shared:
+            self._bits = memoryview(multiprocessing.RawArray('B', (self.size + 7) // 8)).cast('B')
+            self._counters = multiprocessing.RawArray('Q', 2)       # keys added, opaque
+        else:
+            self._bits = memoryview(bytearray((self.size + 7) // 8))
+            self._counters = [0, 0]
+
+    def _positions(self, data) -> list:
+        """
+        Bits of a key, by double hashing of one digest
+        :param data: Canonical bytes of the key
+        :return: list of bit positions
+        """
+        first, second = DIGEST.unpack(hashlib.blake2b(data, digest_size=16).digest())
+        size = self.size
+        first, second = first % size, second % size     # small ints from here on, much faster to combine
+        return [(first + i * second) % size for i in range(self.hashes)]
+
+    def add(self, key):
+        """
+        Adds a key (holding the writers exclusion of the database)
+        :param key: Key for the database
+        """
+        data = canonical(key)
+        if data is None:
+            self._counters[1] = 1
+            return
+        bits = self._bits
+        for pos in self._positions(data):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self._counters[0] += 1
+
+    def may_contain(self, key) -> bool:
+        """
+        If a key may be in the database
+        :param key: Key for the database
+        :return: False only if it is certainly not there
+        """
+        if self._counters[1]:
+            return True
+        data = canonical(key)
+        if data is None:
+            return True
+        first, second = DIGEST.unpack(hashlib.blake2b(data, digest_size=16).digest())
+        size, bits = self.size, self._bits
+        pos, step = first % size, second % size
+        for _ in range(self.hashes):        # a missing key usually stops at its first or second bit
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+            pos = (pos + step) % size
+        return True
+
+    @property
+    def added(self) -> int:
+        """ Keys added since it was built """
+        return self._counters[0]
+
+    @property
+    def full(self) -> bool:
+        """ If more keys than its capacity were added, so its false positive rate is higher than the target """
+        return self._counters[0] > self.capacity
+
+    def save(self, file_name, stamp):
+        """
+        Writes the filter to a file, replacing it at once
+        :param file_name: Filter file
+        :param stamp: Picklable stamp of the database files it matches
+        """
+        stamp_data = pickle.dumps(stamp)
+        temp_name = f"{file_name}.{os.getpid()}.tmp"
+        with open(temp_name, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, self.capacity, self.fp_rate, self._counters[0], bool(self._counters[1]),
+                                len(stamp_data)))
+            f.write(stamp_data)
+            f.write(self._bits)
+        os.replace(temp_name, file_name)
+
+    @classmethod
+    def load(cls, file_name, stamp, shared=False):
+        """
+        Reads a filter written by save if it matches the database files
+        :param file_name: Filter file
+        :param stamp: Stamp of the database files now
+        :param shared: If it is shared between processes
+        :return: BloomFilter or None if there isn't a usable one
+        """
+        try:
+            with open(file_name, 'rb') as f:
+                magic, capacity, fp_rate, added, opaque, stamp_length = HEADER.unpack(f.read(HEADER.size))
+                if magic != MAGIC or pickle.loads(f.read(stamp_length)) != stamp:
+                    return None
+                bloom = cls(capacity, fp_rate, shared)
+                if f.readinto(bloom._bits) != len(bloom._bits):
+                    return None
+        except FileNotFoundError:
+            return None
+        except (OSError, struct.error, pickle.UnpicklingError, EOFError) as err:
+            logging.warning(f"Ignoring filter file {file_name}: {err}")
+            return None
+        bloom._counters[0], bloom._counters[1] = added, opaque
+        return bloom
+
+
+if __name__ == "__main__":
+    bloom = BloomFilter(1000)
+    for n in range(1000):
+        bloom.add(n)
+    assert all(bloom.may_contain(n) for n in range(1000)) and bloom.may_contain(5.0) and bloom.may_contain(True)
+    false_positives = sum(bloom.may_contain(n) for n in range(1000, 101000))
+    assert false_positives < 2000, false_positives
+    bloom.add(("a", 1))
+    assert bloom.may_contain(("a", 1.0)) and not bloom.may_contain(("a", 2))
+    bloom.add(frozenset())
+    assert bloom.may_contain("anything")
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        bloom.save(os.path.join(directory, "f"), ("stamp", 1))
+        assert BloomFilter.load(os.path.join(directory, "f"), ("stamp", 2)) is None
+        loaded = BloomFilter.load(os.path.join(directory, "f"), ("stamp", 1), shared=True)
+        assert loaded.may_contain("anything") and loaded.added == 1001 and bytes(loaded._bits) == bytes(bloom._bits)
@@ -0,0 +1,215 @@
+"""
+Author: Tomas Dal Farra
+Date: 08/02/2023
+Description: Streaming readers and writers of records for bulk import and export (JSON lines, CSV and pickle)
+"""
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from itertools import islice
+import argparse
+import tempfile
+import pickle
+import json
+import time
+import csv
+import os
+
+FORMATS = ("jsonl", "csv", "pickle")
+SUFFIXES = {".jsonl": "jsonl", ".json": "jsonl", ".csv": "csv", ".pkl": "pickle", ".pickle": "pickle"}
+CHUNK = 10000               # records read, parsed and applied together
+
+
+def get_format(path, format=None) -> str:
+    """
+    Format of a file, given or by the suffix of its path
+    :param path: Path of the file or None
+    :param format: 'jsonl', 'csv', 'pickle' or None to use the suffix
+    :return: format
+    """
+    if format is None and path is not None:
+        format = SUFFIXES.get(os.path.splitext(os.fspath(path))[1].lower())
+    if format not in FORMATS:
+        raise ValueError(f"Unknown format {format!r}, use one of {FORMATS}")
+    return format
+
+
+def _key(key):
+    """ JSON has no tuples: lists given as keys are made tuples (hashable) """
+    return tuple(_key(part) for part in key) if isinstance(key, list) else key
+
+
+def parse_jsonl(lines) -> list:
+    """
+    Parses JSON lines of records {"key": key, "value": value}, skipping blank lines
+    :param lines: List of str lines
+    :return: list of (key, value)
+    """
+    records = []
+    for line in lines:
+        if line.strip():
+            record = json.loads(line)
+            records.append((_key(record["key"]), record["value"]))
+    return records
+
+
+def _chunks(source, chunk):
+    """
+    Lines (or any items) of a source in chunks
+    :param source: Open text file or any iterable
+    :param chunk: Items in a chunk
+    :return: Generator of lists of items
+    """
+    lines = iter(source)
+    while True:
+        lines_chunk = list(islice(lines, chunk))
+        if not lines_chunk:
+            return
+        yield lines_chunk
+
+
+def _parsed_jsonl(source, chunk, workers):
+    """
+    Parses JSON lines in chunks, in a pool of processes if workers (at most 2 * workers chunks are
+    waiting at a time, so memory stays bounded while the records are applied in order)
+    :param source: Open text file or iterable of lines
+    :param chunk: Records in a chunk
+    :param workers: Number of processes (0: parses in this one)
+    :return: Generator of lists of (key, value)
+    """
+    if not workers:
+        for lines_chunk in _chunks(source, chunk):
+            yield parse_jsonl(lines_chunk)
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for lines_chunk in _chunks(source, chunk):
+            pending.append(pool.submit(parse_jsonl, lines_chunk))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _parsed_csv(source, chunk):
+    """
+    Parses CSV rows (key, value) in chunks, skipping a header row 'key,value'. Keys and values are text
+    :param source: Open text file or iterable of lines
+    :param chunk: Records in a chunk
+    :return: Generator of lists of (key, value)
+    """
+    rows = csv.reader(source)
+    first = next(rows, None)
+    if first is None:
+        return
+    pending = [] if first == ["key", "value"] else [(first[0], first[1])]
+    while True:
+        pending.extend((row[0], row[1]) for row in islice(rows, chunk - len(pending)) if row)
+        if not pending:
+            return
+        yield pending
+        pending = []
+
+
+def _parsed_pickle(f):
+    """
+    Reads a pickle stream written by write_records: one pickled list of (key, value) per chunk
+    :param f: Open binary file
+    :return: Generator of lists of (key, value)
+    """
+    while True:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            return
+
+
+def read_records(source, format=None, chunk=CHUNK, workers=0):
+    """
+    Streams the records of a file or an iterable in chunks, so only a few chunks are in memory at a time
+    :param source: Path of a file, or an iterable of lines ('jsonl', 'csv') or of (key, value) pairs ('pickle')
+    :param format: 'jsonl', 'csv', 'pickle' or None to use the suffix of the path
+    :param chunk: Records in a chunk
+    :param workers: Processes parsing JSON lines (0: parses in this process)
+    :return: Generator of lists of (key, value)
+    """
+    path = source if isinstance(source, (str, bytes, os.PathLike)) else None
+    format = get_format(path, format)
+    if path is None:
+        if format == "jsonl":
+            yield from _parsed_jsonl(source, chunk, workers)
+        elif format == "csv":
+            yield from _parsed_csv(source, chunk)
+        else:
+            yield from _chunks(source, chunk)          # already (key, value) pairs
+        return
+    if format == "pickle":
+        with open(path, 'rb') as f:
+            yield from _parsed_pickle(f)
+        return
+    with open(path, newline="" if format == "csv" else None, encoding="utf-8") as f:
+        yield from _parsed_jsonl(f, chunk, workers) if format == "jsonl" else _parsed_csv(f, chunk)
+
+
+def write_records(path, items, format=None, chunk=CHUNK) -> int:
+    """
+    Writes records to a file in chunks, replacing it at once when complete
+    :param path: Path of the file
+    :param items: Iterable of (key, value)
+    :param format: 'jsonl', 'csv', 'pickle' or None to use the suffix of the path
+    :param chunk: Records written together
+    :return: Number of records written
+    """
+    format = get_format(path, format)
+    temp_name = f"{os.fspath(path)}.{os.getpid()}.tmp"
+    items = iter(items)
+    count = 0
+    try:
+        with open(temp_name, 'wb' if format == "pickle" else 'w', encoding=None if format == "pickle" else "utf-8",
+                  newline="" if format == "csv" else None) as f:
+            if format == "csv":
+                writer = csv.writer(f)
+                writer.writerow(["key", "value"])
+            for records in _chunks(items, chunk):
+                if format == "jsonl":
+                    f.writelines(json.dumps({"key": key, "value": val}) + "\n" for key, val in records)
+                elif format == "csv":
+                    writer.writerows(records)
+                else:
+                    pickle.dump(records, f, protocol=pickle.HIGHEST_PROTOCOL)
+                count += len(records)
+        os.replace(temp_name, path)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+    return count
+
+
+def main():
+    """
+    Measures import and export throughput: python bulk.py --records 1000000 --engine snapshot
+    """
+    from file_database import FileDataBase
+    parser = argparse.ArgumentParser(description="Measures bulk import and export throughput")
+    parser.add_argument("--records", type=int, default=1000000, help="number of records")
+    parser.add_argument("--engine", default="snapshot", choices=["snapshot", "log", "hash"], help="storage engine")
+    parser.add_argument("--workers", type=int, default=0, help="processes parsing JSON lines")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        for format in FORMATS:
+            source = os.path.join(directory, f"source.{format}")
+            write_records(source, ((f"key{n}", f"value {n}") for n in range(args.records)), format)
+            database = FileDataBase(os.path.join(directory, f"{format}.bin"), args.engine)
+            start = time.perf_counter()
+            database.import_from(source, format, workers=args.workers)
+            imported = time.perf_counter() - start
+            start = time.perf_counter()
+            database.export_to(os.path.join(directory, f"export.{format}"), format)
+            exported = time.perf_counter() - start
+            database.close()
+            print(f"{format:6} import {args.records / imported:10.0f} records/s   "
+                  f"export {args.records / exported:10.0f} records/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+"""
+Author: Tomas Dal Farra
+Date: 04/02/2023
+Description: Ordered feed of the changes committed to a database, numbered by sequence, for replication
+"""
+import threading
+import weakref
+import logging
+import struct
+import pickle
+import zlib
+import time
+import os
+
+# A record is a header (payload length, crc32 of the payload, sequence number, commit time) and the pickled
+# (operation, key, value) of one change
+RECORD = struct.Struct(">IIQd")
+READ_SIZE = 1 << 20             # bytes read from the feed at once by a cursor
+GAP = -1                        # operation of a record standing for committed changes the feed lost, up to its
+                                # sequence number: readers reaching it need a full snapshot
+
+_feeds = weakref.WeakSet()                  # feeds alive in this process, to recreate their conditions on fork
+
+
+def _reset_after_fork():
+    """ A condition held by a thread of the parent would never be released in the child, so it is recreated """
+    for feed in _feeds:
+        feed._appended = threading.Condition()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class FeedTruncated(Exception):
+    """ Changes asked for are no longer in the feed (or never were), the reader needs a full snapshot """
+
+
+def _records(data, limit=None):
+    """
+    Parses complete records from feed bytes, stopping at a torn or partial record
+    :param data: Feed bytes starting at a record boundary
+    :param limit: Maximum number of records (None: all)
+    :return: list of (end offset, (sequence, commit time, operation, key, value))
+    """
+    records = []
+    pos = 0
+    while pos + RECORD.size <= len(data) and (limit is None or len(records) < limit):
+        length, crc, seq, stamp = RECORD.unpack_from(data, pos)
+        start = pos + RECORD.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        pos = start + length
+        records.append((pos, (seq, stamp, *pickle.loads(payload))))
+    return records
+
+
+def _file_id(path):
+    """
+    Identity of the file at a path, to notice when it was rotated
+    :param path: File path
+    :return: device and inode of the file or None if it doesn't exist
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
+class ChangeFeed:
+    """
+    Append-only file '<file_name>.feed' of the changes committed to a database, each with the next sequence
+    number. Changes must be appended holding the writers exclusion of the database, so the order of the feed
+    is the order of the commits. When the feed reaches retain bytes it is rotated to '<file_name>.feed.1'
+    (replacing the previous one), so between retain and twice retain bytes of changes are kept for readers
+    """
+    def __init__(self, file_name, retain=1 << 22, fsync=False):
+        """
+        Initializer for the change feed
+        :param file_name: Name of the database file
+        :param retain: Feed size in bytes after which it is rotated
+        :param fsync: If appended records are made durable before the writer continues
+        """
+        self.feed_name = file_name + ".feed"
+        self.old_name = self.feed_name + ".1"
+        self.retain = retain
+        self.fsync = fsync
+        self.head = 0                       # last sequence number appended or seen by this process
+        self._offset = 0                    # bytes of the feed file already read to know head
+        self._feed_id = None
+        self._gap = None                    # last sequence number lost by a failed append, until a gap records it
+        self._appended = threading.Condition()    # guards the state above, notified on every append
+        _feeds.add(self)
+        self._catch_up()
+
+    def _catch_up(self, repair=False):
+        """
+        Reads the records appended by other processes (or since opening) to know the last sequence number
+        :param repair: Truncates a torn record at the end of the feed (only safe holding the writers exclusion)
+        """
+        try:
+            stat = os.stat(self.feed_name)
+        except FileNotFoundError:           # rotated and not appended since: the last record is in the old one
+            if self._feed_id is not None or not self.head:
+                self.head = max(self.head, self._last_of(self.old_name))
+            self._feed_id, self._offset = None, 0
+            return
+        feed_id = stat.st_dev, stat.st_ino
+        if feed_id != self._feed_id or stat.st_size < self._offset:
+            self._feed_id, self._offset = feed_id, 0
+        if stat.st_size == self._offset:    # nothing appended by others
+            if not self.head:
+                self.head = self._last_of(self.old_name)
+            return
+        with open(self.feed_name, 'rb') as feed:
+            feed.seek(self._offset)
+            data = feed.read()
+        records = _records(data)
+        if records:
+            self._offset += records[-1][0]
+            self.head = records[-1][1][0]
+        elif not self.head:
+            self.head = self._last_of(self.old_name)
+        if repair and self._offset < stat.st_size:
+            os.truncate(self.feed_name, self._offset)
+
+    @staticmethod
+    def _last_of(file_name) -> int:
+        """
+        Last sequence number of a feed file
+        :param file_name: Feed file
+        :return: sequence number (0 if it doesn't exist or is empty)
+        """
+        try:
+            with open(file_name, 'rb') as feed:
+                records = _records(feed.read())
+        except FileNotFoundError:
+            return 0
+        return records[-1][1][0] if records else 0
+
+    def append(self, changes):
+        """
+        Appends committed changes with the following sequence numbers (holding the writers exclusion).
+        If it fails the changes are committed anyway: their numbers are recorded as a gap, written at once
+        or by the next append, so readers take a snapshot instead of missing them
+        :param changes: List of (operation, key, value)
+        :raise Exception: the error of the failed append
+        """
+        with self._appended:
+            stamp = time.time()
+            last = max(self.head, self._gap or 0) + len(changes)     # if even the feed can't be read
+            try:
+                self._catch_up(repair=True)
+                data = bytearray()
+                seq = self.head
+                if self._gap is not None:   # lost by a failed append of this process
+                    seq = max(seq, self._gap)
+                    data += self._record((GAP, None, None), seq, stamp)
+                last = seq + len(changes)
+                for change in changes:
+                    seq += 1
+                    data += self._record(change, seq, stamp)
+                self._write(data)
+            except Exception:
+                self._gap = last
+                self._write_gap(stamp)
+                raise
+            self._gap = None
+            self.head = seq
+            self._appended.notify_all()
+
+    @staticmethod
+    def _record(change, seq, stamp) -> bytes:
+        """
+        Encodes a record
+        :param change: (operation, key, value)
+        :param seq: Sequence number
+        :param stamp: Commit time
+        :return: record bytes
+        """
+        payload = pickle.dumps(change, protocol=pickle.HIGHEST_PROTOCOL)
+        return RECORD.pack(len(payload), zlib.crc32(payload), seq, stamp) + payload
+
+    def _write(self, data):
+        """
+        Appends records to the feed file, rotating it when it reaches retain bytes
+        :param data: Records bytes
+        """
+        with open(self.feed_name, 'ab') as feed:
+            feed.write(data)
+            if self.fsync:
+                feed.flush()
+                os.fsync(feed.fileno())
+        if self._feed_id is None:           # created by this append
+            self._feed_id = _file_id(self.feed_name)
+        self._offset += len(data)
+        if self._offset >= self.retain:
+            os.replace(self.feed_name, self.old_name)
+            self._feed_id, self._offset = None, 0
+
+    def _write_gap(self, stamp):
+        """
+        Records the changes lost by a failed append as a gap (the next append tries again if it fails too)
+        :param stamp: Commit time
+        """
+        gap = self._gap
+        try:
+            self._catch_up(repair=True)     # drops a record torn by the failure
+            gap = max(self.head, gap)
+            self._write(self._record((GAP, None, None), gap, stamp))
+            self._gap = None
+        except Exception as err:
+            logging.error(f"Changes up to {gap} aren't in the feed and the gap isn't recorded yet: {err}")
+        self.head = max(self.head, gap)
+        self._appended.notify_all()
+
+    def last_seq(self) -> int:
+        """
+        Sequence number of the last change committed by any process (call it holding the reader access
+        so it matches the database)
+        :return: sequence number (0 if there are none)
+        """
+        with self._appended:
+            self._catch_up()
+            return self.head
+
+    def wait(self, seq, timeout):
+        """
+        Waits until this process appends a change after seq. Changes appended by other processes
+        aren't noticed, so readers wait with a timeout and then look at the feed anyway
+        :param seq: Last sequence number already read
+        :param timeout: Maximum seconds to wait
+        """
+        with self._appended:
+            self._appended.wait_for(lambda: self.head > seq, timeout)
+
+    def cursor(self, after):
+        """
+        Reader of the changes after a sequence number
+        :param after: Last sequence number the reader already has (0: from the first one)
+        :return: FeedCursor
+        """
+        return FeedCursor(self, after)
+
+
+class FeedCursor:
+    """
+    Reads the changes of a feed in order from a sequence number on, following the feed through rotations
+    """
+    def __init__(self, feed, after):
+        """
+        Initializer for a feed cursor
+        :param feed: ChangeFeed to read
+        :param after: Last sequence number the reader already has
+        :raise FeedTruncated: if the next change is no longer in the feed
+        """
+        self.feed = feed
+        self.seq = after                    # last sequence number read
+        self._file = None
+        self._pos = 0
+        self._locate()
+
+    def _locate(self):
+        """
+        Opens the feed file with the change after seq and moves to it
+        :raise FeedTruncated: if the feed doesn't have it
+        """
+        for name in (self.feed.old_name, self.feed.feed_name):
+            try:
+                f = open(name, 'rb')
+            except FileNotFoundError:
+                continue
+            pos = 0
+            while True:
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                length, _, seq, _ = RECORD.unpack(header)
+                if pos == 0 and seq > self.seq + 1:
+                    f.close()
+                    raise FeedTruncated(f"Changes after {self.seq} start at {seq} in {name}")
+                if seq > self.seq:
+                    self._file, self._pos = f, pos
+                    return
+                pos += RECORD.size + length
+                f.seek(pos)
+            if name == self.feed.old_name and os.path.exists(self.feed.feed_name):
+                f.close()
+                continue
+            last = self.feed.last_seq()
+            if self.seq > last:
+                f.close()
+                raise FeedTruncated(f"Change {self.seq} is ahead of the feed (at {last})")
+            self._file, self._pos = f, pos          # at the end, waiting for the next change
+            return
+        if self.seq > self.feed.last_seq():
+            raise FeedTruncated(f"Change {self.seq} is ahead of the empty feed")
+
+    def read(self, limit=1000) -> list:
+        """
+        Reads the next changes committed
+        :param limit: Maximum number of changes
+        :return: list of (sequence, commit time, operation, key, value), empty if there aren't new ones
+        :raise FeedTruncated: if the feed was rotated twice while the reader was behind
+        """
+        if self._file is None:
+            self._locate()
+            if self._file is None:
+                return []
+        self._file.seek(self._pos)
+        records = _records(self._file.read(READ_SIZE), limit)
+        for i, (_, record) in enumerate(records):
+            if record[2] == GAP:            # changes of a failed append, a snapshot has them
+                if not i:
+                    raise FeedTruncated(f"Changes after {self.seq} up to {record[0]} aren't in the feed")
+                records = records[:i]
+                break
+        if records:
+            self._pos += records[-1][0]
+            self.seq = records[-1][1][0]
+            return [record for _, record in records]
+        if _file_id(self.feed.feed_name) in (None, self._file_id()):
+            return []                       # nothing new in the current feed file
+        # this file was rotated and is read to the end: continue in the new one
+        self._file.close()
+        self._file = None
+        try:
+            f = open(self.feed.feed_name, 'rb')
+        except FileNotFoundError:
+            return []
+        header = f.read(RECORD.size)
+        if len(header) == RECORD.size and RECORD.unpack(header)[2] != self.seq + 1:
+            f.close()
+            raise FeedTruncated(f"Changes after {self.seq} were rotated out of the feed")
+        self._file, self._pos = f, 0
+        return self.read(limit)
+
+    def _file_id(self):
+        """ Identity of the open feed file """
+        stat = os.fstat(self._file.fileno())
+        return stat.st_dev, stat.st_ino
+
+    def close(self):
+        """ Closes the open feed file """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+if __name__ == "__main__":
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        change_feed = ChangeFeed(os.path.join(directory, "db.bin"), retain=200)
+        for n in range(20):
+            change_feed.append([(0, n, n), (1, -n, None)])
+        assert change_feed.last_seq() == 40 and ChangeFeed(change_feed.feed_name[:-5]).last_seq() == 40
+        try:
+            change_feed.cursor(0)
+            raise AssertionError("the first changes should have been rotated out")
+        except FeedTruncated:
+            pass
+        late = change_feed.cursor(38)
+        assert [record[0] for record in late.read()] == [39, 40] and late.read() == []
+        change_feed.append([(0, "x", 1)])
+        assert late.read()[0][2:] == (0, "x", 1)
@@ -0,0 +1,214 @@
+"""
+Author: Tomas Dal Farra
+Date: 20/01/2023
+Description: Client of the database server with a connection pool and pipelining
+"""
+from db_server import pack_frame, read_frame, GET, SET_VALUE, DELETE_VALUE, BATCH, ERROR
+from contextlib import contextmanager
+import threading
+import socket
+import queue
+
+
+def connect(address) -> socket.socket:
+    """
+    Opens a new connection to the server
+    :param address: Path of a Unix-domain socket or (host, port) for TCP
+    :return: connected socket
+    """
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.connect(address)
+    return sock
+
+
+class ConnectionPool:
+    """
+    Pool of connections to the server, opened when needed up to size and reused afterwards
+    """
+    def __init__(self, address, size=4):
+        """
+        Initializer for the connection pool
+        :param address: Path of a Unix-domain socket or (host, port) for TCP
+        :param size: Maximum number of connections
+        """
+        self.address = address
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        """
+        Lends a connection while inside the block. A connection that failed is closed instead of reused
+        """
+        self._slots.acquire()
+        try:
+            try:
+                sock = self._idle.get_nowait()
+            except queue.Empty:
+                sock = connect(self.address)
+            try:
+                yield sock
+            except Exception:
+                sock.close()
+                raise
+            self._idle.put(sock)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """
+        Closes idle connections
+        """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class Pipeline:
+    """
+    Requests queued to be sent together, their answers are read after sending all of them
+    """
+    def __init__(self, client):
+        """
+        Initializer for a pipeline
+        :param client: DataBaseClient to send the requests through
+        """
+        self.client = client
+        self.requests = []                  # (opcode, payload)
+
+    def set_value(self, key, val, ttl=None):
+        """ Queues a set_value """
+        self.requests.append((SET_VALUE, (key, val) if ttl is None else (key, val, ttl)))
+
+    def get_value(self, key):
+        """ Queues a get_value """
+        self.requests.append((GET, key))
+
+    def delete_value(self, key):
+        """ Queues a delete_value """
+        self.requests.append((DELETE_VALUE, key))
+
+    def execute(self) -> list:
+        """
+        Sends the queued requests and reads their answers
+        :return: result of each request in order
+        """
+        requests, self.requests = self.requests, []
+        return self.client._send(requests)
+
+
+class DataBaseClient:
+    """
+    Database with the interface of DataBase whose content lives in a DataBaseServer
+    """
+    def __init__(self, address, pool_size=4):
+        """
+        Initializer for the database client
+        :param address: Path of a Unix-domain socket or (host, port) for TCP
+        :param pool_size: Maximum number of connections used at the same time
+        """
+        self.pool = ConnectionPool(address, pool_size)
+
+    def _send(self, requests) -> list:
+        """
+        Sends requests in one write through a pooled connection and reads their answers
+        :param requests: List of (opcode, payload)
+        :return: result of each request in order
+        """
+        if not requests:
+            return []
+        with self.pool.connection() as sock:
+            sock.sendall(b"".join(pack_frame(request_id, opcode, payload)
+                                  for request_id, (opcode, payload) in enumerate(requests)))
+            answers = []
+            for request_id in range(len(requests)):
+                answer = read_frame(sock)
+                if answer is None or answer[0] != request_id:      # raised inside so the socket isn't reused
+                    raise ConnectionError("Connection to the database server was lost")
+                answers.append(answer)
+        results = []
+        for answer in answers:
+            if answer[1] == ERROR:
+                raise RuntimeError(f"Database server error: {answer[2]}")
+            results.append(answer[2])
+        return results
+
+    def set_value(self, key, val, ttl=None) -> bool:
+        """
+        Sets new key:value to database
+        :param key: Key for the database
+        :param val: Value of the key
+        :param ttl: Seconds until the key expires (None: never)
+        :return: If the operation was successful
+        """
+        return self._send([(SET_VALUE, (key, val) if ttl is None else (key, val, ttl))])[0]
+
+    def get_value(self, key):
+        """
+        Gets value according to the key of the database
+        If key doesn't exist None is returned
+        :param key: Key for the database element
+        :return: Value from the database if found
+        """
+        return self._send([(GET, key)])[0]
+
+    def delete_value(self, key):
+        """
+        Deletes value from database
+        :param key: Key for a database value
+        :return: Deleted value if existed
+        """
+        return self._send([(DELETE_VALUE, key)])[0]
+
+    def batch(self, operations) -> list:
+        """
+        Executes several operations in one request and one transaction of the server
+        :param operations: List of (operation, key, value) where operation is GET, SET_VALUE or DELETE_VALUE
+        :return: result of each operation
+        """
+        return self._send([(BATCH, list(operations))])[0]
+
+    def set_many(self, items) -> bool:
+        """
+        Sets several key:value pairs in one request
+        :param items: Dictionary or iterable of (key, value) pairs
+        :return: If the operation was successful
+        """
+        return all(self.batch([(SET_VALUE, key, val) for key, val in dict(items).items()]))
+
+    def get_many(self, keys) -> dict:
+        """
+        Gets values of several keys in one request
+        :param keys: Iterable of keys for the database
+        :return: Dictionary of key:value for each key
+        """
+        keys = list(keys)
+        return dict(zip(keys, self.batch([(GET, key, None) for key in keys])))
+
+    def delete_many(self, keys) -> dict:
+        """
+        Deletes several values in one request
+        :param keys: Iterable of keys for database values
+        :return: Dictionary of key:deleted value (None if it didn't exist)
+        """
+        keys = list(keys)
+        return dict(zip(keys, self.batch([(DELETE_VALUE, key, None) for key in keys])))
+
+    def pipeline(self) -> Pipeline:
+        """
+        Creates a pipeline to send several requests without waiting for each answer
+        :return: Pipeline
+        """
+        return Pipeline(self)
+
+    def close(self):
+        """
+        Closes the connections
+        """
+        self.pool.close()
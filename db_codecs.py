@@ -0,0 +1,489 @@
+"""
+Author: Tomas Dal Farra
+Date: 23/01/2023
+Description: Serialization codecs for the dictionary database and the header recording them in files
+"""
+from expiry import Expiring
+import lazy_dict
+import marshal
+import struct
+import pickle
+import time
+import zlib
+import lzma
+import bz2
+import os
+
+MAGIC = b"SDBC"
+HEADER = struct.Struct(">4sBB")             # magic, codec id, flags (id of the compression algorithm or 0)
+OUT_OF_BAND_SIZE = 1 << 12                  # bytes values from this size are written out of the pickle stream
+COMPRESS_THRESHOLD = 512                    # str/bytes values shorter than this are stored uncompressed
+
+
+class Codec:
+    """
+    Encodes a whole dictionary into bytes and back
+    """
+    codec_id = 0
+    name = ""
+
+    def encode(self, db) -> list:
+        """
+        Encodes a dictionary
+        :param db: Dictionary to encode
+        :return: list of byte chunks that written one after the other make the encoding
+        """
+        raise NotImplementedError
+
+    def decode(self, data) -> dict:
+        """
+        Decodes a dictionary
+        :param data: Bytes (or memoryview) of the encoding
+        :return: Dictionary
+        """
+        raise NotImplementedError
+
+    def dumps(self, db) -> bytes:
+        """
+        Encodes a dictionary into one bytes object
+        :param db: Dictionary to encode
+        :return: encoding
+        """
+        return b"".join(self.encode(db))
+
+
+class _OutOfBand:
+    """ Large bytes/bytearray value pickled as a buffer outside of the pickle stream """
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __reduce_ex__(self, protocol):
+        return type(self.value), (pickle.PickleBuffer(self.value),)
+
+
+class PickleCodec(Codec):
+    """
+    Highest pickle protocol. Values that are bytes or bytearray of OUT_OF_BAND_SIZE or more are written
+    as separate buffers after the pickle stream, so they are never copied into it
+    Layout: number of buffers, length of each buffer, length of the stream, stream, buffers
+    """
+    codec_id = 1
+    name = "pickle"
+    COUNT = struct.Struct(">I")
+    LENGTH = struct.Struct(">Q")
+
+    def encode(self, db) -> list:
+        if any(type(val) in (bytes, bytearray) and len(val) >= OUT_OF_BAND_SIZE for val in db.values()):
+            db = {key: _OutOfBand(val) if type(val) in (bytes, bytearray) and len(val) >= OUT_OF_BAND_SIZE else val
+                  for key, val in db.items()}
+        buffers = []
+        stream = pickle.dumps(db, protocol=pickle.HIGHEST_PROTOCOL, buffer_callback=buffers.append)
+        raws = [buffer.raw() for buffer in buffers]
+        lengths = b"".join(self.LENGTH.pack(raw.nbytes) for raw in raws)
+        return [self.COUNT.pack(len(raws)), lengths, self.LENGTH.pack(len(stream)), stream, *raws]
+
+    def decode(self, data) -> dict:
+        data = memoryview(data)
+        count = self.COUNT.unpack_from(data, 0)[0]
+        pos = self.COUNT.size
+        lengths = [self.LENGTH.unpack_from(data, pos + i * self.LENGTH.size)[0] for i in range(count)]
+        pos += count * self.LENGTH.size
+        stream_length = self.LENGTH.unpack_from(data, pos)[0]
+        pos += self.LENGTH.size
+        stream = data[pos:pos + stream_length]
+        pos += stream_length
+        buffers = []
+        for length in lengths:
+            buffers.append(data[pos:pos + length])
+            pos += length
+        return pickle.loads(stream, buffers=buffers)
+
+
+class MarshalCodec(Codec):
+    """
+    marshal: fastest for builtin types only (ValueError for anything else, bytearray is read back as bytes).
+    Its format may change between python versions
+    """
+    codec_id = 2
+    name = "marshal"
+
+    def encode(self, db) -> list:
+        return [marshal.dumps(db)]
+
+    def decode(self, data) -> dict:
+        return marshal.loads(data)
+
+
+class TaggedCodec(Codec):
+    """
+    Compact encoding of keys and values that are str, int, bytes or None (TypeError for anything else).
+    Every key and value is a tag byte and a length byte (255 means a 4 byte length follows) and its bytes.
+    An expiring value is an EXPIRING element holding its deadline followed by the value
+    """
+    codec_id = 3
+    name = "tagged"
+    NONE, INT, STR, BYTES, EXPIRING = range(5)
+    LONG = struct.Struct(">I")
+    DEADLINE = struct.Struct(">d")
+
+    def _element(self, obj, parts):
+        """
+        Appends the encoding of a key or value
+        :param obj: Key or value
+        :param parts: List of byte chunks to append to
+        """
+        kind = type(obj)
+        if kind is str:
+            tag, data = self.STR, obj.encode()
+        elif kind is bytes or kind is bytearray:
+            tag, data = self.BYTES, obj
+        elif kind is int:
+            tag, data = self.INT, obj.to_bytes((obj.bit_length() + 8) // 8, "big", signed=True)
+        elif obj is None:
+            tag, data = self.NONE, b""
+        elif kind is Expiring:
+            parts.append(bytes((self.EXPIRING, self.DEADLINE.size)) + self.DEADLINE.pack(obj.deadline))
+            self._element(obj.val, parts)
+            return
+        else:
+            raise TypeError(f"Tagged codec can't encode {kind.__name__}")
+        if len(data) < 255:
+            parts.append(bytes((tag, len(data))))
+        else:
+            parts.append(bytes((tag, 255)) + self.LONG.pack(len(data)))
+        parts.append(data)
+
+    def encode(self, db) -> list:
+        parts = []
+        for key, val in db.items():
+            self._element(key, parts)
+            self._element(val, parts)
+        return parts
+
+    def decode(self, data) -> dict:
+        data = memoryview(data)
+        end = len(data)
+        elements = []
+        deadlines = []                      # (index of an expiring element, its deadline)
+        pos = 0
+        while pos < end:
+            tag, length = data[pos], data[pos + 1]
+            pos += 2
+            if length == 255:
+                length = self.LONG.unpack_from(data, pos)[0]
+                pos += self.LONG.size
+            chunk = data[pos:pos + length]
+            pos += length
+            if tag == self.STR:
+                elements.append(str(chunk, "utf-8"))
+            elif tag == self.INT:
+                elements.append(int.from_bytes(chunk, "big", signed=True))
+            elif tag == self.BYTES:
+                elements.append(bytes(chunk))
+            elif tag == self.EXPIRING:
+                deadlines.append((len(elements), self.DEADLINE.unpack(chunk)[0]))
+            else:
+                elements.append(None)
+        for i, deadline in deadlines:
+            elements[i] = Expiring(elements[i], deadline)
+        return dict(zip(elements[::2], elements[1::2]))
+
+
+class IndexedCodec(Codec):
+    """
+    Values pickled one by one after a directory of the keys and the offsets of their values (see lazy_dict),
+    so a file can be opened reading only the keys (lazy option of the storage engines). Values of a LazyDict
+    that weren't read are written again without decoding them
+    """
+    codec_id = 4
+    name = "indexed"
+
+    def encode(self, db) -> list:
+        return lazy_dict.encode(db)
+
+    def decode(self, data) -> dict:
+        return lazy_dict.decode(data)
+
+
+CODECS = {codec.name: codec for codec in (PickleCodec(), MarshalCodec(), TaggedCodec(), IndexedCodec())}
+_BY_ID = {codec.codec_id: codec for codec in CODECS.values()}
+
+
+class Compression:
+    """
+    Compresses the str, bytes and bytearray values of a dictionary from a size threshold, so they are written
+    and read as fewer bytes. A compressed encoding is the length of a table of {key: kind of value} of the
+    compressed values, the table and the dictionary with those values replaced by their compressed bytes,
+    both encoded with the codec. Decoding only decompresses the values in the table.
+    The compressed bytes of the last encoded (or decoded) str and bytes values are kept, so rewriting a whole
+    dictionary compresses only the values that changed since
+    """
+    # algorithm: (id recorded in the flags of the header, compress(data, level), decompress(data))
+    ALGORITHMS = {"zlib": (1, lambda data, level: zlib.compress(data, 6 if level is None else level), zlib.decompress),
+                  "lzma": (2, lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+                  "bz2": (3, lambda data, level: bz2.compress(data, 9 if level is None else level), bz2.decompress)}
+    BYTES, STR, BYTEARRAY = range(3)
+    LENGTH = struct.Struct(">Q")
+
+    def __init__(self, algorithm="zlib", level=None, threshold=COMPRESS_THRESHOLD):
+        """
+        Initializer for the compression
+        :param algorithm: 'zlib', 'lzma' or 'bz2'
+        :param level: Compression level of the algorithm (None: its default, 6 for zlib and lzma, 9 for bz2)
+        :param threshold: Values shorter than this are stored uncompressed
+        """
+        if algorithm not in Compression.ALGORITHMS:
+            raise ValueError(f"Unknown compression: {algorithm}")
+        self.algorithm = algorithm
+        self.algorithm_id, self._compress, _ = Compression.ALGORITHMS[algorithm]
+        self.level = level
+        self.threshold = threshold
+        self.cache = {}             # id of a str/bytes value: (value, its compressed bytes), replaced at once
+
+    def encode(self, db, codec) -> list:
+        """
+        Encodes a dictionary compressing its large values (reusing the compressed bytes of cached values)
+        :param db: Dictionary to encode
+        :param codec: Codec encoding the table and the dictionary
+        :return: list of byte chunks
+        """
+        table = {}
+        compressed = {}
+        cache, new_cache = self.cache, {}
+        for key, val in db.items():
+            kind = type(val)
+            if (kind is bytes or kind is str or kind is bytearray) and len(val) >= self.threshold:
+                entry = cache.get(id(val))
+                if entry is not None and entry[0] is val:
+                    data = entry[1]
+                else:
+                    data = self._compress(val.encode() if kind is str else val, self.level)
+                if kind is bytearray:                       # may change in place, never cached
+                    table[key] = self.BYTEARRAY
+                else:
+                    table[key] = self.STR if kind is str else self.BYTES
+                    new_cache[id(val)] = (val, data)
+                compressed[key] = data
+        self.cache = new_cache
+        if compressed:
+            db = {**db, **compressed}
+        table = codec.dumps(table)
+        return [self.LENGTH.pack(len(table)), table, *codec.encode(db)]
+
+    @staticmethod
+    def decode(data, codec, algorithm_id, compression=None) -> dict:
+        """
+        Decodes a dictionary encoded by Compression.encode with any algorithm
+        :param data: Bytes (or memoryview) of the encoding
+        :param codec: Codec of the table and the dictionary
+        :param algorithm_id: Id of the algorithm recorded in the header
+        :param compression: Compression whose cache is replaced by the decoded values if it has the same algorithm
+        :return: Dictionary
+        """
+        decompress = _ALGORITHMS_BY_ID[algorithm_id]
+        data = memoryview(data)
+        length = Compression.LENGTH.unpack_from(data, 0)[0]
+        table = codec.decode(data[Compression.LENGTH.size:Compression.LENGTH.size + length])
+        db = codec.decode(data[Compression.LENGTH.size + length:])
+        cache = {}
+        for key, kind in table.items():
+            compressed = db[key]
+            val = decompress(compressed)
+            if kind == Compression.STR:
+                val = val.decode()
+            elif kind == Compression.BYTEARRAY:
+                val = bytearray(val)
+            else:
+                val = bytes(val)
+            if kind != Compression.BYTEARRAY:
+                cache[id(val)] = (val, compressed)
+            db[key] = val
+        if compression is not None and compression.algorithm_id == algorithm_id:
+            compression.cache = cache
+        return db
+
+
+_ALGORITHMS_BY_ID = {algorithm_id: decompress for algorithm_id, _, decompress in Compression.ALGORITHMS.values()}
+
+
+def get_codec(name):
+    """
+    Gets a codec by name
+    :param name: 'pickle', 'marshal', 'tagged', 'indexed' or None for the legacy format (plain pickle without header)
+    :return: Codec or None
+    """
+    if name is None:
+        return None
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec: {name}")
+    return CODECS[name]
+
+
+def get_codec_by_id(codec_id) -> Codec:
+    """
+    Gets a codec by the id recorded in files
+    :param codec_id: Codec id
+    :return: Codec
+    """
+    if codec_id not in _BY_ID:
+        raise ValueError(f"Unknown codec id {codec_id}")
+    return _BY_ID[codec_id]
+
+
+def get_compression(algorithm, level=None, threshold=COMPRESS_THRESHOLD):
+    """
+    Gets a compression
+    :param algorithm: 'zlib', 'lzma', 'bz2' or None for no compression
+    :param level: Compression level (see Compression)
+    :param threshold: Values shorter than this are stored uncompressed
+    :return: Compression or None
+    """
+    return None if algorithm is None else Compression(algorithm, level, threshold)
+
+
+def encode_body(db, codec, compression=None) -> list:
+    """
+    Encodes a dictionary with a codec, compressing its large values if there is a compression
+    :param db: Dictionary to encode
+    :param codec: Codec
+    :param compression: Compression or None
+    :return: list of byte chunks
+    """
+    return codec.encode(db) if compression is None else compression.encode(db, codec)
+
+
+def decode_body(data, codec, algorithm_id=0, compression=None) -> dict:
+    """
+    Decodes a dictionary encoded by encode_body()
+    :param data: Bytes (or memoryview) of the encoding
+    :param codec: Codec
+    :param algorithm_id: Id of the compression algorithm or 0 if it wasn't compressed
+    :param compression: Compression to keep the compressed values in its cache (see Compression.decode) or None
+    :return: Dictionary
+    """
+    return codec.decode(data) if not algorithm_id else Compression.decode(data, codec, algorithm_id, compression)
+
+
+def encode_file(db, codec=None, compression=None) -> list:
+    """
+    Encodes a dictionary as the content of a file: header and encoding, or a plain pickle without header
+    if codec is None (with a compression the pickle codec is used then, as it needs the header).
+    Encoding before opening the file leaves it untouched when a value can't be encoded
+    :param db: Dictionary to encode
+    :param codec: Codec or None
+    :param compression: Compression or None
+    :return: list of byte chunks to write one after the other
+    """
+    if codec is None and compression is None:
+        return [pickle.dumps(db)]
+    codec = codec or CODECS["pickle"]
+    flags = compression.algorithm_id if compression is not None else 0
+    return [HEADER.pack(MAGIC, codec.codec_id, flags), *encode_body(db, codec, compression)]
+
+
+def load(f) -> dict:
+    """
+    Reads a dictionary written from encode_file() with any codec
+    :param f: File open for binary reading
+    :return: Dictionary
+    """
+    return decode_file(f.read())
+
+
+def decode_file(data, compression=None) -> dict:
+    """
+    Decodes the content of a file written from encode_file() with any codec (without header it is a plain pickle)
+    :param data: Bytes of the file
+    :param compression: Compression to keep the compressed values in its cache (see Compression.decode) or None
+    :return: Dictionary
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        return pickle.loads(data)
+    _, codec_id, flags = HEADER.unpack_from(data, 0)
+    return decode_body(memoryview(data)[HEADER.size:], get_codec_by_id(codec_id), flags, compression)
+
+
+def compare(db, reps=5) -> dict:
+    """
+    Compares codecs on a dictionary (encoding time doesn't include joining the chunks, files are written
+    chunk by chunk)
+    :param db: Dictionary to encode
+    :param reps: Repetitions of each measure (the best is kept)
+    :return: Dictionary of codec name: (encode seconds, decode seconds, size in bytes)
+    """
+    results = {}
+    for name, codec in [("legacy", None), *CODECS.items()]:
+        encode_db = (lambda d: [pickle.dumps(d)]) if codec is None else codec.encode
+        decode_db = pickle.loads if codec is None else codec.decode
+        try:
+            data = b"".join(encode_db(db))
+        except (TypeError, ValueError):
+            continue
+        encode = decode = float("inf")
+        for _ in range(reps):
+            start = time.perf_counter()
+            encode_db(db)
+            middle = time.perf_counter()
+            decode_db(data)
+            encode, decode = min(encode, middle - start), min(decode, time.perf_counter() - middle)
+        results[name] = (encode, decode, len(data))
+    return results
+
+
+def compare_compression(db, levels=(1, 6), reps=3) -> dict:
+    """
+    Compares compression algorithms and levels on a dictionary with the pickle codec: CPU time against bytes
+    to write and read
+    :param db: Dictionary to encode
+    :param levels: Levels of each algorithm
+    :param reps: Repetitions of each measure (the best is kept)
+    :return: Dictionary of (algorithm, level): (encode seconds, decode seconds, size in bytes)
+    """
+    codec = CODECS["pickle"]
+    results = {}
+    for algorithm, level in [(None, None)] + [(name, level) for name in Compression.ALGORITHMS for level in levels]:
+        compression = get_compression(algorithm, level)
+        data = b"".join(encode_file(db, codec, compression))
+        encode = decode = float("inf")
+        for _ in range(reps):
+            start = time.perf_counter()
+            encode_file(db, codec, compression)
+            middle = time.perf_counter()
+            decode_file(data)
+            encode, decode = min(encode, middle - start), min(decode, time.perf_counter() - middle)
+        results[algorithm, level] = (encode, decode, len(data))
+    return results
+
+
+def text_sample(size=1 << 12, limit=2000) -> dict:
+    """
+    Text-heavy dictionary: the python sources of the standard library split in values of about size characters
+    :param size: Characters of each value
+    :param limit: Maximum number of values
+    :return: Dictionary of path:part: text
+    """
+    db = {}
+    root = os.path.dirname(os.__file__)
+    for name in sorted(os.listdir(root)):
+        if name.endswith(".py"):
+            with open(os.path.join(root, name), encoding="utf-8", errors="replace") as f:
+                text = f.read()
+            for part in range(0, len(text), size):
+                db[f"{name}:{part}"] = text[part:part + size]
+                if len(db) == limit:
+                    return db
+    return db
+
+
+if __name__ == "__main__":
+    samples = {"small str/int": {f"key{n}": n for n in range(100000)},
+               "1 KiB bytes": {n: bytes(1024) for n in range(10000)},
+               "64 KiB bytes": {n: bytes(1 << 16) for n in range(500)}}
+    for sample, sample_db in samples.items():
+        for codec_name, (enc, dec, size) in compare(sample_db).items():
+            print(f"{sample:14} {codec_name:8} encode {enc * 1000:8.2f} ms  decode {dec * 1000:8.2f} ms  {size:>10} bytes")
+    for (algorithm, level), (enc, dec, size) in compare_compression(text_sample()).items():
+        print(f"4 KiB text     {algorithm or 'none':5} {level or '-':>2} encode {enc * 1000:8.2f} ms  "
+              f"decode {dec * 1000:8.2f} ms  {size:>10} bytes")
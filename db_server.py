@@ -0,0 +1,285 @@
+"""
+Author: Tomas Dal Farra
+Date: 20/01/2023
+Description: Database server process: one in-memory database shared by any process through a socket
+"""
+from sync_database import SyncDataBase
+from change_feed import FeedTruncated
+import socketserver
+import threading
+import argparse
+import logging
+import struct
+import pickle
+import time
+import io
+import os
+
+# Every message is a frame: header (payload length, request id, opcode) followed by a pickled payload.
+# Requests of a connection are answered in order, so a client can pipeline them (send several before
+# reading the answers). Requests are unpickled without resolving any global but REQUEST_GLOBALS, so keys
+# and values sent to the server are builtin types and a request can't make it import or call anything
+FRAME = struct.Struct(">IIB")
+GET = 1                     # payload: key
+SET_VALUE = 2               # payload: (key, value) or (key, value, ttl)
+DELETE_VALUE = 3            # payload: key
+BATCH = 4                   # payload: list of (GET, SET_VALUE or DELETE_VALUE, key, value) in one transaction
+SNAPSHOT = 5                # payload: None, answer: (sequence number, dictionary) of a database with a feed
+SUBSCRIBE = 6               # payload: (sequence number, limit), answers until the connection is closed
+OK = 0                      # answer payload: result, or (last sequence number, changes) to SUBSCRIBE
+TRUNCATED = 254             # answer to SUBSCRIBE: the changes asked for are no longer in the feed
+ERROR = 255                 # answer payload: error message
+HEARTBEAT = 1.0             # seconds after which an idle subscription is sent an empty answer
+POLL = 0.1                  # seconds a subscription waits before looking for changes of other processes
+# sets, frozensets and bytearrays have their own opcodes, complex numbers are the one builtin type pickled by
+# calling it, with two numbers: no global lets a request allocate or loop beyond the size of its payload
+REQUEST_GLOBALS = {("builtins", "complex")}
+
+
+def recv_exact(sock, size) -> bytes:
+    """
+    Receives exactly size bytes
+    :param sock: Connected socket
+    :param size: Number of bytes
+    :return: bytes received (less only if the connection was closed)
+    """
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+
+def pack_frame(request_id, opcode, payload) -> bytes:
+    """
+    Builds a frame
+    :param request_id: Identifier of the request, repeated in its answer
+    :param opcode: Operation or answer code
+    :param payload: Object to pickle as payload
+    :return: frame bytes
+    """
+    data = pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+    return FRAME.pack(len(data), request_id, opcode) + data
+
+
+def read_raw_frame(sock):
+    """
+    Reads a frame without unpickling its payload
+    :param sock: Connected socket
+    :return: (request id, opcode, payload bytes) or None if the connection was closed
+    """
+    header = recv_exact(sock, FRAME.size)
+    if len(header) < FRAME.size:
+        return None
+    length, request_id, opcode = FRAME.unpack(header)
+    data = recv_exact(sock, length)
+    if len(data) < length:
+        return None
+    return request_id, opcode, data
+
+
+def read_frame(sock):
+    """
+    Reads a frame (of the server: its answers are trusted)
+    :param sock: Connected socket
+    :return: (request id, opcode, payload) or None if the connection was closed
+    """
+    frame = read_raw_frame(sock)
+    if frame is None:
+        return None
+    request_id, opcode, data = frame
+    return request_id, opcode, pickle.loads(data)
+
+
+class RequestUnpickler(pickle.Unpickler):
+    """
+    Unpickler of requests. Unpickling calls whatever a pickle names, so it only resolves the builtin types
+    of REQUEST_GLOBALS: any local user can connect to a TCP port, and a request must not run code in the server
+    """
+    def find_class(self, module, name):
+        if (module, name) in REQUEST_GLOBALS:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f"{module}.{name} is not allowed in a request")
+
+
+def loads_request(data):
+    """
+    Unpickles the payload of a request
+    :param data: Payload bytes
+    :return: payload of builtin types
+    """
+    return RequestUnpickler(io.BytesIO(data)).load()
+
+
+class DataBaseHandler(socketserver.BaseRequestHandler):
+    """
+    Serves the requests of one connection in order
+    """
+    def execute(self, opcode, payload):
+        """
+        Executes a request on the database of the server
+        :param opcode: Operation code
+        :param payload: Arguments of the operation
+        :return: result of the operation
+        """
+        database = self.server.database
+        if opcode == GET:
+            return database.get_value(payload)
+        if opcode == SET_VALUE:
+            return database.set_value(*payload)
+        if opcode == DELETE_VALUE:
+            return database.delete_value(payload)
+        if opcode == BATCH:
+            with database.transaction() as txn:
+                return [txn.get_value(key) if op == GET else
+                        txn.set_value(key, val) if op == SET_VALUE else
+                        txn.delete_value(key) for op, key, val in payload]
+        if opcode == SNAPSHOT:
+            return database.feed_snapshot()
+        raise ValueError(f"Unknown operation {opcode}")
+
+    def subscribe(self, request_id, after, limit):
+        """
+        Streams the changes of the feed after a sequence number as they are committed, with an empty
+        answer when idle for HEARTBEAT seconds, until the follower disconnects or the server shuts down
+        :param request_id: Identifier of the SUBSCRIBE request, repeated in every answer
+        :param after: Last sequence number the follower has
+        :param limit: Maximum changes in one answer
+        """
+        database = self.server.database
+        sock = self.request
+        try:
+            cursor = database.changes(after)
+        except FeedTruncated as err:
+            sock.sendall(pack_frame(request_id, TRUNCATED, str(err)))
+            return
+        except Exception as err:
+            logging.error(f"There was a problem to subscribe to the feed: {err}")
+            sock.sendall(pack_frame(request_id, ERROR, f"{type(err).__name__}: {err}"))
+            return
+        logging.info(f"Follower subscribed after change {after}")
+        sent = time.monotonic()
+        try:
+            while not self.server.closing.is_set():
+                try:
+                    changes = cursor.read(limit)
+                except FeedTruncated as err:
+                    sock.sendall(pack_frame(request_id, TRUNCATED, str(err)))
+                    return
+                if changes or time.monotonic() - sent >= HEARTBEAT:
+                    sock.sendall(pack_frame(request_id, OK, (database.feed.head, changes)))
+                    sent = time.monotonic()
+                if len(changes) < limit:
+                    database.feed.wait(cursor.seq, POLL)
+        except OSError:
+            logging.info(f"Follower disconnected at change {cursor.seq}")
+        finally:
+            cursor.close()
+
+    def handle(self):
+        """
+        Answers frames in order until the client closes the connection
+        """
+        sock = self.request
+        while True:
+            frame = read_raw_frame(sock)
+            if frame is None:
+                return
+            request_id, opcode, data = frame
+            try:
+                payload = loads_request(data)
+                if opcode != SUBSCRIBE:
+                    answer = pack_frame(request_id, OK, self.execute(opcode, payload))
+            except Exception as err:
+                logging.error(f"There was a problem to execute request {opcode}: {err}")
+                answer = pack_frame(request_id, ERROR, f"{type(err).__name__}: {err}")
+            else:
+                if opcode == SUBSCRIBE:         # the connection is used only for the stream from now on
+                    self.subscribe(request_id, *payload)
+                    return
+            sock.sendall(answer)
+
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    """
+    Unix-domain server whose socket only the user running it can connect to
+    """
+    def server_bind(self):
+        """
+        Binds the socket and restricts it before it listens, so nobody else can connect in between
+        """
+        super().server_bind()
+        os.chmod(self.server_address, 0o600)
+
+
+class DataBaseServer:
+    """
+    Owns one SyncDataBase kept in memory (reads are served from its cache) and persisted through its
+    file, and serves it to clients over a Unix-domain socket or localhost TCP
+    """
+    def __init__(self, address, file_name="dbfile.bin", engine="snapshot", **options):
+        """
+        Initializer for the database server
+        :param address: Path of a Unix-domain socket or (host, port) for TCP
+        :param file_name: Name of file for the database
+        :param engine: Storage engine of the file (see FileDataBase)
+        :param options: Options for the storage engine
+        """
+        self.database = SyncDataBase(1, file_name, engine, **options)
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.remove(address)
+            self.server = UnixServer(address, DataBaseHandler)
+        else:
+            self.server = socketserver.ThreadingTCPServer(address, DataBaseHandler)
+        self.server.daemon_threads = True
+        self.server.database = self.database
+        self.server.closing = threading.Event()     # ends the subscriptions being streamed
+        self.address = self.server.server_address
+
+    def serve_forever(self):
+        """
+        Serves clients until shutdown() is called
+        """
+        self.server.serve_forever()
+
+    def shutdown(self):
+        """
+        Stops serving and closes the database
+        """
+        self.server.closing.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.database.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+def main():
+    """
+    Entry point: python db_server.py --file dbfile.bin (--unix path | --port number) [--feed]
+    """
+    parser = argparse.ArgumentParser(description="Serves a database file to local clients")
+    parser.add_argument("--file", default="dbfile.bin", help="database file")
+    parser.add_argument("--engine", default="snapshot", choices=["snapshot", "log", "hash"], help="storage engine")
+    parser.add_argument("--unix", help="path of the Unix-domain socket to listen on")
+    parser.add_argument("--port", type=int, default=5433, help="localhost TCP port (if --unix isn't given)")
+    parser.add_argument("--feed", action="store_true", help="keep a change feed for followers")
+    args = parser.parse_args()
+    server = DataBaseServer(args.unix or ("127.0.0.1", args.port), args.file, args.engine, feed=args.feed)
+    logging.info(f"Serving {args.file} on {server.address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    # logging configuration just when running
+    logging.basicConfig(filename="file_database.log", level=logging.INFO,
+                        format="[%(filename)s] - %(asctime)s - %(levelname)s - %(message)s")
+    main()
@@ -3,6 +3,14 @@ Author: Tomas Dal Farra
 Date: 25/12/2022
 Description: Interface for a database based on a python dictionary
 """
+from sorted_index import KeyIndex
+from expiry import Expiring, ExpiryHeap, REAP_BATCH, expiring, expired, live
+from contextlib import contextmanager
+from itertools import islice
+import time
+
+BATCH = 1000                # keys whose values are read together while scanning
+_MISSING = object()
 
 
 class DataBase:
@@ -11,15 +19,22 @@ class DataBase:
     """
     def __init__(self):
         self.db = {}
+        self._index = None              # KeyIndex of the keys of db, built by the first scan and kept up to date
+        self._expiry = ExpiryHeap()     # deadlines of keys set with a ttl, to reap them
 
-    def set_value(self, key, val):
+    def set_value(self, key, val, ttl=None):
         """
         Sets new key:value to database
         :param key: Key for the database
         :param val: Value of the key
+        :param ttl: Seconds until the key expires (None: never)
         """
         try:
+            val = expiring(val, ttl)
             self.db[key] = val
+            self._reindex(key)
+            if isinstance(val, Expiring):
+                self._expire(key, val.deadline)
             return True
         except KeyError:
             return False
@@ -31,7 +46,7 @@ class DataBase:
         :param key: Key for the database element
         :return: Value from the database if found
         """
-        return self.db.get(key)
+        return live(self.db.get(key))
 
     def delete_value(self, key):
         """
@@ -39,7 +54,203 @@ class DataBase:
         :param key: Key for a database value
         :return: Deleted value if existed
         """
-        return self.db.pop(key, None)
+        val = self.db.pop(key, None)
+        self._reindex(key, deleted=True)
+        return live(val)
+
+    def set_many(self, items) -> bool:
+        """
+        Sets several key:value pairs to database
+        :param items: Dictionary or iterable of (key, value) pairs
+        :return: If the operation was successful
+        """
+        items = dict(items)
+        self.db.update(items)
+        for key in items:
+            self._reindex(key)
+        return True
+
+    def get_many(self, keys) -> dict:
+        """
+        Gets values of several keys of the database (None for keys that don't exist)
+        :param keys: Iterable of keys for the database
+        :return: Dictionary of key:value for each key
+        """
+        now = time.time()
+        return {key: live(self.db.get(key), now) for key in keys}
+
+    def delete_many(self, keys) -> dict:
+        """
+        Deletes several values from database
+        :param keys: Iterable of keys for database values
+        :return: Dictionary of key:deleted value (None if it didn't exist)
+        """
+        now = time.time()
+        deleted = {key: live(self.db.pop(key, None), now) for key in keys}
+        for key in deleted:
+            self._reindex(key, deleted=True)
+        return deleted
+
+    def update(self, key, fn):
+        """
+        Sets a key to a function of its current value atomically, in one transaction
+        :param key: Key for the database
+        :param fn: Function taking the current value (None if the key doesn't exist) and returning the new one
+        :return: New value
+        """
+        with self.transaction() as txn:
+            return txn.update(key, fn)
+
+    def increment(self, key, delta=1):
+        """
+        Adds to the value of a key atomically (see update)
+        :param key: Key for the database
+        :param delta: Amount to add (a key that doesn't exist counts as 0)
+        :return: New value
+        """
+        return self.update(key, lambda val: delta if val is None else val + delta)
+
+    def compare_and_set(self, key, expected, new) -> bool:
+        """
+        Sets a key only if its current value is the expected one, atomically in one transaction
+        :param key: Key for the database
+        :param expected: Value the key must have (None if it must not exist)
+        :param new: Value to set
+        :return: If the value was set
+        """
+        with self.transaction() as txn:
+            return txn.compare_and_set(key, expected, new)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups changes to apply them all together when the block ends.
+        If an exception is raised inside the block nothing is applied
+        :return: Transaction where to make the changes
+        """
+        txn = Transaction(self.db)
+        yield txn
+        txn.apply()
+        for key, val in txn.staged.items():
+            self._reindex(key, deleted=val is Transaction.DELETED)
+            if isinstance(val, Expiring):
+                self._expire(key, val.deadline)
+
+    def _expire(self, key, deadline):
+        """
+        Records in the expiry heap a key set with a ttl
+        :param key: Key for the database
+        :param deadline: time.time() when it expires
+        """
+        self._expiry.push(key, deadline)
+
+    def _seed_expiry(self):
+        """
+        Pushes to the expiry heap the expiring keys already in the database
+        """
+        self._expiry.seed(list(self.db.items()))
+
+    def reap(self, limit=REAP_BATCH) -> int:
+        """
+        Deletes expired keys, earliest first, in one transaction. Expired keys are invisible to readers
+        already, this frees them. The first reap looks for the expiring keys already in the database
+        :param limit: Maximum number of keys to delete
+        :return: Number of keys deleted
+        """
+        if not self._expiry.seeded:
+            self._seed_expiry()
+        now = time.time()
+        if not self._expiry.due(now):
+            return 0
+        with self.transaction() as txn:
+            for key in self._expiry.pop_due(now, limit):
+                if expired(txn.base.get(key), now):    # else it was set again after the entry was pushed
+                    txn.delete_value(key)
+            return len(txn.staged)
+
+    def _reindex(self, key, deleted=False):
+        """
+        Keeps the sorted index (if any) up to date with a change of a key.
+        A key that can't be ordered with the others drops the index, scans then fail building it
+        :param key: Key set or deleted
+        :param deleted: If the key was deleted
+        """
+        if self._index is None:
+            return
+        try:
+            self._index.discard(key) if deleted else self._index.add(key)
+        except TypeError:
+            self._index = None
+
+    def _ordered(self):
+        """
+        Dictionary to scan and a snapshot of the sorted index of its keys, so changes made while
+        scanning don't move the scan
+        :return: (dictionary, KeyIndex)
+        """
+        if self._index is None:
+            self._index = KeyIndex(self.db)
+        return self.db, self._index.snapshot()
+
+    @staticmethod
+    def _stream(db, keys, batch):
+        """
+        Streams the (key, value) pairs of some keys reading the values of each batch of keys together
+        (keys deleted since the index snapshot and expired keys are skipped)
+        :param db: Dictionary with the values
+        :param keys: Iterable of keys in order
+        :param batch: Number of keys in a batch
+        :return: Generator of (key, value)
+        """
+        keys = iter(keys)
+        while True:
+            chunk = list(islice(keys, batch))
+            if not chunk:
+                return
+            now = time.time()
+            for key, val in [(key, db.get(key, _MISSING)) for key in chunk]:
+                if val is not _MISSING and not expired(val, now):
+                    yield key, live(val, now)
+
+    def keys(self):
+        """
+        Streams the keys in order: keys of each type together (all numbers together), types by name
+        :return: Generator of keys
+        """
+        db, index = self._ordered()
+        for key, _ in self._stream(db, index.irange(), BATCH):
+            yield key
+
+    def items(self, batch=BATCH):
+        """
+        Streams the key:value pairs in order of the keys (see keys)
+        :param batch: Number of values read together
+        :return: Generator of (key, value)
+        """
+        db, index = self._ordered()
+        yield from self._stream(db, index.irange(), batch)
+
+    def scan(self, start=None, end=None, batch=BATCH):
+        """
+        Streams the key:value pairs with keys from start (included) to end (excluded) in order.
+        Bounds must be comparable to each other and only keys comparable to them are scanned
+        :param start: First key or None from the first one
+        :param end: Key where to stop or None until the last one
+        :param batch: Number of values read together
+        :return: Generator of (key, value)
+        """
+        db, index = self._ordered()
+        yield from self._stream(db, index.irange(start, end), batch)
+
+    def prefix(self, prefix, batch=BATCH):
+        """
+        Streams the key:value pairs with keys starting with a prefix in order
+        :param prefix: str or bytes the keys start with
+        :param batch: Number of values read together
+        :return: Generator of (key, value)
+        """
+        db, index = self._ordered()
+        yield from self._stream(db, index.prefix(prefix), batch)
 
     def __repr__(self):
         """
@@ -49,6 +260,128 @@ class DataBase:
         return str(self.db)
 
 
+class Transaction:
+    """
+    Changes staged over a dictionary database that are applied all together
+    """
+    DELETED = object()                      # marks a staged deletion
+
+    def __init__(self, db):
+        """
+        Initializer for a transaction
+        :param db: Dictionary the changes are made over
+        """
+        self.base = db
+        self.staged = {}                    # key: new value or DELETED, in order of change
+
+    def set_value(self, key, val, ttl=None) -> bool:
+        """
+        Stages new key:value
+        :param key: Key for the database
+        :param val: Value of the key
+        :param ttl: Seconds until the key expires (None: never)
+        :return: If the operation was successful
+        """
+        self.staged.pop(key, None)          # keeps the order of the last change
+        self.staged[key] = expiring(val, ttl)
+        return True
+
+    def get_value(self, key):
+        """
+        Gets value of the key as seen by the transaction
+        If key doesn't exist None is returned
+        :param key: Key for the database element
+        :return: Value from the database if found
+        """
+        val = self.staged[key] if key in self.staged else self.base.get(key)
+        return None if val is Transaction.DELETED else live(val)
+
+    def delete_value(self, key):
+        """
+        Stages the deletion of a key
+        :param key: Key for a database value
+        :return: Deleted value if existed
+        """
+        val = self.get_value(key)
+        self.staged.pop(key, None)
+        self.staged[key] = Transaction.DELETED
+        return val
+
+    def set_many(self, items) -> bool:
+        """
+        Stages several key:value pairs
+        :param items: Dictionary or iterable of (key, value) pairs
+        :return: If the operation was successful
+        """
+        for key, val in dict(items).items():
+            self.set_value(key, val)
+        return True
+
+    def get_many(self, keys) -> dict:
+        """
+        Gets values of several keys as seen by the transaction
+        :param keys: Iterable of keys for the database
+        :return: Dictionary of key:value for each key
+        """
+        return {key: self.get_value(key) for key in keys}
+
+    def delete_many(self, keys) -> dict:
+        """
+        Stages the deletion of several keys
+        :param keys: Iterable of keys for database values
+        :return: Dictionary of key:deleted value (None if it didn't exist)
+        """
+        return {key: self.delete_value(key) for key in keys}
+
+    def update(self, key, fn):
+        """
+        Stages a key set to a function of its value as seen by the transaction
+        :param key: Key for the database
+        :param fn: Function taking the current value (None if the key doesn't exist) and returning the new one
+        :return: New value
+        """
+        val = fn(self.get_value(key))
+        self.set_value(key, val)
+        return val
+
+    def increment(self, key, delta=1):
+        """
+        Stages adding to the value of a key
+        :param key: Key for the database
+        :param delta: Amount to add (a key that doesn't exist counts as 0)
+        :return: New value
+        """
+        return self.update(key, lambda val: delta if val is None else val + delta)
+
+    def compare_and_set(self, key, expected, new) -> bool:
+        """
+        Stages a key set only if its value as seen by the transaction is the expected one
+        :param key: Key for the database
+        :param expected: Value the key must have (None if it must not exist)
+        :param new: Value to set
+        :return: If the value was set
+        """
+        if self.get_value(key) != expected:
+            return False
+        return self.set_value(key, new)
+
+    def apply(self):
+        """
+        Applies the staged changes to the dictionary. A dictionary written in place (see
+        hash_storage.HashIndexMap.write_many) takes them all at once, to check them before writing any
+        """
+        write_many = getattr(self.base, "write_many", None)
+        if write_many is not None:
+            write_many([(key, val) for key, val in self.staged.items() if val is not Transaction.DELETED],
+                       [key for key, val in self.staged.items() if val is Transaction.DELETED])
+            return
+        for key, val in self.staged.items():
+            if val is Transaction.DELETED:
+                self.base.pop(key, None)
+            else:
+                self.base[key] = val
+
+
 if __name__ == "__main__":
     dbase = DataBase()
     assert dbase.set_value('1', 'a')
@@ -57,3 +390,28 @@ if __name__ == "__main__":
     assert dbase.delete_value('2') is None
     assert dbase.delete_value('1') == 'a'
     assert repr(dbase) == '{}'
+    assert dbase.set_many({'1': 'a', '2': 'b'})
+    assert dbase.get_many(['1', '3']) == {'1': 'a', '3': None}
+    try:
+        with dbase.transaction() as t:
+            t.delete_value('1')
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    with dbase.transaction() as t:
+        assert t.delete_value('1') == 'a' and t.get_value('1') is None
+        t.set_value('3', 'c')
+    assert dbase.delete_many(['1', '2']) == {'1': None, '2': 'b'}
+    assert repr(dbase) == "{'3': 'c'}"
+    assert dbase.increment('n') == 1 and dbase.increment('n', 5) == 6
+    assert dbase.update('3', str.upper) == 'C'
+    assert not dbase.compare_and_set('3', 'c', 'd') and dbase.compare_and_set('3', 'C', 'd')
+    assert dbase.get_value('3') == 'd'
+    assert list(dbase.keys()) == ['3', 'n']
+    dbase.set_many({'a1': 1, 'a2': 2, 'b': 3})
+    dbase.delete_value('3')
+    assert list(dbase.prefix('a')) == [('a1', 1), ('a2', 2)]
+    assert list(dbase.scan('a2', 'n')) == [('a2', 2), ('b', 3)]
+    assert dbase.set_value('t', 'x', ttl=60) and dbase.get_value('t') == 'x'
+    assert dbase.set_value('gone', 'y', ttl=-1) and dbase.get_value('gone') is None
+    assert 'gone' not in dbase.keys() and dbase.reap() == 1 and 'gone' not in dbase.db
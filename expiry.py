@@ -0,0 +1,152 @@
+"""
+Author: Tomas Dal Farra
+Date: 02/02/2023
+Description: Values with an expiry time and the min-heap of expiry times that drives their removal
+"""
+from itertools import count
+import threading
+import weakref
+import heapq
+import time
+import os
+
+REAP_BATCH = 100            # maximum keys removed by one reap, so writers are never kept waiting long
+
+_heaps = weakref.WeakSet()                  # heaps alive in this process, to recreate their locks on fork
+
+
+def _reset_after_fork():
+    """ A lock held by a thread of the parent would never be released in the child, so it is recreated """
+    for expiry_heap in _heaps:
+        expiry_heap._lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class Expiring:
+    """
+    Value stored with the time it expires. It is what the database file keeps for a key set with a ttl,
+    so the expiry persists with the value in every storage engine
+    """
+    __slots__ = ("val", "deadline")
+
+    def __init__(self, val, deadline):
+        """
+        Initializer for an expiring value
+        :param val: Value of the key
+        :param deadline: time.time() when the key expires
+        """
+        self.val = val
+        self.deadline = deadline
+
+    def __reduce__(self):
+        return Expiring, (self.val, self.deadline)
+
+    def __eq__(self, other):
+        return isinstance(other, Expiring) and (self.val, self.deadline) == (other.val, other.deadline)
+
+    def __repr__(self):
+        return f"Expiring({self.val!r}, {self.deadline})"
+
+
+def expiring(val, ttl):
+    """
+    Value to store for a key set with a time to live
+    :param val: Value of the key
+    :param ttl: Seconds until the key expires or None if it never does
+    :return: Expiring value or val
+    """
+    return val if ttl is None else Expiring(val, time.time() + ttl)
+
+
+def live(val, now=None):
+    """
+    Value as readers see it: expired values don't exist (None) and expiring ones are unwrapped
+    :param val: Stored value
+    :param now: time.time() to compare with (now if None)
+    :return: Value or None
+    """
+    if isinstance(val, Expiring):
+        return val.val if val.deadline > (time.time() if now is None else now) else None
+    return val
+
+
+def expired(val, now) -> bool:
+    """
+    If a stored value has expired
+    :param val: Stored value
+    :param now: time.time() to compare with
+    :return: True if it is an expired Expiring value
+    """
+    return isinstance(val, Expiring) and val.deadline <= now
+
+
+class ExpiryHeap:
+    """
+    Min-heap of (deadline, key) of expiring keys. An entry isn't removed when its key changes: whoever pops
+    it must check the key still holds an expired value
+    """
+    def __init__(self):
+        self._heap = []
+        self._order = count()               # ties of deadlines never compare keys (of any type)
+        self._lock = threading.Lock()
+        self.seeded = False                 # if the expiring keys already in the database were pushed
+        _heaps.add(self)
+
+    def push(self, key, deadline):
+        """
+        Adds a key that expires
+        :param key: Key for the database
+        :param deadline: time.time() when it expires
+        """
+        with self._lock:
+            heapq.heappush(self._heap, (deadline, next(self._order), key))
+
+    def seed(self, items):
+        """
+        Adds the expiring keys of a database
+        :param items: Iterable of (key, stored value)
+        """
+        entries = [(val.deadline, next(self._order), key) for key, val in items if isinstance(val, Expiring)]
+        with self._lock:
+            self._heap.extend(entries)
+            heapq.heapify(self._heap)
+            self.seeded = True
+
+    def due(self, now) -> bool:
+        """
+        If any key is due to expire
+        :param now: time.time() to compare with
+        :return: True if the earliest deadline has passed
+        """
+        heap = self._heap
+        return bool(heap) and heap[0][0] <= now
+
+    def pop_due(self, now, limit) -> list:
+        """
+        Removes the keys whose deadline has passed, earliest first
+        :param now: time.time() to compare with
+        :param limit: Maximum number of keys
+        :return: list of keys
+        """
+        keys = []
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][0] <= now and len(keys) < limit:
+                keys.append(heapq.heappop(heap)[2])
+        return keys
+
+    def __len__(self):
+        return len(self._heap)
+
+
+if __name__ == "__main__":
+    expiry = ExpiryHeap()
+    expiry.seed([("a", Expiring(1, 5.0)), ("b", 2), ("c", Expiring(3, 1.0))])
+    expiry.push(7, 3.0)
+    assert len(expiry) == 3 and expiry.due(1.0) and not expiry.due(0.5)
+    assert expiry.pop_due(4.0, 10) == ["c", 7] and expiry.pop_due(10.0, 10) == ["a"]
+    assert live(Expiring("x", 2.0), 1.0) == "x" and live(Expiring("x", 2.0), 2.0) is None and live(5) == 5
+    assert expiring("x", None) == "x" and live(expiring("x", 60)) == "x"
@@ -3,9 +3,17 @@ Author: Tomas Dal Farra
 Date: 25/12/2022
 Description: Defines a class where to handle a dictionary database within a file
 """
-from dict_database import DataBase
-import pickle
+from dict_database import DataBase, Transaction
+from storage import SnapshotStorage, LogStorage, SET, DELETE
+from hash_storage import HashStorage
+from sorted_index import KeyIndex
+from expiry import expiring, live, expired
+from bloom_filter import BloomFilter, MIN_KEYS
+from lazy_dict import LazyDict, save_hot_keys
+import bulk
+from contextlib import contextmanager
 import os
+import time
 import logging
 
 
@@ -13,45 +21,49 @@ class FileDataBase(DataBase):
     """
     File handling dictionary database
     """
-    def __init__(self, file_name="dbfile.bin"):
-        self.file_name = file_name
-        super().__init__()
-        if not self._non_zero_file(self.file_name):      # creates file with empty dictionary if it doesn't exist
-            with open(self.file_name, 'wb') as f:
-                pickle.dump({}, f)
-                logging.debug("New database initialized")
-        else:
-            with open(self.file_name, 'rb') as f:
-                self.db = pickle.load(f)
-                logging.debug("Previous database content loaded")
+    ENGINES = {"snapshot": SnapshotStorage, "log": LogStorage, "hash": HashStorage}
 
-    @staticmethod
-    def _non_zero_file(file_path) -> bool:
+    def __init__(self, file_name="dbfile.bin", engine="snapshot", **options):
         """
-        Checks if a file exists and if it has any content
-        :param file_path: path for file to check
-        :return: if file meets the condition
+        Initializer for file database class
+        :param file_name: Name of file for the database
+        :param engine: Storage engine, 'snapshot' rewrites the whole file on every change,
+        'log' appends changes to a log that is compacted in background and 'hash' keeps a
+        memory-mapped hash table that is changed in place
+        :param options: Options for the storage engine (e.g. compact_size for 'log', buckets for 'hash',
+        codec='pickle', 'marshal', 'tagged' or 'indexed', compression='zlib', 'lzma' or 'bz2' with compression_level
+        and compression_threshold and lazy=True to decode values when first read for 'snapshot' and 'log') and
+        its durability policy: durability='os' (default), 'always' or 'interval' with interval_ms and interval_ops
         """
-        try:
-            return os.path.getsize(file_path) > 0
-        except OSError:
-            return False
+        if engine not in FileDataBase.ENGINES:
+            raise ValueError(f"Unknown storage engine: {engine}")
+        self.file_name = file_name
+        super().__init__()
+        self.storage = FileDataBase.ENGINES[engine](file_name, **options)
+        self.db = self.storage.open()
+        self._indexed = None            # (storage version, dictionary, KeyIndex of its keys) to scan, replaced at once
+        self.feed = None                # ChangeFeed recording the committed changes (see SyncDataBase)
+        self.bloom = None               # BloomFilter of the keys, to answer missing keys without loading (see SyncDataBase)
+        self.bloom_name = file_name + ".bloom"
+        self.hot_name = file_name + ".hot"     # keys read before closing a lazily opened file, to warm up with
 
-    def set_value(self, key, val) -> bool:
+    def set_value(self, key, val, ttl=None) -> bool:
         """
         Sets new key:value to database in file
         :param key: Key for the database
         :param val: Value of the key
+        :param ttl: Seconds until the key expires (None: never), the expiry time is stored with the value
         :return: If the operation was successful
         """
         try:
-            with open(self.file_name, 'rb') as f:
-                self.db = pickle.load(f)
+            self._load_for_write()
+            val = expiring(val, ttl)
             is_set = super().set_value(key, val)
-            with open(self.file_name, 'wb') as f:
-                pickle.dump(self.db, f)
+            self._persist([(SET, key, val)])
+            self._await_durable()
             return is_set
         except Exception as err:
+            self.storage.invalidate()
             logging.error(f"There was a problem to set value: {err}")
             raise err
 
@@ -63,8 +75,7 @@ class FileDataBase(DataBase):
         :return: Value from the database if found
         """
         try:
-            with open(self.file_name, 'rb') as f:
-                self.db = pickle.load(f)
+            self.db = self.storage.load()
             return super().get_value(key)
         except Exception as err:
             logging.error(f"There was a problem to get value: {err}")
@@ -77,16 +88,314 @@ class FileDataBase(DataBase):
         :return: Deleted value if existed
         """
         try:
-            with open(self.file_name, 'rb') as f:
-                self.db = pickle.load(f)
+            self._load_for_write()
+            existed = key in self.db
             val = super().delete_value(key)
-            with open(self.file_name, 'wb') as f:
-                pickle.dump(self.db, f)
+            self._persist([(DELETE, key, None)] if existed else [])
+            self._await_durable()
             return val
         except Exception as err:
+            self.storage.invalidate()
             logging.error(f"There was a problem to delete value: {err}")
             raise err
 
+    def update(self, key, fn):
+        """
+        Sets a key to a function of its current value in file, loading and persisting once
+        :param key: Key for the database
+        :param fn: Function taking the current value (None if the key doesn't exist) and returning the new one
+        :return: New value
+        """
+        try:
+            self._load_for_write()
+            val = fn(live(self.db.get(key)))
+            super().set_value(key, val)
+            self._persist([(SET, key, val)])
+            self._await_durable()
+            return val
+        except Exception as err:
+            self.storage.invalidate()
+            logging.error(f"There was a problem to update value: {err}")
+            raise err
+
+    def compare_and_set(self, key, expected, new) -> bool:
+        """
+        Sets a key in file only if its current value is the expected one, loading and persisting once
+        :param key: Key for the database
+        :param expected: Value the key must have (None if it must not exist)
+        :param new: Value to set
+        :return: If the value was set
+        """
+        try:
+            if live(self.storage.load().get(key)) != expected:
+                return False
+            self._load_for_write()
+            super().set_value(key, new)
+            self._persist([(SET, key, new)])
+            self._await_durable()
+            return True
+        except Exception as err:
+            self.storage.invalidate()
+            logging.error(f"There was a problem to compare and set value: {err}")
+            raise err
+
+    def set_many(self, items) -> bool:
+        """
+        Sets several key:value pairs to database in file, writing the file once
+        :param items: Dictionary or iterable of (key, value) pairs
+        :return: If the operation was successful
+        """
+        with self.transaction() as txn:
+            return txn.set_many(items)
+
+    def get_many(self, keys) -> dict:
+        """
+        Gets values of several keys of the database in file, reading the file once
+        :param keys: Iterable of keys for the database
+        :return: Dictionary of key:value for each key
+        """
+        try:
+            self.db = self.storage.load()
+            return super().get_many(keys)
+        except Exception as err:
+            logging.error(f"There was a problem to get values: {err}")
+            raise err
+
+    def delete_many(self, keys) -> dict:
+        """
+        Deletes several values from database in file, writing the file once
+        :param keys: Iterable of keys for database values
+        :return: Dictionary of key:deleted value (None if it didn't exist)
+        """
+        with self.transaction() as txn:
+            return txn.delete_many(keys)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups changes to apply them all together when the block ends: the file is read once
+        when it starts and written once when it ends. If an exception is raised inside the block
+        nothing is applied
+        :return: Transaction where to make the changes
+        """
+        self._load_for_write()
+        with super().transaction() as txn:
+            yield txn
+            changes = [(DELETE, key, None) if val is Transaction.DELETED else (SET, key, val)
+                       for key, val in txn.staged.items()]
+        try:
+            self._persist(changes)
+        except Exception as err:
+            self.storage.invalidate()
+            logging.error(f"There was a problem to commit transaction: {err}")
+            raise err
+        self._await_durable()
+
+    def import_from(self, source, format=None, chunk=bulk.CHUNK, workers=0) -> int:
+        """
+        Sets the records of a file or an iterable streaming them in chunks (see bulk.read_records), so only
+        a few chunks of records are in memory besides the database. The snapshot engine writes the file once
+        at the end (all records or none), other engines persist each chunk as it is applied
+        :param source: Path of a file, or an iterable of lines ('jsonl', 'csv') or of (key, value) pairs ('pickle')
+        :param format: 'jsonl' ({"key": key, "value": value} per line), 'csv' (key,value text columns),
+        'pickle' (stream written by export_to) or None to use the suffix of the path
+        :param chunk: Records applied together
+        :param workers: Processes parsing JSON lines (0: parses in this process)
+        :return: Number of records imported
+        """
+        try:
+            start = time.perf_counter()
+            self._load_for_write()
+            self._index = None                  # built again by the next scan
+            rewrite = isinstance(self.storage, SnapshotStorage)
+            count, fed, changes = 0, [], []
+            with self.storage.bulk():
+                for records in bulk.read_records(source, format, chunk, workers):
+                    if not records:             # e.g. only blank lines
+                        continue
+                    changes = [(SET, key, val) for key, val in records]
+                    self.db.update(records)
+                    count += len(changes)
+                    if not rewrite:
+                        self._persist(changes)
+                        continue
+                    self._add_to_bloom(changes)
+                    if self.feed is not None:   # recorded only once the file is written
+                        fed.extend(changes)
+            if rewrite and count:               # the whole dictionary is written whatever the changes
+                self.storage.persist(self.db, fed or changes)
+                if fed:
+                    self.feed.append(fed)
+            self._await_durable()
+        except Exception as err:
+            self.storage.invalidate()
+            logging.error(f"There was a problem to import records: {err}")
+            raise err
+        elapsed = time.perf_counter() - start
+        logging.info(f"Imported {count} records in {elapsed:.2f} s ({count / elapsed:.0f} records/s)")
+        return count
+
+    def export_to(self, path, format=None, chunk=bulk.CHUNK) -> int:
+        """
+        Writes the key:value pairs (expired keys skipped) to a file streaming them in chunks, in the order of
+        the dictionary. The file is replaced at once when complete
+        :param path: Path of the file
+        :param format: 'jsonl', 'csv' (keys and values written as text), 'pickle' or None to use the suffix
+        :param chunk: Records written together
+        :return: Number of records exported
+        """
+        try:
+            start = time.perf_counter()
+            count = bulk.write_records(path, self._live_items(self.storage.load()), format, chunk)
+        except Exception as err:
+            logging.error(f"There was a problem to export records: {err}")
+            raise err
+        elapsed = time.perf_counter() - start
+        logging.info(f"Exported {count} records in {elapsed:.2f} s ({count / elapsed:.0f} records/s)")
+        return count
+
+    @staticmethod
+    def _live_items(db):
+        """
+        Streams the pairs of a dictionary as readers see them
+        :param db: Dictionary database
+        :return: Generator of (key, value) without expired keys
+        """
+        now = time.time()
+        for key, val in db.items():
+            if not expired(val, now):
+                yield key, live(val, now)
+
+    def _persist(self, changes):
+        """
+        Persists changes already applied to the dictionary, records them in the change feed (if any, a gap
+        that sends followers to a snapshot if that fails) and publishes the sorted index
+        :param changes: List of (operation, key, value)
+        """
+        self._add_to_bloom(changes)         # before the keys can be read
+        self.storage.persist(self.db, changes)
+        if self.feed is not None and changes:
+            try:                            # still holding the writers exclusion of the commit
+                self.feed.append(changes)
+            except Exception as err:        # committed anyway, the feed records a gap in their place
+                logging.error(f"Changes committed to {self.file_name} missed the change feed, followers "
+                              f"will take a snapshot: {err}")
+        self._publish_index()
+
+    def _add_to_bloom(self, changes):
+        """
+        Adds the keys set by changes to the Bloom filter (if any)
+        :param changes: List of (operation, key, value)
+        """
+        bloom = self.bloom
+        if bloom is not None:
+            full = bloom.full
+            for op, key, _ in changes:
+                if op == SET:
+                    bloom.add(key)
+            if bloom.full and not full:
+                self._regrow_bloom()
+
+    def _bloom_stamp(self) -> list:
+        """
+        Size and modification time of the files of the storage, which a saved Bloom filter must match
+        :return: list of (size, mtime_ns)
+        """
+        stamp = []
+        for name in dict.fromkeys([self.file_name, *self.storage._durable_files()]):
+            if os.path.isfile(name):
+                stat = os.stat(name)
+                stamp.append((stat.st_size, stat.st_mtime_ns))
+        return stamp
+
+    def _open_bloom(self, keys=None, fp_rate=0.01, shared=False):
+        """
+        Opens the Bloom filter of the keys: the one saved by close() if the files didn't change since,
+        else one built from the keys in the file, sized for keys or twice the keys there are now
+        :param keys: Number of keys the filter is sized for (None: from the keys in the file)
+        :param fp_rate: Target false positive rate
+        :param shared: If it is shared between processes
+        """
+        bloom = BloomFilter.load(self.bloom_name, self._bloom_stamp(), shared)
+        if bloom is None or bloom.full or bloom.fp_rate != fp_rate or (keys is not None and bloom.capacity < keys):
+            db = self.storage.load()
+            bloom = BloomFilter(max(keys or 2 * len(db), MIN_KEYS), fp_rate, shared)
+            for key in db:
+                bloom.add(key)
+            logging.debug(f"Bloom filter built for {len(db)} keys")
+        self.bloom = bloom
+
+    def _regrow_bloom(self):
+        """
+        Replaces a filter with more keys than its capacity (which has more false positives) with one built
+        from the current keys. A filter shared between processes can't be replaced, it keeps working with
+        more false positives
+        """
+        bloom = self.bloom
+        if bloom.shared:
+            logging.warning(f"Bloom filter of {self.file_name} is over its capacity of {bloom.capacity} keys")
+            return
+        grown = BloomFilter(max(2 * len(self.db), MIN_KEYS), bloom.fp_rate)
+        for key in self.db:
+            grown.add(key)
+        self.bloom = grown
+
+    def _seed_expiry(self):
+        """
+        Pushes to the expiry heap the expiring keys in the file (a file opened lazily tells them without
+        decoding the other values)
+        """
+        db = self.storage.load()
+        self._expiry.seed(db.expiring_items() if isinstance(db, LazyDict) else list(db.items()))
+
+    def _warm(self, keys):
+        """
+        Decodes the values of some keys of a file opened lazily, so their first reads are served from memory
+        :param keys: Iterable of keys
+        """
+        db = self.storage.load()
+        for key in keys:
+            db.get(key)
+
+    def _load_for_write(self):
+        """
+        Loads the database to change it. If the sorted index of the keys is up to date, a snapshot of it
+        is changed along with the database (see DataBase), else it is rebuilt by the next scan
+        """
+        self.db = self.storage.load_for_write()
+        indexed = self._indexed
+        self._index = None
+        if indexed is not None and indexed[0] is not None and indexed[0] == self.storage.version():
+            self._index = indexed[2].snapshot()
+
+    def _publish_index(self):
+        """
+        Publishes the sorted index changed by a write with the version of the database it persisted
+        """
+        if self._index is not None:
+            self._indexed = (self.storage.version(), self.db, self._index)
+            self._index = None
+
+    def _ordered(self):
+        """
+        Current database and a snapshot of the sorted index of its keys. The index is built once and
+        then kept up to date by the writes, it is built again only if the database changed otherwise
+        (e.g. written by another process)
+        :return: (dictionary, KeyIndex)
+        """
+        version, db = self.storage.load_versioned()
+        indexed = self._indexed
+        if indexed is None or version is None or indexed[0] != version:
+            indexed = (version, db, KeyIndex(db))
+            self._indexed = indexed
+        return db, indexed[2].snapshot()
+
+    def _await_durable(self):
+        """
+        Waits until the last change is durable according to the durability policy of the storage
+        """
+        self.storage.wait_durable()
+
     def get_name(self) -> str:
         """
         Gets file name
@@ -94,14 +403,26 @@ class FileDataBase(DataBase):
         """
         return self.file_name
 
+    def close(self):
+        """
+        Releases resources of the storage engine (waits for background work to finish) and saves the Bloom filter
+        and the keys read from a file opened lazily
+        """
+        if self.storage.lazy:
+            db = self.storage.load()
+            if isinstance(db, LazyDict):
+                save_hot_keys(self.hot_name, db.hot_keys())
+        self.storage.close()
+        if self.bloom is not None:
+            self.bloom.save(self.bloom_name, self._bloom_stamp())
+
     def __repr__(self):
         """
         Prints file name and then file dictionary
         :return: string description of the database
         """
         try:
-            with open(self.file_name, "rb") as f:
-                self.db = pickle.load(f)
+            self.db = self.storage.load()
         except Exception as err:
             logging.error(f"There was a problem trying to print database: {err}")
             raise err
@@ -109,17 +430,28 @@ class FileDataBase(DataBase):
 
 
 if __name__ == "__main__":
-    database = FileDataBase('testfile.bin')
-    try:
-        assert database.set_value('1', '2')
-        assert database.set_value(1, '3')
-        assert database.get_value(1) == '3'
-        assert database.delete_value('1') == '2'
-        assert database.get_value('1') is None
-        assert database.delete_value('1') is None
-        assert repr(database) == database.get_name() + ": {1: '3'}"
-    finally:
-        os.remove(database.get_name())
+    for storage_engine in ("snapshot", "log", "hash"):
+        database = FileDataBase('testfile.bin', engine=storage_engine)
+        try:
+            assert database.set_value('1', '2')
+            assert database.set_value(1, '3')
+            assert database.get_value(1) == '3'
+            assert database.delete_value('1') == '2'
+            assert database.get_value('1') is None
+            assert database.delete_value('1') is None
+            assert repr(database) == database.get_name() + ": {1: '3'}"
+            assert database.set_many({2: 'a', 3: 'b'})
+            assert database.delete_many([2, 4]) == {2: 'a', 4: None}
+            assert database.get_many([1, 3]) == {1: '3', 3: 'b'}
+            with database.transaction() as transaction:
+                transaction.delete_value(3)
+            assert database.get_value(3) is None
+            database.close()
+            assert FileDataBase('testfile.bin', engine=storage_engine).get_value(1) == '3'
+        finally:
+            os.remove(database.get_name())
+            if storage_engine == "log":
+                os.remove(database.get_name() + ".log")
     # logging configuration just when running
     log_file = "file_database.log"                                                   # file to save the log
     log_level = logging.DEBUG                                                        # set the minimum logger level
@@ -0,0 +1,373 @@
+"""
+Author: Tomas Dal Farra
+Date: 09/01/2023
+Description: Memory-mapped storage engine with an on-disk hash index and a heap of records
+"""
+from collections.abc import MutableMapping
+from storage import Storage
+import db_codecs
+import hashlib
+import logging
+import struct
+import pickle
+import mmap
+import os
+
+MAGIC = b"SDBH"
+VERSION = 1
+HEADER = struct.Struct(">4sIIQQQQ")         # magic, version, replaced, buckets, count, heap end, garbage bytes
+HEADER_SIZE = 64                            # header area, the bucket table starts after it
+SLOT = struct.Struct(">Q")                  # offset of the newest record of a bucket (0 if empty)
+RECORD = struct.Struct(">QQIIB")            # next record of the bucket, key hash, key length, value length, flags
+TOMBSTONE = 1                               # record flag: the key was deleted
+LOAD_FACTOR = 0.75                          # keys per bucket after which the table doubles
+
+
+def key_hash(key_bytes) -> int:
+    """
+    Stable 64 bit hash of a serialized key (python hash() changes between runs)
+    :param key_bytes: Serialized key
+    :return: hash of the key
+    """
+    return int.from_bytes(hashlib.blake2b(key_bytes, digest_size=8).digest(), "big")
+
+
+class HashIndexMap(MutableMapping):
+    """
+    Dictionary stored in a memory-mapped file.
+    The file has a header, a table of buckets and a heap of records. Each bucket points to the newest
+    record of a chain of records with keys of that bucket. Setting or deleting appends a record to the heap
+    and points the bucket to it, so a change writes a few pages in place and a lookup touches only the
+    bucket and its chain. Replaced records are garbage until the table is rebuilt, which happens when
+    it grows past LOAD_FACTOR or garbage is more than half of the heap
+    """
+    def __init__(self, file_name):
+        """
+        Maps an existing hash file
+        :param file_name: Name of the hash file
+        """
+        self.file_name = file_name
+        self._fd = os.open(file_name, os.O_RDWR)
+        self._mm = mmap.mmap(self._fd, 0)
+        magic, version, _, self._buckets, _, _, _ = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{file_name} is not a hash database file")
+        self._heap_start = HEADER_SIZE + self._buckets * SLOT.size
+
+    @staticmethod
+    def create(file_name, items=(), buckets=1024):
+        """
+        Writes a new hash file
+        :param file_name: Name of the hash file
+        :param items: Iterable of (key, value) pairs to store in it
+        :param buckets: Initial number of buckets (power of two)
+        """
+        heap_start = HEADER_SIZE + buckets * SLOT.size
+        with open(file_name, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, 0, buckets, 0, heap_start, 0).ljust(HEADER_SIZE, b"\0"))
+            f.truncate(heap_start + (1 << 16))
+        table = HashIndexMap(file_name)
+        try:
+            for key, val in items:
+                table[key] = val
+        finally:
+            table.close()
+
+    def _header(self):
+        """
+        Reads the header
+        :return: (replaced, buckets, count, heap end, garbage)
+        """
+        return HEADER.unpack_from(self._mm, 0)[2:]
+
+    def _set_header(self, count, heap_end, garbage):
+        """
+        Writes the counters of the header
+        """
+        struct.pack_into(">QQQ", self._mm, 20, count, heap_end, garbage)
+
+    def heap_end(self) -> int:
+        """
+        End of the heap of records
+        :return: offset in the file
+        """
+        return self._header()[3]
+
+    def refresh(self) -> bool:
+        """
+        Catches up with changes of other processes: remaps if the file grew
+        :return: False if the file was replaced by a rebuild and must be opened again
+        """
+        replaced, _, _, heap_end, _ = self._header()
+        if replaced:
+            return False
+        if heap_end > len(self._mm):
+            self._mm.close()
+            self._mm = mmap.mmap(self._fd, 0)
+        return True
+
+    def _find(self, key_bytes, h):
+        """
+        Finds the newest record of a key
+        :param key_bytes: Serialized key
+        :param h: Hash of the key
+        :return: (offset, record header) or (0, None) if the key has no record
+        """
+        mm = self._mm
+        offset = SLOT.unpack_from(mm, HEADER_SIZE + (h & (self._buckets - 1)) * SLOT.size)[0]
+        while offset:
+            record = RECORD.unpack_from(mm, offset)
+            if record[1] == h and record[2] == len(key_bytes):
+                start = offset + RECORD.size
+                if mm[start:start + record[2]] == key_bytes:
+                    return offset, record
+            offset = record[0]
+        return 0, None
+
+    def _append(self, key_bytes, h, val_bytes, flags):
+        """
+        Appends a record at the end of the heap and makes it the newest of its bucket
+        :return: Size of the appended record
+        """
+        _, _, count, heap_end, garbage = self._header()
+        size = RECORD.size + len(key_bytes) + len(val_bytes)
+        if heap_end + size > len(self._mm):                  # doubles the file
+            os.ftruncate(self._fd, max(2 * len(self._mm), heap_end + size))
+            self._mm.close()
+            self._mm = mmap.mmap(self._fd, 0)
+        slot = HEADER_SIZE + (h & (self._buckets - 1)) * SLOT.size
+        head = SLOT.unpack_from(self._mm, slot)[0]
+        RECORD.pack_into(self._mm, heap_end, head, h, len(key_bytes), len(val_bytes), flags)
+        start = heap_end + RECORD.size
+        self._mm[start:start + len(key_bytes)] = key_bytes
+        self._mm[start + len(key_bytes):start + size - RECORD.size] = val_bytes
+        self._set_header(count, heap_end + size, garbage)   # record is complete before the bucket points to it
+        SLOT.pack_into(self._mm, slot, heap_end)
+        return size
+
+    def __getitem__(self, key):
+        key_bytes = pickle.dumps(key)
+        offset, record = self._find(key_bytes, key_hash(key_bytes))
+        if record is None or record[4] & TOMBSTONE:
+            raise KeyError(key)
+        start = offset + RECORD.size + record[2]
+        return pickle.loads(self._mm[start:start + record[3]])
+
+    def _set(self, key_bytes, val_bytes):
+        """
+        Writes a serialized key and value
+        """
+        h = key_hash(key_bytes)
+        _, old = self._find(key_bytes, h)
+        self._append(key_bytes, h, val_bytes, 0)
+        _, _, count, heap_end, garbage = self._header()
+        if old is None or old[4] & TOMBSTONE:
+            count += 1
+        else:
+            garbage += RECORD.size + old[2] + old[3]
+        self._set_header(count, heap_end, garbage)
+        self._maybe_rebuild()
+
+    def _delete(self, key_bytes) -> bool:
+        """
+        Deletes a serialized key
+        :return: False if the key didn't exist
+        """
+        h = key_hash(key_bytes)
+        _, old = self._find(key_bytes, h)
+        if old is None or old[4] & TOMBSTONE:
+            return False
+        size = self._append(key_bytes, h, b"", TOMBSTONE)
+        _, _, count, heap_end, garbage = self._header()
+        self._set_header(count - 1, heap_end, garbage + size + RECORD.size + old[2] + old[3])
+        self._maybe_rebuild()
+        return True
+
+    def __setitem__(self, key, val):
+        self._set(pickle.dumps(key), pickle.dumps(val))
+
+    def __delitem__(self, key):
+        if not self._delete(pickle.dumps(key)):
+            raise KeyError(key)
+
+    def write_many(self, items, deleted=()):
+        """
+        Sets and deletes several keys, serializing all of them before writing any: the file is changed in place,
+        so a key or value that can't be serialized must fail before the first record is written
+        :param items: Iterable of (key, value) pairs to set
+        :param deleted: Keys to delete (those that don't exist are ignored)
+        """
+        records = [(pickle.dumps(key), pickle.dumps(val)) for key, val in items]
+        deleted = [pickle.dumps(key) for key in deleted]
+        for key_bytes, val_bytes in records:
+            self._set(key_bytes, val_bytes)
+        for key_bytes in deleted:
+            self._delete(key_bytes)
+
+    def update(self, other=(), **kwds):
+        """
+        Sets several keys at once (see write_many)
+        """
+        self.write_many(dict(other, **kwds).items())
+
+    def __contains__(self, key):
+        key_bytes = pickle.dumps(key)
+        _, record = self._find(key_bytes, key_hash(key_bytes))
+        return record is not None and not record[4] & TOMBSTONE
+
+    def _records(self):
+        """
+        Walks the newest live record of every key
+        :return: Generator of (offset, record header)
+        """
+        mm = self._mm
+        for bucket in range(self._buckets):
+            offset = SLOT.unpack_from(mm, HEADER_SIZE + bucket * SLOT.size)[0]
+            seen = set()
+            while offset:
+                record = RECORD.unpack_from(mm, offset)
+                start = offset + RECORD.size
+                key_bytes = mm[start:start + record[2]]
+                if key_bytes not in seen:
+                    seen.add(key_bytes)
+                    if not record[4] & TOMBSTONE:
+                        yield offset, record
+                offset = record[0]
+
+    def __iter__(self):
+        for offset, record in self._records():
+            start = offset + RECORD.size
+            yield pickle.loads(self._mm[start:start + record[2]])
+
+    def items(self):
+        """
+        Key:value pairs reading each record once
+        :return: Generator of (key, value)
+        """
+        for offset, record in self._records():
+            start = offset + RECORD.size
+            key_end = start + record[2]
+            yield pickle.loads(self._mm[start:key_end]), pickle.loads(self._mm[key_end:key_end + record[3]])
+
+    def __len__(self):
+        return self._header()[2]
+
+    def __repr__(self):
+        return str(dict(self.items()))
+
+    def _maybe_rebuild(self):
+        """
+        Rebuilds the file when the table is too full or the heap has too much garbage
+        """
+        _, buckets, count, heap_end, garbage = self._header()
+        if count > buckets * LOAD_FACTOR:
+            self.rebuild(buckets * 2)
+        elif garbage > (1 << 20) and garbage * 2 > heap_end - self._heap_start:
+            self.rebuild(buckets)
+
+    def rebuild(self, buckets):
+        """
+        Writes live records to a new file and replaces this one with it.
+        The old file is marked as replaced so other processes reopen it
+        :param buckets: Number of buckets of the new file
+        """
+        temp_name = f"{self.file_name}.{os.getpid()}.rebuild"
+        HashIndexMap.create(temp_name, self.items(), buckets)
+        os.replace(temp_name, self.file_name)
+        struct.pack_into(">I", self._mm, 8, 1)              # replaced flag
+        self.close()
+        self.__init__(self.file_name)
+        logging.debug(f"Hash file rebuilt with {buckets} buckets")
+
+    def flush(self):
+        """
+        Writes changed pages to disk
+        """
+        self._mm.flush()
+
+    def close(self):
+        """
+        Unmaps and closes the file
+        """
+        if not self._mm.closed:
+            self._mm.close()
+        os.close(self._fd)
+
+
+class HashStorage(Storage):
+    """
+    Storage engine keeping the database in a HashIndexMap: opening maps the file without reading it,
+    a point lookup reads only the pages it needs and a change is written in place.
+    An existing dictionary file (of any codec) is converted when opened
+    """
+    def __init__(self, file_name, buckets=1024, **durability):
+        """
+        Initializer for the hash storage
+        :param file_name: Name of file for the database
+        :param buckets: Initial number of buckets (rounded up to a power of two)
+        :param durability: Durability options (see Storage)
+        """
+        super().__init__(file_name, **durability)
+        self.buckets = 1 << max(buckets - 1, 0).bit_length()
+        self._map = None
+
+    def open(self) -> HashIndexMap:
+        """
+        Maps the database file creating or converting it if needed
+        :return: Dictionary-like database
+        """
+        try:
+            with open(self.file_name, 'rb') as f:
+                magic = f.read(len(MAGIC))
+        except FileNotFoundError:
+            magic = b""
+        if magic != MAGIC:
+            db = {}
+            if magic:
+                with open(self.file_name, 'rb') as f:
+                    db = db_codecs.load(f)
+                logging.debug(f"Converting dictionary {self.file_name} to a hash file")
+            buckets = self.buckets
+            while len(db) > buckets * LOAD_FACTOR:              # sized so converting never rebuilds
+                buckets *= 2
+            temp_name = f"{self.file_name}.{os.getpid()}.rebuild"
+            HashIndexMap.create(temp_name, db.items(), buckets)
+            os.replace(temp_name, self.file_name)
+        self._map = HashIndexMap(self.file_name)
+        return self._map
+
+    def load(self) -> HashIndexMap:
+        """
+        Returns the mapped database after catching up with changes of other processes
+        :return: Dictionary-like database
+        """
+        if self._map is None or not self._map.refresh():
+            if self._map is not None:
+                self._map.close()
+            self._map = HashIndexMap(self.file_name)
+        return self._map
+
+    def persist(self, db, changes):
+        """
+        Changes are already written in place in the mapped file, only the durability policy is applied
+        (fsync of the file also writes its dirty mapped pages)
+        :param db: Dictionary with the changes already applied
+        :param changes: List of (operation, key, value) applied to db
+        """
+        if changes:
+            self._committed()
+
+    def version(self):
+        """
+        Mapped table and the end of its heap, which grows with every change of any process
+        :return: Hashable version or None if nothing is mapped
+        """
+        table = self._map
+        return (id(table), table.heap_end()) if table is not None else None
+
+    def close(self):
+        """ Unmaps the database file """
+        if self._map is not None:
+            self._map.close()
+            self._map = None
@@ -0,0 +1,506 @@
+"""
+Author: Tomas Dal Farra
+Date: 10/02/2023
+Description: Dictionary file with a key directory, opened without reading it and decoding each key and value on first access
+"""
+from collections.abc import MutableMapping
+from bloom_filter import canonical
+from expiry import Expiring
+from operator import itemgetter
+from itertools import islice, accumulate
+from bisect import bisect_left
+from array import array
+import argparse
+import tempfile
+import hashlib
+import logging
+import struct
+import pickle
+import mmap
+import time
+import sys
+import os
+
+# Layout: header (number of keys, length of the extras), the pickled extras ({index: deadline} of the expiring
+# values and {key: index} of keys without a canonical form), padding to 8 bytes, three arrays of 64 bit little
+# endian integers (hashes of the keys in ascending order, offsets of the keys and offsets of the values, both
+# with a last one for the end), the keys and the values. Keys and values are pickled one by one without the
+# protocol and first frame opcodes, which loading a single one doesn't need
+HEADER = struct.Struct(">QQ")
+HOT_KEYS = 1 << 16              # keys recorded as hot at most
+WARM_BATCH = 1000               # hot keys decoded together by a warm-up
+_MISSING = object()
+_NATIVE = sys.byteorder == "little"         # arrays are read in place, else copied and swapped
+
+
+def _dumps(obj):
+    """
+    Pickles a key or value without its protocol and first frame opcodes (11 bytes of most small values)
+    :param obj: Key or value
+    :return: bytes of the pickle
+    """
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    return data[11 if data[2] == pickle.FRAME[0] else 2:]
+
+
+def key_hash(key):
+    """
+    Stable 64 bit hash of a key, equal for keys that are equal in a dictionary
+    :param key: Key for the database
+    :return: (hash, None) or (hash of its pickle, key) for keys without a canonical form (see bloom_filter)
+    """
+    data = canonical(key)
+    other = data is None
+    if other:
+        data = pickle.dumps(key, protocol=pickle.HIGHEST_PROTOCOL)
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little"), other
+
+
+def _array(data, pos, count):
+    """
+    Array of 64 bit integers of an encoding
+    :param data: Memoryview of the encoding
+    :param pos: Where the array starts
+    :param count: Number of integers
+    :return: Sequence of ints (a view of data if the machine is little endian)
+    """
+    view = data[pos:pos + count * 8]
+    if _NATIVE:
+        return view.cast('Q')
+    numbers = array('Q', view)
+    numbers.byteswap()
+    return numbers
+
+
+def _chunks(count, deadlines, others, hash_chunks, key_offsets, value_offsets, key_chunks, value_chunks) -> list:
+    """
+    Chunks of an encoding
+    :param count: Number of keys
+    :param deadlines: {position: deadline} of the expiring values
+    :param others: {key: position} of the keys without a canonical form
+    :param hash_chunks: Chunks of the hashes of the keys (little endian) in ascending order
+    :param key_offsets: array of the offsets of the keys
+    :param value_offsets: array of the offsets of the values
+    :param key_chunks: Chunks of the keys
+    :param value_chunks: Chunks of the values
+    :return: list of byte chunks
+    """
+    extras = pickle.dumps((deadlines, others), protocol=pickle.HIGHEST_PROTOCOL)
+    if not _NATIVE:
+        key_offsets.byteswap()
+        value_offsets.byteswap()
+    padding = bytes(-(HEADER.size + len(extras)) % 8)
+    return [HEADER.pack(count, len(extras)), extras, padding, *hash_chunks, key_offsets.tobytes(),
+            value_offsets.tobytes(), *key_chunks, *value_chunks]
+
+
+def encode(db) -> list:
+    """
+    Encodes a dictionary with its key directory. The keys and values a LazyDict didn't change are copied
+    as they are, without decoding them
+    :param db: Dictionary or LazyDict
+    :return: list of byte chunks
+    """
+    if isinstance(db, LazyDict):
+        return db.encoded()
+    entries = []
+    for key, val in db.items():
+        h, other = key_hash(key)
+        entries.append((h, _dumps(key), _dumps(val), val.deadline if type(val) is Expiring else None,
+                        key if other else _MISSING))
+    entries.sort(key=itemgetter(0))
+    deadlines, others = {}, {}
+    for i, (_, _, _, deadline, other) in enumerate(entries):
+        if deadline is not None:
+            deadlines[i] = deadline
+        if other is not _MISSING:
+            others[other] = i
+    hashes = array('Q', [entry[0] for entry in entries])
+    if not _NATIVE:
+        hashes.byteswap()
+    return _chunks(len(entries), deadlines, others, [hashes.tobytes()],
+                   array('Q', accumulate((len(entry[1]) for entry in entries), initial=0)),
+                   array('Q', accumulate((len(entry[2]) for entry in entries), initial=0)),
+                   [entry[1] for entry in entries], [entry[2] for entry in entries])
+
+
+def decode(data) -> dict:
+    """
+    Decodes a whole dictionary encoded by encode()
+    :param data: Bytes (or memoryview) of the encoding
+    :return: Dictionary
+    """
+    db = LazyDict(data)
+    return dict(db.items())
+
+
+class LazyDict(MutableMapping):
+    """
+    Dictionary over an encoding with a key directory (usually a memory-mapped file). Creating it reads only
+    a header: a key is found by a binary search of its hash in the directory, and its value is decoded (and
+    kept) the first time it is read. Iteration follows the directory (the order of the hashes of the keys).
+    Changes are kept apart from the encoding, so copy() is cheap and a copy can be changed while the original
+    is read by others (like a snapshot dictionary that is copied on write)
+    """
+    def __init__(self, data, start=0):
+        """
+        Reads the header of an encoding
+        :param data: Encoding (bytes, memoryview or mmap) that must not change while the dictionary is used
+        :param start: Where the encoding starts in data
+        """
+        data = memoryview(data)[start:]
+        count, length = HEADER.unpack_from(data, 0)
+        self._deadlines, self._others = pickle.loads(data[HEADER.size:HEADER.size + length])
+        pos = HEADER.size + length + (-(HEADER.size + length) % 8)
+        self.directory_size = HEADER.size + length
+        self._data = data
+        self._count = count
+        self._hashes = _array(data, pos, count)
+        self._key_offsets = _array(data, pos + count * 8, count + 1)
+        self._value_offsets = _array(data, pos + (2 * count + 1) * 8, count + 1)
+        self._keys_start = pos + (3 * count + 2) * 8
+        self._values_start = self._keys_start + self._key_offsets[count]
+        self._decoded = {}              # values decoded from the encoding, shared with copies
+        self._changed = {}              # key: value set since it was read
+        self._deleted = set()           # keys of the encoding deleted since it was read
+        self._added = set()             # keys set since it was read that aren't in the encoding
+
+    def _key(self, i):
+        """
+        Decodes the key at a position of the directory
+        :param i: Position
+        :return: Key
+        """
+        offsets, start = self._key_offsets, self._keys_start
+        return pickle.loads(self._data[start + offsets[i]:start + offsets[i + 1]])
+
+    def _value(self, i):
+        """
+        Decodes the value at a position of the directory
+        :param i: Position
+        :return: Value
+        """
+        offsets, start = self._value_offsets, self._values_start
+        return pickle.loads(self._data[start + offsets[i]:start + offsets[i + 1]])
+
+    def _find(self, key) -> int:
+        """
+        Position of a key in the directory
+        :param key: Key for the database
+        :return: position or -1 if it isn't in the encoding
+        """
+        h, other = key_hash(key)
+        if other:
+            return self._others.get(key, -1)
+        hashes, count = self._hashes, self._count
+        i = bisect_left(hashes, h)
+        while i < count and hashes[i] == h:
+            if self._key(i) == key:
+                return i
+            i += 1
+        return -1
+
+    def get(self, key, default=None):
+        val = self._changed.get(key, _MISSING)
+        if val is not _MISSING:
+            return val
+        if key in self._deleted:
+            return default
+        val = self._decoded.get(key, _MISSING)
+        if val is _MISSING:
+            i = self._find(key)
+            if i < 0:
+                return default
+            val = self._decoded[key] = self._value(i)
+        return val
+
+    def __getitem__(self, key):
+        val = self.get(key, _MISSING)
+        if val is _MISSING:
+            raise KeyError(key)
+        return val
+
+    def __setitem__(self, key, val):
+        if key not in self._changed and key not in self._deleted and self._find(key) < 0:
+            self._added.add(key)
+        self._changed[key] = val
+        self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        if self._changed.pop(key, _MISSING) is not _MISSING and key in self._added:
+            self._added.discard(key)
+        elif key in self._deleted or (key not in self._decoded and self._find(key) < 0):
+            raise KeyError(key)
+        else:
+            self._deleted.add(key)
+
+    def __contains__(self, key):
+        return key in self._changed or (key not in self._deleted and (key in self._decoded or self._find(key) >= 0))
+
+    def _directory_keys(self):
+        """
+        Keys of the encoding with their positions
+        :return: Generator of (position, key)
+        """
+        loads, data = pickle.loads, self._data
+        offsets, start = self._key_offsets, self._keys_start
+        for i in range(self._count):
+            yield i, loads(data[start + offsets[i]:start + offsets[i + 1]])
+
+    def __iter__(self):
+        deleted = self._deleted
+        for _, key in self._directory_keys():
+            if key not in deleted:
+                yield key
+        yield from list(self._added)
+
+    def __len__(self):
+        return self._count - len(self._deleted) + len(self._added)
+
+    def items(self):
+        """
+        Key:value pairs, decoding the values not read yet without keeping them
+        :return: Generator of (key, value)
+        """
+        changed, decoded, deleted = self._changed, self._decoded, self._deleted
+        for i, key in self._directory_keys():
+            if key in deleted:
+                continue
+            val = changed.get(key, _MISSING)
+            if val is _MISSING:
+                val = decoded.get(key, _MISSING)
+                if val is _MISSING:
+                    val = self._value(i)
+            yield key, val
+        for key in list(self._added):
+            yield key, changed[key]
+
+    def _runs(self, touched, entries):
+        """
+        Runs of unchanged positions of the encoding, in order, with the changed entries between them
+        :param touched: Sorted list of positions changed or deleted
+        :param entries: Changed entries sorted by hash
+        :return: Generator of (first, end) ranges of positions or entries
+        """
+        hashes = self._hashes
+        pos = 0
+        for entry in [*entries, None]:
+            end = self._count if entry is None else bisect_left(hashes, entry[0], pos)
+            first = bisect_left(touched, pos)
+            for i in touched[first:bisect_left(touched, end, first)]:
+                if i > pos:
+                    yield pos, i
+                pos = i + 1
+            if end > pos:
+                yield pos, end
+            pos = max(pos, end)
+            if entry is not None:
+                yield entry
+
+    def encoded(self) -> list:
+        """
+        Encodes the dictionary with its changes: runs of keys and values that didn't change are copied
+        from the encoding as they are (see encode)
+        :return: list of byte chunks
+        """
+        changed, added, deadlines = self._changed, self._added, self._deadlines
+        others = {i: key for key, i in self._others.items()}
+        touched = {self._find(key) for key in self._deleted}     # keys of the encoding, so never -1
+        entries = []
+        for key, val in changed.items():
+            i = -1 if key in added else self._find(key)
+            if i >= 0:
+                touched.add(i)
+                h, other = self._hashes[i], i in others
+            else:
+                h, other = key_hash(key)
+            entries.append((h, _dumps(key), _dumps(val), val.deadline if type(val) is Expiring else None,
+                            key if other else _MISSING))
+        entries.sort(key=itemgetter(0))
+        data = self._data
+        hash_start = self._keys_start - (3 * self._count + 2) * 8
+        key_offsets, keys_start = self._key_offsets, self._keys_start
+        value_offsets, values_start = self._value_offsets, self._values_start
+        hash_chunks, key_chunks, value_chunks = [], [], []
+        new_key_offsets, new_value_offsets = array('Q'), array('Q')
+        new_deadlines, new_others = {}, {}
+        key_end = value_end = count = 0
+        moved = []                      # (first, end, new position of first) of the runs copied
+        for run in self._runs(sorted(touched), entries):
+            if len(run) == 2:
+                first, end = run
+                hash_chunks.append(data[hash_start + first * 8:hash_start + end * 8])
+                key_chunks.append(data[keys_start + key_offsets[first]:keys_start + key_offsets[end]])
+                value_chunks.append(data[values_start + value_offsets[first]:values_start + value_offsets[end]])
+                new_key_offsets.extend(map((key_end - key_offsets[first]).__add__, key_offsets[first:end]))
+                new_value_offsets.extend(map((value_end - value_offsets[first]).__add__, value_offsets[first:end]))
+                key_end += key_offsets[end] - key_offsets[first]
+                value_end += value_offsets[end] - value_offsets[first]
+                moved.append((first, end, count))
+                count += end - first
+                continue
+            h, key_data, value_data, deadline, other = run
+            hash_chunks.append(h.to_bytes(8, "little"))
+            key_chunks.append(key_data)
+            value_chunks.append(value_data)
+            new_key_offsets.append(key_end)
+            new_value_offsets.append(value_end)
+            key_end += len(key_data)
+            value_end += len(value_data)
+            if deadline is not None:
+                new_deadlines[count] = deadline
+            if other is not _MISSING:
+                new_others[other] = count
+            count += 1
+        starts = [first for first, _, _ in moved]
+        for i, key in [*((i, _MISSING) for i in deadlines), *others.items()]:   # None is a key too
+            run = bisect_left(starts, i + 1) - 1
+            if run >= 0 and i < moved[run][1]:
+                new_i = i - moved[run][0] + moved[run][2]
+                if key is _MISSING:
+                    new_deadlines[new_i] = deadlines[i]
+                else:
+                    new_others[key] = new_i
+        new_key_offsets.append(key_end)
+        new_value_offsets.append(value_end)
+        return _chunks(count, new_deadlines, new_others, hash_chunks, new_key_offsets, new_value_offsets,
+                       key_chunks, value_chunks)
+
+    def expiring_items(self) -> list:
+        """
+        Pairs with expiring values, found by the directory without decoding the others
+        :return: list of (key, Expiring value)
+        """
+        changed, deleted = self._changed, self._deleted
+        items = []
+        for i in self._deadlines:
+            key = self._key(i)
+            if key not in changed and key not in deleted:
+                items.append((key, self._value(i)))
+        items.extend((key, val) for key, val in changed.items() if type(val) is Expiring)
+        return items
+
+    def hot_keys(self, limit=HOT_KEYS) -> list:
+        """
+        Keys whose values were decoded (read since opening), in the order they were first read
+        :param limit: Maximum number of keys
+        :return: list of keys
+        """
+        deleted, changed = self._deleted, self._changed
+        return list(islice((key for key in list(self._decoded) if key not in deleted and key not in changed), limit))
+
+    def copy(self):
+        """
+        Copy sharing the encoding and the decoded values, with its own changes
+        :return: LazyDict
+        """
+        other = LazyDict.__new__(LazyDict)
+        other.__dict__.update(self.__dict__)
+        other._changed = dict(self._changed)
+        other._deleted = set(self._deleted)
+        other._added = set(self._added)
+        return other
+
+    def adopt(self, other):
+        """
+        Keeps the values another LazyDict already has, once this one was read from its encoding
+        :param other: LazyDict with the same content
+        """
+        decoded, changed, deleted = self._decoded, other._changed, other._deleted
+        decoded.update((key, val) for key, val in list(other._decoded.items())
+                       if key not in changed and key not in deleted)
+        decoded.update(changed)
+
+    def __repr__(self):
+        return str(dict(self.items()))
+
+
+def open_file(file_name, start=0) -> LazyDict:
+    """
+    Maps a file and reads the header of its key directory
+    :param file_name: File with an encoding
+    :param start: Where the encoding starts in the file
+    :return: LazyDict
+    """
+    with open(file_name, 'rb') as f:
+        return LazyDict(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), start)
+
+
+def save_hot_keys(file_name, keys):
+    """
+    Records the keys read by a process, replacing the file at once
+    :param file_name: Hot keys file
+    :param keys: List of keys
+    """
+    temp_name = f"{file_name}.{os.getpid()}.tmp"
+    with open(temp_name, 'wb') as f:
+        pickle.dump(keys, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_name, file_name)
+
+
+def load_hot_keys(file_name) -> list:
+    """
+    Reads the keys recorded by save_hot_keys
+    :param file_name: Hot keys file
+    :return: list of keys (empty if there are none)
+    """
+    try:
+        with open(file_name, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return []
+    except (OSError, pickle.UnpicklingError, EOFError) as err:
+        logging.warning(f"Ignoring hot keys file {file_name}: {err}")
+        return []
+
+
+def _startup(file_name, engine, lazy, queue):
+    """
+    Opens a database in a new process and measures the time until its first read and its memory
+    :param file_name: Database file
+    :param engine: Storage engine
+    :param lazy: If it is opened lazily
+    :param queue: Queue where to put (seconds, resident MiB)
+    """
+    from file_database import FileDataBase
+    start = time.perf_counter()
+    database = FileDataBase(file_name, engine, lazy=lazy)
+    database.get_value("key7")
+    elapsed = time.perf_counter() - start
+    with open("/proc/self/statm") as f:
+        resident = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+    database.close()
+    queue.put((elapsed, resident))
+
+
+def main():
+    """
+    Measures time to the first read and resident memory opening eagerly and lazily:
+    python lazy_dict.py --keys 1000000 --value-size 200
+    """
+    import multiprocessing
+    from file_database import FileDataBase
+    parser = argparse.ArgumentParser(description="Compares eager and lazy opening of a database file")
+    parser.add_argument("--keys", type=int, default=1000000, help="number of keys")
+    parser.add_argument("--value-size", type=int, default=200, help="characters of each value")
+    parser.add_argument("--engine", default="snapshot", choices=["snapshot", "log"], help="storage engine")
+    args = parser.parse_args()
+    context = multiprocessing.get_context("spawn")          # a new interpreter, so its memory is only the database
+    with tempfile.TemporaryDirectory() as directory:
+        for lazy in (False, True):
+            file_name = os.path.join(directory, f"{'lazy' if lazy else 'eager'}.bin")
+            database = FileDataBase(file_name, args.engine, lazy=lazy)
+            database.import_from(((f"key{n}", str(n).ljust(args.value_size, "v")) for n in range(args.keys)),
+                                 "pickle")
+            database.close()
+            queue = context.Queue()
+            process = context.Process(target=_startup, args=(file_name, args.engine, lazy, queue))
+            process.start()
+            elapsed, resident = queue.get()
+            process.join()
+            print(f"{'lazy' if lazy else 'eager':5} {os.path.getsize(file_name) / (1 << 20):8.1f} MiB file   "
+                  f"first read {elapsed * 1000:9.1f} ms   resident {resident:8.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
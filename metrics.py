@@ -0,0 +1,130 @@
+"""
+Author: Tomas Dal Farra
+Date: 28/01/2023
+Description: Low-overhead counters and latency histograms shared between threads or processes
+"""
+import multiprocessing
+import threading
+
+# latency histograms: operations, readers-writer lock waiting vs holding and decoding/encoding the database
+HISTOGRAMS = ("get", "set", "delete", "update", "read_wait", "read_hold", "write_wait", "write_hold", "decode", "encode")
+COUNTERS = ("decode_bytes", "encode_bytes", "bloom_skips")      # bloom_skips: misses answered by the filter
+BUCKETS = 40                # bucket b counts latencies below 2^b ns (the last one also the longer ones)
+LAST_BUCKET = BUCKETS - 1
+HISTOGRAM_SIZE = 2 + BUCKETS                                # count, total ns and buckets
+
+
+class Metrics:
+    """
+    Latency histograms with power of two buckets and byte counters in one flat array.
+    For processes the array lives in shared memory, so any process sees the numbers of all of them
+    """
+    def __init__(self, shared=False):
+        """
+        Initializer for the metrics
+        :param shared: If the numbers are shared between processes (forked after creating it)
+        """
+        size = len(HISTOGRAMS) * HISTOGRAM_SIZE + len(COUNTERS)
+        if shared:
+            self._lock = multiprocessing.Lock()
+            self._values = multiprocessing.RawArray('Q', size)
+        else:
+            self._lock = threading.Lock()
+            self._values = [0] * size
+        self._offsets = {name: i * HISTOGRAM_SIZE for i, name in enumerate(HISTOGRAMS)}
+        self._offsets.update({name: len(HISTOGRAMS) * HISTOGRAM_SIZE + i for i, name in enumerate(COUNTERS)})
+        # offsets of the histograms of each operation and lock kind, to record them without building names
+        self._locked_offsets = {(name, kind): (self._offsets[name], self._offsets[kind + "_wait"],
+                                               self._offsets[kind + "_hold"])
+                                for name in ("get", "set", "delete", "update") for kind in ("read", "write")}
+
+    def observe(self, name, ns):
+        """
+        Records a latency
+        :param name: One of HISTOGRAMS
+        :param ns: Latency in nanoseconds
+        """
+        offset = self._offsets[name]
+        values = self._values
+        with self._lock:
+            values[offset] += 1
+            values[offset + 1] += ns
+            values[offset + 2 + min(ns.bit_length(), LAST_BUCKET)] += 1
+
+    def observe_locked(self, name, kind, start, acquired, released, end):
+        """
+        Records an operation made holding the readers-writer lock taking the metrics lock once:
+        its latency, the time waiting for the lock and the time holding it
+        :param name: Histogram of the operation ('get', 'set', 'delete' or 'update')
+        :param kind: 'read' or 'write' lock
+        :param start: perf_counter_ns() when the operation started
+        :param acquired: perf_counter_ns() when the lock was acquired
+        :param released: perf_counter_ns() when the lock was about to be released
+        :param end: perf_counter_ns() when the operation finished
+        """
+        op, wait, hold = self._locked_offsets[name, kind]
+        op_ns, wait_ns, hold_ns = end - start, acquired - start, released - acquired
+        values = self._values
+        with self._lock:
+            values[op] += 1
+            values[op + 1] += op_ns
+            values[op + 2 + min(op_ns.bit_length(), LAST_BUCKET)] += 1
+            values[wait] += 1
+            values[wait + 1] += wait_ns
+            values[wait + 2 + min(wait_ns.bit_length(), LAST_BUCKET)] += 1
+            values[hold] += 1
+            values[hold + 1] += hold_ns
+            values[hold + 2 + min(hold_ns.bit_length(), LAST_BUCKET)] += 1
+
+    def add(self, name, amount):
+        """
+        Increases a counter
+        :param name: One of COUNTERS
+        :param amount: Amount to add
+        """
+        with self._lock:
+            self._values[self._offsets[name]] += amount
+
+    @staticmethod
+    def _percentile(buckets, count, fraction) -> float:
+        """
+        Upper bound of the bucket where a percentile falls
+        :param buckets: Counts of each bucket
+        :param count: Total count
+        :param fraction: Percentile between 0 and 1
+        :return: latency in microseconds
+        """
+        rank = fraction * count
+        seen = 0
+        for bucket, bucket_count in enumerate(buckets):
+            seen += bucket_count
+            if seen >= rank:
+                return (1 << bucket) / 1000
+        return (1 << (len(buckets) - 1)) / 1000
+
+    def stats(self) -> dict:
+        """
+        Current numbers. Percentiles are the upper bound of their power of two bucket
+        :return: Dictionary with count, total_ms, mean_us, p50_us and p99_us of every histogram and the counters
+        """
+        with self._lock:
+            values = list(self._values)
+        stats = {}
+        for name in HISTOGRAMS:
+            offset = self._offsets[name]
+            count, total = values[offset], values[offset + 1]
+            buckets = values[offset + 2:offset + HISTOGRAM_SIZE]
+            stats[name] = {"count": count, "total_ms": total / 1e6, "mean_us": total / count / 1000 if count else 0.0,
+                           "p50_us": self._percentile(buckets, count, 0.5) if count else 0.0,
+                           "p99_us": self._percentile(buckets, count, 0.99) if count else 0.0}
+        for name in COUNTERS:
+            stats[name] = values[self._offsets[name]]
+        return stats
+
+    def reset(self):
+        """
+        Sets every number to zero
+        """
+        with self._lock:
+            for i in range(len(self._values)):
+                self._values[i] = 0
@@ -0,0 +1,241 @@
+"""
+Author: Tomas Dal Farra
+Date: 04/02/2023
+Description: Follower keeping a copy of the database of a server up to date from its change feed
+"""
+from sync_database import SyncDataBase
+from db_server import pack_frame, read_frame, SNAPSHOT, SUBSCRIBE, OK, TRUNCATED
+from db_client import connect
+from dict_database import BATCH
+from storage import SET
+import threading
+import argparse
+import logging
+import socket
+import time
+import os
+
+
+class Follower:
+    """
+    Copy of the database of a DataBaseServer with a change feed (--feed), kept in its own file.
+    A new follower takes a full snapshot and then applies the changes committed after it, in order and
+    in one transaction per answer of the server. The last sequence number applied is kept in
+    '<file_name>.seq', so after a disconnect or a restart it resumes from there (changes applied again
+    after a crash leave the same result). If the feed no longer has the changes it needs it takes a
+    snapshot again. Reads are served by follower.database
+    """
+    def __init__(self, address, file_name="replica.bin", engine="snapshot", batch=BATCH, retry=0.5, **options):
+        """
+        Initializer for the follower
+        :param address: Path of a Unix-domain socket or (host, port) for TCP of the primary server
+        :param file_name: Name of file for the copy of the database
+        :param engine: Storage engine of the copy (see FileDataBase)
+        :param batch: Maximum changes applied in one transaction
+        :param retry: Seconds to wait before connecting again after a failure
+        :param options: Options for SyncDataBase and the storage engine of the copy
+        """
+        self.address = address
+        # keys expire by the deletions of the primary, a reaper of its own would add changes
+        self.database = SyncDataBase(1, file_name, engine, reap_interval=None, **options)
+        self.seq_name = file_name + ".seq"
+        self.batch = batch
+        self.retry = retry
+        self.seq = self._load_seq()         # last change applied, None if it needs a snapshot
+        self.primary_seq = None             # last change of the primary, as of its last answer
+        self.snapshots = 0
+        self.applied = 0                    # changes applied
+        self.apply_time = 0.0               # seconds spent applying them
+        self.delay = 0.0                    # seconds from the commit of the last change applied to its apply
+        self.max_delay = 0.0
+        self._applied = threading.Condition()
+        self._stop = threading.Event()
+        self._sock = None
+        self._thread = None
+
+    def _load_seq(self):
+        """
+        Last sequence number applied by a previous run
+        :return: sequence number or None if there is none
+        """
+        try:
+            with open(self.seq_name) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _save_seq(self, seq):
+        """
+        Records the last sequence number applied, replacing the file at once
+        :param seq: Sequence number
+        """
+        temp_name = self.seq_name + ".tmp"
+        with open(temp_name, 'w') as f:
+            f.write(str(seq))
+        os.replace(temp_name, self.seq_name)
+        with self._applied:
+            self.seq = seq
+            self._applied.notify_all()
+
+    def start(self):
+        """
+        Starts following the primary in a background thread
+        :return: self
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="follower", daemon=True)
+        self._thread.start()
+        return self
+
+    def run(self):
+        """
+        Follows the primary until stop() is called, connecting again after failures
+        """
+        while not self._stop.is_set():
+            try:
+                self._sock = connect(self.address)
+                try:
+                    if self.seq is None:
+                        self._install()
+                    self._follow()
+                finally:
+                    self._sock.close()
+            except (OSError, ConnectionError, RuntimeError) as err:
+                if not self._stop.is_set():
+                    logging.warning(f"Replication from {self.address} interrupted at change {self.seq}: {err}")
+                    self._stop.wait(self.retry)
+
+    def _answer(self):
+        """
+        Reads an answer of the primary
+        :return: (opcode, payload)
+        """
+        answer = read_frame(self._sock)
+        if answer is None:
+            raise ConnectionError("Connection to the primary was lost")
+        if answer[1] not in (OK, TRUNCATED):
+            raise RuntimeError(f"Primary error: {answer[2]}")
+        return answer[1], answer[2]
+
+    def _install(self):
+        """
+        Replaces the copy with a snapshot of the primary in one transaction
+        """
+        self._sock.sendall(pack_frame(0, SNAPSHOT, None))
+        _, (seq, db) = self._answer()
+        with self.database.transaction() as txn:
+            for key in list(txn.base):
+                if key not in db:
+                    txn.delete_value(key)
+            for key, val in db.items():
+                txn.set_value(key, val)
+        self.snapshots += 1
+        self.primary_seq = seq
+        self._save_seq(seq)
+        logging.info(f"Installed snapshot of {len(db)} keys at change {seq}")
+
+    def _follow(self):
+        """
+        Subscribes to the changes after the last one applied and applies them as they come
+        """
+        self._sock.sendall(pack_frame(0, SUBSCRIBE, (self.seq, self.batch)))
+        while not self._stop.is_set():
+            opcode, payload = self._answer()
+            if opcode == TRUNCATED:
+                logging.warning(f"Feed no longer has the changes after {self.seq}: {payload}")
+                self.seq = None
+                return
+            self.primary_seq, changes = payload
+            if changes:
+                self._apply(changes)
+
+    def _apply(self, changes):
+        """
+        Applies changes of the feed in one transaction
+        :param changes: List of (sequence number, commit time, operation, key, value)
+        """
+        start = time.perf_counter()
+        with self.database.transaction() as txn:
+            for _, _, op, key, val in changes:
+                if op == SET:
+                    txn.set_value(key, val)
+                else:
+                    txn.delete_value(key)
+        self.apply_time += time.perf_counter() - start
+        self.applied += len(changes)
+        self.delay = max(time.time() - changes[-1][1], 0.0)
+        self.max_delay = max(self.max_delay, self.delay)
+        self._save_seq(changes[-1][0])
+
+    def wait_for(self, seq, timeout=None) -> bool:
+        """
+        Waits until the change with a sequence number is applied
+        :param seq: Sequence number
+        :param timeout: Maximum seconds to wait (None: no limit)
+        :return: If it was applied
+        """
+        with self._applied:
+            return self._applied.wait_for(lambda: self.seq is not None and self.seq >= seq, timeout)
+
+    def stats(self) -> dict:
+        """
+        Replication lag and throughput: sequence numbers of the copy and of the primary, changes behind,
+        delay from commit to apply of the last change (and the maximum) and changes applied per second
+        of applying them
+        :return: Dictionary of statistics
+        """
+        seq, primary_seq = self.seq, self.primary_seq
+        return {"seq": seq, "primary_seq": primary_seq,
+                "lag_changes": primary_seq - seq if seq is not None and primary_seq is not None else None,
+                "delay_ms": self.delay * 1000, "max_delay_ms": self.max_delay * 1000,
+                "applied": self.applied, "snapshots": self.snapshots,
+                "changes_per_second": self.applied / self.apply_time if self.apply_time else 0.0}
+
+    def stop(self):
+        """
+        Stops following (the copy keeps what it applied)
+        """
+        self._stop.set()
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)     # wakes up the thread waiting for an answer
+            except OSError:
+                pass
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        """
+        Stops following and closes the copy
+        """
+        self.stop()
+        self.database.close()
+
+
+def main():
+    """
+    Entry point: python replication.py --file replica.bin (--unix path | --port number)
+    """
+    parser = argparse.ArgumentParser(description="Keeps a copy of the database of a server with a feed")
+    parser.add_argument("--file", default="replica.bin", help="file of the copy")
+    parser.add_argument("--engine", default="snapshot", choices=["snapshot", "log", "hash"], help="storage engine")
+    parser.add_argument("--unix", help="path of the Unix-domain socket of the primary")
+    parser.add_argument("--port", type=int, default=5433, help="localhost TCP port of the primary")
+    args = parser.parse_args()
+    follower = Follower(args.unix or ("127.0.0.1", args.port), args.file, args.engine)
+    logging.info(f"Following {follower.address} into {args.file}")
+    try:
+        follower.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        follower.close()
+
+
+if __name__ == "__main__":
+    # logging configuration just when running
+    logging.basicConfig(filename="file_database.log", level=logging.INFO,
+                        format="[%(filename)s] - %(asctime)s - %(levelname)s - %(message)s")
+    main()
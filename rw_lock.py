@@ -0,0 +1,152 @@
+"""
+Author: Tomas Dal Farra
+Date: 05/01/2023
+Description: Writer-preferring reader-writer lock for threads and processes
+"""
+from contextlib import contextmanager
+import multiprocessing
+import threading
+import time
+
+READERS = 0                 # index in the state of the number of readers holding the lock
+WRITER = 1                  # index in the state of whether a writer holds (or was handed) the lock
+WAITING_WRITERS = 2         # index in the state of the number of writers waiting for the lock
+HANDOFF = 3                 # index in the state of whether the lock was handed to a waiting writer
+
+
+class RWLock:
+    """
+    Reader-writer lock: any number of readers or a single writer.
+    Writers are preferred, once a writer waits new readers wait behind it so writers are not starved.
+    The lock is handed directly to a waiting writer so it can not be taken again by whoever released it.
+    Acquiring and releasing is O(1): one mutex plus waking only who can proceed
+    """
+    def __init__(self, lock, condition, state):
+        """
+        Initializer for the reader-writer lock
+        :param lock: Mutex guarding the state
+        :param condition: Factory of conditions over the mutex
+        :param state: Mutable sequence of 4 integers (readers, writer, waiting writers, handoff)
+        """
+        self._lock = lock
+        self._read_ok = condition(lock)         # readers wait here while there is or waits a writer
+        self._write_ok = condition(lock)        # writers wait here until the lock is handed to them
+        self._state = state
+        self.metrics = None                     # Metrics recording waiting and holding times, set by the owner
+
+    def acquire_read(self):
+        """
+        Acquires the lock for reading, waiting while a writer holds it or waits for it
+        """
+        with self._lock:
+            state = self._state
+            while state[WRITER] or state[WAITING_WRITERS]:
+                self._read_ok.wait()
+            state[READERS] += 1
+
+    def release_read(self):
+        """
+        Releases the lock for reading, the last reader hands the lock to a waiting writer
+        """
+        with self._lock:
+            state = self._state
+            state[READERS] -= 1
+            if not state[READERS] and state[WAITING_WRITERS] and not state[WRITER]:
+                state[WRITER] = state[HANDOFF] = 1
+                self._write_ok.notify()
+
+    def acquire_write(self):
+        """
+        Acquires the lock for writing. If it is held or other writers are waiting, waits in line
+        until it is handed over
+        """
+        with self._lock:
+            state = self._state
+            if state[WRITER] or state[READERS] or state[WAITING_WRITERS]:
+                state[WAITING_WRITERS] += 1
+                self._write_ok.wait()               # always waits, a pending handoff belongs to who was woken
+                while not state[HANDOFF]:
+                    self._write_ok.wait()
+                state[HANDOFF] = 0
+                state[WAITING_WRITERS] -= 1
+            else:
+                state[WRITER] = 1
+
+    def release_write(self):
+        """
+        Releases the lock for writing, handing it to the next writer if any or else to all waiting readers
+        """
+        with self._lock:
+            state = self._state
+            if state[WAITING_WRITERS]:
+                state[HANDOFF] = 1
+                self._write_ok.notify()
+            else:
+                state[WRITER] = 0
+                self._read_ok.notify_all()
+
+    @contextmanager
+    def _locked(self, acquire, release, kind):
+        """
+        Holds the lock while inside the block, recording the time waiting for it and holding it if there are metrics
+        :param acquire: Acquiring method
+        :param release: Releasing method
+        :param kind: 'read' or 'write'
+        """
+        metrics = self.metrics
+        if metrics is None:
+            acquire()
+            try:
+                yield
+            finally:
+                release()
+            return
+        start = time.perf_counter_ns()
+        acquire()
+        acquired = time.perf_counter_ns()
+        metrics.observe(kind + "_wait", acquired - start)
+        try:
+            yield
+        finally:
+            metrics.observe(kind + "_hold", time.perf_counter_ns() - acquired)
+            release()
+
+    def read_locked(self):
+        """
+        Holds the lock for reading while inside the block
+        """
+        return self._locked(self.acquire_read, self.release_read, "read")
+
+    def write_locked(self):
+        """
+        Holds the lock for writing while inside the block
+        """
+        return self._locked(self.acquire_write, self.release_write, "write")
+
+
+class ThreadRWLock(RWLock):
+    """
+    Reader-writer lock between threads
+    """
+    def __init__(self):
+        super().__init__(threading.Lock(), threading.Condition, [0, 0, 0, 0])
+
+
+class ProcessRWLock(RWLock):
+    """
+    Reader-writer lock between processes, its state lives in shared memory
+    """
+    def __init__(self):
+        super().__init__(multiprocessing.Lock(), multiprocessing.Condition, multiprocessing.RawArray('i', 4))
+
+
+if __name__ == "__main__":
+    for rw_lock in (ThreadRWLock(), ProcessRWLock()):
+        rw_lock.acquire_read()
+        rw_lock.acquire_read()
+        rw_lock.release_read()
+        rw_lock.release_read()
+        with rw_lock.write_locked():
+            assert rw_lock._state[WRITER] == 1
+        with rw_lock.read_locked():
+            assert rw_lock._state[READERS] == 1
@@ -0,0 +1,265 @@
+"""
+Author: Tomas Dal Farra
+Date: 12/01/2023
+Description: Synchronized database split by key across several files, each one with its own lock
+"""
+from sync_database import SyncDataBase
+from hash_storage import key_hash
+from dict_database import BATCH
+from sorted_index import sort_key
+from expiry import expired, live
+from contextlib import contextmanager, ExitStack
+import heapq
+import pickle
+import time
+import os
+
+
+class ShardedSyncDataBase:
+    """
+    Database thread/process synchronized whose keys are hashed across shards.
+    Every shard is a SyncDataBase with its own file and readers-writer lock, so writes to different
+    shards run in parallel and each one rewrites only its shard
+    """
+    def __init__(self, mode, file_name="dbfile.bin", shards=4, engine="snapshot", **options):
+        """
+        Initializer for sharded database class
+        :param mode: Takes a flag 1 or 0 where this means threading or multiprocessing correspondingly
+        :param file_name: Name of the file recording the number of shards, shard i is stored in 'file_name.i'
+        :param shards: Number of shards (must be the same every time the database is opened)
+        :param engine: Storage engine of the shard files (see FileDataBase)
+        :param options: Options for the storage engine
+        """
+        if shards < 1:
+            raise ValueError("There must be at least one shard")
+        self.file_name = file_name
+        if os.path.exists(file_name):
+            with open(file_name, 'rb') as f:
+                stored = pickle.load(f)["shards"]
+            if stored != shards:
+                raise ValueError(f"{file_name} has {stored} shards, not {shards}")
+        else:
+            with open(file_name, 'wb') as f:
+                pickle.dump({"shards": shards}, f)
+        self.shards = [SyncDataBase(mode, f"{file_name}.{i}", engine, **options) for i in range(shards)]
+
+    def _shard(self, key) -> SyncDataBase:
+        """
+        Shard where a key is stored, with a hash that is the same in every process and run
+        :param key: Key for the database
+        :return: Shard database
+        """
+        return self.shards[key_hash(pickle.dumps(key)) % len(self.shards)]
+
+    def _group(self, keys) -> dict:
+        """
+        Groups keys by their shard
+        :param keys: Iterable of keys for the database
+        :return: Dictionary of shard: list of its keys
+        """
+        groups = {}
+        for key in keys:
+            groups.setdefault(self._shard(key), []).append(key)
+        return groups
+
+    def set_value(self, key, val, ttl=None) -> bool:
+        """
+        Sets new key:value in the shard of the key
+        :param key: Key for the database
+        :param val: Value of the key
+        :param ttl: Seconds until the key expires (None: never)
+        :return: If the operation was successful
+        """
+        return self._shard(key).set_value(key, val, ttl)
+
+    def get_value(self, key):
+        """
+        Gets value according to the key from its shard
+        If key doesn't exist None is returned
+        :param key: Key for the database element
+        :return: Value from the database if found
+        """
+        return self._shard(key).get_value(key)
+
+    def delete_value(self, key):
+        """
+        Deletes value from the shard of the key
+        :param key: Key for a database value
+        :return: Deleted value if existed
+        """
+        return self._shard(key).delete_value(key)
+
+    def update(self, key, fn):
+        """
+        Sets a key to a function of its current value atomically in its shard
+        :param key: Key for the database
+        :param fn: Function taking the current value (None if the key doesn't exist) and returning the new one
+        :return: New value
+        """
+        return self._shard(key).update(key, fn)
+
+    def increment(self, key, delta=1):
+        """
+        Adds to the value of a key atomically in its shard
+        :param key: Key for the database
+        :param delta: Amount to add (a key that doesn't exist counts as 0)
+        :return: New value
+        """
+        return self._shard(key).increment(key, delta)
+
+    def compare_and_set(self, key, expected, new) -> bool:
+        """
+        Sets a key only if its current value is the expected one, atomically in its shard
+        :param key: Key for the database
+        :param expected: Value the key must have (None if it must not exist)
+        :param new: Value to set
+        :return: If the value was set
+        """
+        return self._shard(key).compare_and_set(key, expected, new)
+
+    def set_many(self, items) -> bool:
+        """
+        Sets several key:value pairs writing each shard involved once.
+        Each shard is changed atomically but not all of them together
+        :param items: Dictionary or iterable of (key, value) pairs
+        :return: If the operation was successful
+        """
+        items = dict(items)
+        return all([shard.set_many({key: items[key] for key in keys})
+                    for shard, keys in self._group(items).items()])
+
+    def get_many(self, keys) -> dict:
+        """
+        Gets values of several keys reading each shard involved once
+        :param keys: Iterable of keys for the database
+        :return: Dictionary of key:value for each key
+        """
+        values = {}
+        for shard, shard_keys in self._group(keys).items():
+            values.update(shard.get_many(shard_keys))
+        return values
+
+    def delete_many(self, keys) -> dict:
+        """
+        Deletes several values writing each shard involved once
+        :param keys: Iterable of keys for database values
+        :return: Dictionary of key:deleted value (None if it didn't exist)
+        """
+        deleted = {}
+        for shard, shard_keys in self._group(keys).items():
+            deleted.update(shard.delete_many(shard_keys))
+        return deleted
+
+    @contextmanager
+    def _all_read_locked(self):
+        """
+        Holds the reader access of every shard (always in the same order) while inside the block
+        """
+        with ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.rw_lock.read_locked())
+            yield
+
+    def snapshot(self) -> dict:
+        """
+        Copies the whole database consistently: no shard changes while it is copied (without expired keys)
+        :return: Dictionary with the content of all shards
+        """
+        db = {}
+        with self._all_read_locked():
+            for shard in self.shards:
+                db.update(shard.storage.load())
+        now = time.time()
+        return {key: live(val, now) for key, val in db.items() if not expired(val, now)}
+
+    def keys(self):
+        """
+        Streams the keys of all shards in order (see DataBase.keys).
+        Each shard is scanned from one version of its own, not all of them together
+        :return: Generator of keys
+        """
+        return heapq.merge(*[shard.keys() for shard in self.shards], key=sort_key)
+
+    def items(self, batch=BATCH):
+        """
+        Streams the key:value pairs of all shards in order of the keys (see keys)
+        :param batch: Number of values read together in each shard
+        :return: Generator of (key, value)
+        """
+        return heapq.merge(*[shard.items(batch) for shard in self.shards], key=lambda item: sort_key(item[0]))
+
+    def scan(self, start=None, end=None, batch=BATCH):
+        """
+        Streams the key:value pairs with keys from start (included) to end (excluded) of all shards in order
+        (see DataBase.scan and keys)
+        :param start: First key or None from the first one
+        :param end: Key where to stop or None until the last one
+        :param batch: Number of values read together in each shard
+        :return: Generator of (key, value)
+        """
+        return heapq.merge(*[shard.scan(start, end, batch) for shard in self.shards],
+                           key=lambda item: sort_key(item[0]))
+
+    def prefix(self, prefix, batch=BATCH):
+        """
+        Streams the key:value pairs with keys starting with a prefix of all shards in order (see keys)
+        :param prefix: str or bytes the keys start with
+        :param batch: Number of values read together in each shard
+        :return: Generator of (key, value)
+        """
+        return heapq.merge(*[shard.prefix(prefix, batch) for shard in self.shards],
+                           key=lambda item: sort_key(item[0]))
+
+    def get_name(self) -> str:
+        """
+        Gets file name
+        :return: file name
+        """
+        return self.file_name
+
+    def close(self):
+        """
+        Releases resources of all shards
+        """
+        for shard in self.shards:
+            shard.close()
+
+    def __iter__(self):
+        """
+        Iterates over the keys of a consistent copy of the database
+        """
+        return iter(self.snapshot())
+
+    def __len__(self):
+        """
+        Number of keys of a consistent copy of the database
+        """
+        return len(self.snapshot())
+
+    def __repr__(self):
+        """
+        Prints file name and then the dictionary of all the shards
+        :return: string description of the database
+        """
+        return f"{self.file_name}: {self.snapshot()}"
+
+
+if __name__ == "__main__":
+    database = ShardedSyncDataBase(1, 'testfile.bin', shards=3)
+    try:
+        assert database.set_value('1', '2')
+        assert database.set_many({n: n for n in range(10)})
+        assert database.get_value(1) == 1
+        assert database.delete_value('1') == '2'
+        assert database.get_many([1, '1']) == {1: 1, '1': None}
+        assert database.increment(1, 2) == 3 and database.compare_and_set(1, 3, 1)
+        assert database.delete_many([8, 10]) == {8: 8, 10: None}
+        assert sorted(database) == [0, 1, 2, 3, 4, 5, 6, 7, 9]
+        assert list(database.keys()) == [0, 1, 2, 3, 4, 5, 6, 7, 9]
+        assert list(database.scan(2, 5)) == [(2, 2), (3, 3), (4, 4)]
+        assert sum(len(shard.db) for shard in database.shards) == 9
+        assert repr(database).startswith(database.get_name() + ": ")
+    finally:
+        os.remove(database.get_name())
+        for i in range(3):
+            os.remove(f"{database.get_name()}.{i}")
@@ -0,0 +1,226 @@
+"""
+Author: Tomas Dal Farra
+Date: 31/01/2023
+Description: Sorted index of the keys of a database with cheap snapshots for range and prefix scans
+"""
+from bisect import bisect_left
+from itertools import takewhile
+
+CHUNK = 1000                # keys per chunk, a chunk is split when it doubles
+
+
+def key_group(key) -> str:
+    """
+    Group of keys that can be compared with each other: numbers together, else keys of the same type
+    :param key: Key for the database
+    :return: name of the group
+    """
+    if isinstance(key, (int, float)):
+        return "number"
+    return type(key).__name__
+
+
+def sort_key(key):
+    """
+    Order of keys of any type: by group and then by key within the group
+    :param key: Key for the database
+    :return: comparable tuple
+    """
+    return key_group(key), key
+
+
+class SortedKeys:
+    """
+    Sorted list of comparable keys split in chunks, so a change moves at most a chunk of keys.
+    snapshot() copies only the list of chunks: chunks are then shared and copied by whoever changes them
+    first (copy on write), so a snapshot never sees later changes
+    """
+    def __init__(self, keys=()):
+        """
+        Initializer for the sorted keys
+        :param keys: Iterable of comparable keys without repetitions
+        """
+        keys = sorted(keys)
+        self._chunks = [keys[i:i + CHUNK] for i in range(0, len(keys), CHUNK)]
+        self._maxes = [chunk[-1] for chunk in self._chunks]
+        self._owned = {id(chunk) for chunk in self._chunks}   # chunks this object may change in place
+        self._len = len(keys)
+
+    def snapshot(self):
+        """
+        Copy that doesn't change when this one changes
+        :return: SortedKeys
+        """
+        other = object.__new__(SortedKeys)
+        other._chunks, other._maxes, other._len = list(self._chunks), list(self._maxes), self._len
+        other._owned = set()
+        self._owned = set()
+        return other
+
+    def _own(self, i) -> list:
+        """
+        Chunk i ready to be changed, copied first if it is shared
+        :param i: Index of the chunk
+        :return: chunk
+        """
+        chunk = self._chunks[i]
+        if id(chunk) not in self._owned:
+            chunk = list(chunk)
+            self._chunks[i] = chunk
+            self._owned.add(id(chunk))
+        return chunk
+
+    def add(self, key):
+        """
+        Adds a key if it isn't already there
+        :param key: Key comparable with the others
+        """
+        if not self._chunks:
+            chunk = [key]
+            self._chunks.append(chunk)
+            self._maxes.append(key)
+            self._owned.add(id(chunk))
+            self._len = 1
+            return
+        i = min(bisect_left(self._maxes, key), len(self._maxes) - 1)
+        j = bisect_left(self._chunks[i], key)
+        if j < len(self._chunks[i]) and self._chunks[i][j] == key:
+            return
+        chunk = self._own(i)
+        chunk.insert(j, key)
+        self._maxes[i] = chunk[-1]
+        self._len += 1
+        if len(chunk) > 2 * CHUNK:
+            first, second = chunk[:CHUNK], chunk[CHUNK:]
+            self._chunks[i:i + 1] = [first, second]
+            self._maxes[i:i + 1] = [first[-1], second[-1]]
+            self._owned.update((id(first), id(second)))
+
+    def discard(self, key):
+        """
+        Removes a key if it is there
+        :param key: Key comparable with the others
+        """
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            return
+        j = bisect_left(self._chunks[i], key)
+        if j == len(self._chunks[i]) or self._chunks[i][j] != key:
+            return
+        chunk = self._own(i)
+        del chunk[j]
+        self._len -= 1
+        if chunk:
+            self._maxes[i] = chunk[-1]
+        else:
+            del self._chunks[i]
+            del self._maxes[i]
+
+    def irange(self, start=None, end=None):
+        """
+        Keys from start (included) to end (excluded) in order
+        :param start: First key or None from the beginning
+        :param end: Key where to stop or None until the end
+        :return: Generator of keys
+        """
+        i = j = 0
+        if start is not None:
+            i = bisect_left(self._maxes, start)
+            if i == len(self._chunks):
+                return
+            j = bisect_left(self._chunks[i], start)
+        for chunk in self._chunks[i:]:
+            for key in chunk[j:] if j else chunk:
+                if end is not None and not key < end:
+                    return
+                yield key
+            j = 0
+
+    def __len__(self):
+        return self._len
+
+
+class KeyIndex:
+    """
+    Sorted index of keys of any type: one SortedKeys for each group of comparable keys
+    """
+    def __init__(self, keys=()):
+        """
+        Initializer for the key index
+        :param keys: Iterable of keys without repetitions
+        """
+        groups = {}
+        for key in keys:
+            groups.setdefault(key_group(key), []).append(key)
+        self._groups = {group: SortedKeys(group_keys) for group, group_keys in groups.items()}
+
+    def snapshot(self):
+        """
+        Copy that doesn't change when this one changes
+        :return: KeyIndex
+        """
+        other = object.__new__(KeyIndex)
+        other._groups = {group: keys.snapshot() for group, keys in self._groups.items()}
+        return other
+
+    def add(self, key):
+        """
+        Adds a key if it isn't already there
+        :param key: Key for the database
+        """
+        group = key_group(key)
+        if group not in self._groups:
+            self._groups[group] = SortedKeys()
+        self._groups[group].add(key)
+
+    def discard(self, key):
+        """
+        Removes a key if it is there
+        :param key: Key for the database
+        """
+        keys = self._groups.get(key_group(key))
+        if keys is not None:
+            keys.discard(key)
+
+    def irange(self, start=None, end=None):
+        """
+        Keys from start (included) to end (excluded) in order. With bounds only keys of their group are
+        compared to them (start and end must be of the same group), without bounds every key is given,
+        group after group
+        :param start: First key or None
+        :param end: Key where to stop or None
+        :return: Generator of keys
+        """
+        if start is None and end is None:
+            for group in sorted(self._groups):
+                yield from self._groups[group].irange()
+            return
+        keys = self._groups.get(key_group(start if start is not None else end))
+        if keys is not None:
+            yield from keys.irange(start, end)
+
+    def prefix(self, prefix):
+        """
+        Keys starting with a prefix in order
+        :param prefix: str or bytes prefix
+        :return: Generator of keys
+        """
+        return takewhile(lambda key: key.startswith(prefix), self.irange(prefix))
+
+    def __len__(self):
+        return sum(len(keys) for keys in self._groups.values())
+
+
+if __name__ == "__main__":
+    index = KeyIndex([5, "b", 1.5, "a", b"x", 3])
+    assert list(index.irange()) == [b"x", 1.5, 3, 5, "a", "b"]
+    frozen = index.snapshot()
+    index.add("ab")
+    index.discard(3)
+    assert list(index.irange(2, 6)) == [5]
+    assert list(index.prefix("a")) == ["a", "ab"]
+    assert list(frozen.irange(2, 6)) == [3, 5] and len(frozen) == 6
+    big = SortedKeys(range(0, 10000, 2))
+    for n in range(1, 10000, 2):
+        big.add(n)
+    assert list(big.irange(4990, 5003)) == list(range(4990, 5003)) and len(big) == 10000
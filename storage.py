@@ -0,0 +1,786 @@
+"""
+Author: Tomas Dal Farra
+Date: 02/01/2023
+Description: Storage engines that persist the dictionary database into files
+"""
+from contextlib import nullcontext, contextmanager
+import db_codecs
+import lazy_dict
+import threading
+import weakref
+import logging
+import struct
+import pickle
+import time
+import zlib
+import os
+
+SET = 0                     # change operation: key was set to a value
+DELETE = 1                  # change operation: key was deleted
+DURABILITY = ("os", "always", "interval")
+
+_storages = weakref.WeakSet()               # storages alive in this process, to reset their threads state on fork
+
+
+def _reset_after_fork():
+    """ Threads do not survive fork, so locks they held in the parent must be recreated in the child """
+    for storage in _storages:
+        storage._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _process_alive(pid) -> bool:
+    """
+    Checks if a process is running
+    :param pid: Process id
+    :return: False only if there is certainly no such process
+    """
+    if os.name != "posix":              # there signal 0 doesn't probe, it would end the process
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:             # running as another user
+        return True
+    return True
+
+
+class Storage:
+    """
+    Base of storage engines: where the dictionary of a FileDataBase is loaded from and persisted to.
+    Engines with lock_free_reads never change a loaded dictionary, so it can be read without any lock.
+    It also applies the durability policy to the commits of the engine:
+    'os' leaves flushing to the operating system, 'always' fsyncs on every commit and 'interval' fsyncs
+    in background every interval_ms milliseconds or interval_ops commits, whatever comes first, so
+    concurrent writers share one fsync (group commit)
+    """
+    lock_free_reads = False
+    lazy = False                # if values are decoded when first read (see SnapshotStorage)
+
+    def __init__(self, file_name, durability="os", interval_ms=10, interval_ops=100):
+        """
+        Initializer for the storage
+        :param file_name: Name of file for the database
+        :param durability: Durability policy: 'os', 'always' or 'interval'
+        :param interval_ms: Maximum milliseconds between fsyncs with 'interval'
+        :param interval_ops: Maximum commits between fsyncs with 'interval'
+        """
+        if durability not in DURABILITY:
+            raise ValueError(f"Unknown durability policy: {durability}")
+        self.file_name = file_name
+        self.durability = durability
+        self.interval_ms = interval_ms
+        self.interval_ops = interval_ops
+        # context manager giving exclusion against writers of other threads/processes, set by the owner
+        self.exclusive = nullcontext
+        # counter shared between processes that is increased on every write, set by the owner.
+        # It catches changes that file stats miss (same size within the same mtime tick)
+        self.generation = None
+        # Metrics recording time and bytes decoding/encoding the database, set by the owner
+        self.metrics = None
+        self._after_fork()
+        _storages.add(self)
+
+    def _after_fork(self):
+        """ Creates the state of the group commit, again in a forked child process """
+        self._commit_cond = threading.Condition()
+        self._commits = 0                   # commits made by this process
+        self._synced = 0                    # commits made durable by the flusher
+        self._flusher = None                # background thread doing the group fsync
+        self._ticket = threading.local()    # last commit of each thread
+
+    def _durable_files(self) -> list:
+        """
+        Files that must be fsynced to make commits durable
+        :return: list of file names
+        """
+        return [self.file_name]
+
+    @staticmethod
+    def _fsync_path(path):
+        """
+        Fsyncs a file or directory (an fsync of any descriptor flushes every write to the file)
+        :param path: Path of the file or directory
+        """
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _sync(self):
+        """
+        Fsyncs the files of the engine
+        """
+        for file_name in self._durable_files():
+            self._fsync_path(file_name)
+
+    def _committed(self):
+        """
+        Applies the durability policy after the engine wrote a commit (called by the writer)
+        """
+        if self.durability == "always":
+            self._sync()
+        elif self.durability == "interval":
+            with self._commit_cond:
+                self._commits += 1
+                self._ticket.value = self._commits
+                if self._flusher is None or not self._flusher.is_alive():
+                    self._flusher = threading.Thread(target=self._flush_loop, name="group_commit", daemon=True)
+                    self._flusher.start()
+                elif self._commits - self._synced in (1, self.interval_ops):    # wakes it idle or when full
+                    self._commit_cond.notify_all()
+
+    def _flush_loop(self):
+        """
+        Group commit: fsyncs interval_ms after the first commit pending or at interval_ops commits and wakes
+        the writers waiting for it. It sleeps without any timeout while no commit is pending
+        """
+        while True:
+            with self._commit_cond:
+                self._commit_cond.wait_for(lambda: self._commits > self._synced)
+                self._commit_cond.wait_for(lambda: self._commits - self._synced >= self.interval_ops,
+                                           self.interval_ms / 1000)
+                target = self._commits
+            if target > self._synced:
+                try:
+                    self._sync()
+                except OSError as err:
+                    logging.error(f"There was a problem to fsync the database: {err}")
+                    continue
+                with self._commit_cond:
+                    self._synced = target
+                    self._commit_cond.notify_all()
+
+    def wait_durable(self):
+        """
+        Waits until the last commit of this thread is durable. With 'interval' this should be
+        called after releasing locks so other writers can join the same group commit
+        """
+        ticket = getattr(self._ticket, "value", 0)
+        if ticket > self._synced:
+            with self._commit_cond:
+                self._commit_cond.wait_for(lambda: self._synced >= ticket)
+
+    def _measure(self, name, start, size):
+        """
+        Records a decoding or encoding if there are metrics
+        :param name: 'decode' or 'encode'
+        :param start: perf_counter_ns() when it started
+        :param size: Bytes decoded or encoded
+        """
+        if self.metrics is not None:
+            self.metrics.observe(name, time.perf_counter_ns() - start)
+            self.metrics.add(name + "_bytes", size)
+
+    def _bump_generation(self):
+        """ Counts a write in the shared generation (called holding the writers exclusion) """
+        if self.generation is not None:
+            self.generation.value += 1
+
+    def open(self) -> dict:
+        """
+        Opens the database creating its files if needed
+        :return: Dictionary database
+        """
+        raise NotImplementedError
+
+    def load(self) -> dict:
+        """
+        Loads the current database content
+        :return: Dictionary database
+        """
+        raise NotImplementedError
+
+    def load_for_write(self) -> dict:
+        """
+        Loads the current database content to change it and persist it
+        :return: Dictionary database
+        """
+        return self.load()
+
+    def persist(self, db, changes):
+        """
+        Persists changes made to the database
+        :param db: Dictionary with the changes already applied
+        :param changes: List of (operation, key, value) applied to db
+        """
+        raise NotImplementedError
+
+    def version(self):
+        """
+        Identifies the content returned by the last load or persist: it is different whenever the content is
+        :return: Hashable version or None if it can't be told
+        """
+        return None
+
+    def load_versioned(self) -> tuple:
+        """
+        Loads the current database content along with its version (called holding the reader access,
+        so no write comes between them)
+        :return: (version, dictionary database)
+        """
+        db = self.load()
+        return self.version(), db
+
+    def invalidate(self):
+        """ Forgets any in-memory state so next load reads everything from file """
+
+    @contextmanager
+    def bulk(self):
+        """
+        Context to persist many changes in a row: engines may put off their maintenance until it ends
+        """
+        yield
+
+    def close(self):
+        """ Releases resources held by the storage """
+
+
+class SnapshotStorage(Storage):
+    """
+    Keeps the whole dictionary in one file that is rewritten on every change.
+    Every change writes a new version of the file in a temporary file that replaces the old one atomically,
+    so the file is always a complete version. The loaded dictionary is cached and read again only when the
+    file changed. Writers change a copy of it and publish the copy once it is persisted (copy on write),
+    so a loaded dictionary never changes and readers need no lock.
+    With lazy=True the file is written with the 'indexed' codec and mapped in memory: loading it reads only
+    its key directory and values are decoded when they are first read (see lazy_dict.LazyDict)
+    """
+    lock_free_reads = True
+
+    def __init__(self, file_name, codec=None, compression=None, compression_level=None,
+                 compression_threshold=db_codecs.COMPRESS_THRESHOLD, lazy=False, **durability):
+        """
+        Initializer for the snapshot storage
+        :param file_name: Name of file for the database
+        :param codec: Codec writing the file ('pickle', 'marshal', 'tagged' or 'indexed', see db_codecs), recorded
+        in its header. None writes a plain pickle without header. Files are read with the codec they were written with
+        :param compression: 'zlib', 'lzma' or 'bz2' to compress large str/bytes values (recorded in the header,
+        files are read whether they are compressed or not) or None
+        :param compression_level: Level of the compression algorithm (None: its default)
+        :param compression_threshold: Values shorter than this many bytes are stored uncompressed
+        :param lazy: If files written with the 'indexed' codec are opened reading only their keys (the codec
+        is then 'indexed', files written otherwise are read whole until they are written again)
+        :param durability: Durability options (see Storage)
+        """
+        super().__init__(file_name, **durability)
+        if lazy and codec not in (None, "indexed"):
+            raise ValueError(f"Lazy opening needs the 'indexed' codec, not {codec}")
+        if lazy and compression is not None:
+            raise ValueError("Lazy opening can't be combined with compression")
+        self.lazy = lazy
+        self.codec = db_codecs.get_codec("indexed" if lazy else codec)
+        self.compression = db_codecs.get_compression(compression, compression_level, compression_threshold)
+        self._version = None                        # (stamp of the file, dictionary read from it), replaced at once
+
+    @staticmethod
+    def _non_zero_file(file_path) -> bool:
+        """
+        Checks if a file exists and if it has any content
+        :param file_path: path for file to check
+        :return: if file meets the condition
+        """
+        try:
+            return os.path.getsize(file_path) > 0
+        except OSError:
+            return False
+
+    def open(self) -> dict:
+        """
+        Opens the database, creating the file with an empty dictionary if it doesn't exist
+        :return: Dictionary stored in file
+        """
+        if not self._non_zero_file(self.file_name):      # creates file with empty dictionary if it doesn't exist
+            self.write({})
+            logging.debug("New database initialized")
+        else:
+            logging.debug("Previous database content loaded")
+        self._version = None
+        return self.load()
+
+    def _current_stamp(self):
+        """
+        Cheap version of the file: generation, device, inode, modification time and size
+        :return: Tuple that changes when the file changes
+        """
+        generation = self.generation.value if self.generation is not None else None
+        stat = os.stat(self.file_name)
+        return generation, stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def read(self) -> dict:
+        """
+        Reads the dictionary from the file (only its key directory if it is opened lazily)
+        :return: Dictionary stored in file
+        """
+        with open(self.file_name, 'rb') as f:
+            if self.lazy and f.read(db_codecs.HEADER.size) == db_codecs.HEADER.pack(
+                    db_codecs.MAGIC, self.codec.codec_id, 0):
+                start = time.perf_counter_ns()
+                db = lazy_dict.open_file(self.file_name, db_codecs.HEADER.size)
+                self._measure("decode", start, db.directory_size)
+                return db
+            f.seek(0)
+            data = f.read()
+        start = time.perf_counter_ns()
+        db = db_codecs.decode_file(data, self.compression)
+        self._measure("decode", start, len(data))
+        return db
+
+    def _durable_files(self) -> list:
+        """
+        The file and its directory, which records that it was replaced
+        :return: list of file names
+        """
+        return [self.file_name, os.path.dirname(os.path.abspath(self.file_name))]
+
+    def write(self, db, file_name=None):
+        """
+        Writes the whole dictionary to a temporary file and replaces the file with it
+        :param db: Dictionary to write
+        :param file_name: Where to write it (database file by default)
+        """
+        file_name = file_name or self.file_name
+        start = time.perf_counter_ns()
+        chunks = db_codecs.encode_file(db, self.codec, self.compression)
+        self._measure("encode", start, sum(memoryview(chunk).nbytes for chunk in chunks))
+        temp_name = f"{file_name}.{os.getpid()}.tmp"
+        try:
+            with open(temp_name, 'wb') as f:
+                f.writelines(chunks)
+                if self.durability == "always":         # complete on disk before it replaces the file
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(temp_name, file_name)
+        except BaseException:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            raise
+
+    def load(self) -> dict:
+        """
+        Loads the current database content, unpickling the file only if it changed since last time.
+        The stamp is taken before reading so a change during the read is noticed on the next load.
+        The returned dictionary must not be changed (see load_for_write)
+        :return: Dictionary database
+        """
+        return self.load_versioned()[1]
+
+    def load_versioned(self) -> tuple:
+        """
+        Loads the current database content with the stamp it was published with, both from one version,
+        so a write committed by another thread meanwhile can't pair the new stamp with the old dictionary
+        :return: (stamp, dictionary database)
+        """
+        stamp = self._current_stamp()
+        version = self._version
+        if version is None or version[0] != stamp:
+            version = (stamp, self.read())
+            self._version = version
+        return version
+
+    def load_for_write(self) -> dict:
+        """
+        Copies the current database content so readers keep the published one while it is changed
+        (a LazyDict copy shares the file and the values read)
+        :return: Dictionary database
+        """
+        return self.load().copy()
+
+    def persist(self, db, changes):
+        """
+        Persists changes made to the database and publishes db as the current version
+        (the generation counts the write after the file was replaced)
+        :param db: Dictionary with the changes already applied
+        :param changes: List of (operation, key, value) applied to db
+        """
+        if changes:
+            self.write(db)
+            self._committed()
+            self._bump_generation()
+            if self.lazy:       # maps the new file keeping the values read, so the old one can be freed
+                written = self.read()
+                if isinstance(db, lazy_dict.LazyDict) and isinstance(written, lazy_dict.LazyDict):
+                    written.adopt(db)
+                db = written
+            self._version = (self._current_stamp(), db)
+
+    def version(self):
+        """
+        Stamp of the published version
+        :return: Hashable version or None if nothing is loaded
+        """
+        version = self._version
+        return version[0] if version is not None else None
+
+    def invalidate(self):
+        """ Forgets the cached dictionary so next load reads the file """
+        self._version = None
+
+
+class LogStorage(Storage):
+    """
+    Append-only log of changes over a snapshot file.
+    Every set or delete appends one small record to '<file_name>.log', opening replays the log over
+    the snapshot and when the log grows past compact_size it is folded into a new snapshot in background.
+    A record is a pickled change, or with a codec its id, the operation (the id of the compression algorithm
+    in the high 4 bits) and the encoded {key: value}
+    """
+    RECORD_HEADER = struct.Struct(">II")            # record length and crc32 of the record
+
+    def __init__(self, file_name, compact_size=1 << 22, codec=None, compression=None, compression_level=None,
+                 compression_threshold=db_codecs.COMPRESS_THRESHOLD, lazy=False, **durability):
+        """
+        Initializer for the log storage
+        :param file_name: Name of the snapshot file of the database
+        :param compact_size: Log size in bytes after which it is compacted into the snapshot
+        :param codec: Codec of the snapshot and the records (see SnapshotStorage)
+        :param compression: Compression of the snapshot and the records (see SnapshotStorage)
+        :param compression_level: Level of the compression algorithm (None: its default)
+        :param compression_threshold: Values shorter than this many bytes are stored uncompressed
+        :param lazy: If the snapshot is opened reading only its keys (see SnapshotStorage), the log is replayed
+        :param durability: Durability options (see Storage)
+        """
+        # before the base sets metrics, which it shares
+        self.snapshot = SnapshotStorage(file_name, codec, compression, compression_level, compression_threshold, lazy)
+        super().__init__(file_name, **durability)
+        self.lazy = lazy
+        self.log_name = file_name + ".log"
+        self.compact_size = compact_size
+        self.codec = self.snapshot.codec
+        if self.codec is db_codecs.CODECS["indexed"]:      # a directory is no use for a record of one key
+            self.codec = db_codecs.CODECS["pickle"]
+        # its own, the cache of the snapshot keeps the values of the whole dictionary
+        self.compression = db_codecs.get_compression(compression, compression_level, compression_threshold)
+        if self.compression is not None and self.codec is None:     # compressed records need a codec id
+            self.codec = db_codecs.CODECS["pickle"]
+        self._db = None
+        self._offset = 0                            # log bytes already applied to _db
+        self._log_id = None                         # identity of the log file applied to _db
+        self._log = None                            # that log, kept open so no new log can reuse its identity
+
+    def _after_fork(self):
+        """ Creates the locks and threads state, again in a forked child process """
+        super()._after_fork()
+        self._lock = threading.Lock()               # guards in-memory state of this storage
+        self._compactor = None                      # background compaction thread
+        self._bulk = False                          # compaction put off until a bulk write ends
+
+    @property
+    def metrics(self):
+        """ Metrics of this storage, shared with its snapshot """
+        return self.snapshot.metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        self.snapshot.metrics = metrics
+
+    def _durable_files(self) -> list:
+        """
+        Commits are appended to the log
+        :return: list of file names
+        """
+        return [self.log_name]
+
+    @staticmethod
+    def _file_id(f):
+        """
+        Identity of an open file, to notice when it was replaced by a compaction
+        :param f: Open file
+        :return: device and inode of the file
+        """
+        stat = os.fstat(f.fileno())
+        return stat.st_dev, stat.st_ino
+
+    def _path_id(self):
+        """
+        Identity of the file currently at the log path
+        :return: device and inode of the log or None if it doesn't exist
+        """
+        try:
+            stat = os.stat(self.log_name)
+        except FileNotFoundError:
+            return None
+        return stat.st_dev, stat.st_ino
+
+    @staticmethod
+    def _tail(log, offset) -> bytes:
+        """
+        Reads a log from an offset to its end without moving its position, shared with forked processes
+        :param log: Open log file
+        :param offset: Where to start reading
+        :return: bytes read
+        """
+        if hasattr(os, "pread"):
+            return os.pread(log.fileno(), max(os.fstat(log.fileno()).st_size - offset, 0), offset)
+        log.seek(offset)
+        return log.read()
+
+    @classmethod
+    def _records(cls, data):
+        """
+        Parses complete records from log bytes, stopping at a torn or partial record
+        :param data: Log bytes starting at a record boundary
+        :return: Generator of (end offset, change) for each complete record
+        """
+        pos = 0
+        while pos + cls.RECORD_HEADER.size <= len(data):
+            length, crc = cls.RECORD_HEADER.unpack_from(data, pos)
+            start = pos + cls.RECORD_HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return
+            pos = start + length
+            yield pos, cls._decode_change(payload)
+
+    def _encode_change(self, change) -> bytes:
+        """
+        Encodes a change as the payload of a record
+        :param change: (operation, key, value)
+        :return: payload
+        """
+        if self.codec is None:
+            return pickle.dumps(change)
+        op, key, val = change
+        compression = self.compression
+        if compression is None or not isinstance(val, (str, bytes, bytearray)) or len(val) < compression.threshold:
+            return bytes((self.codec.codec_id, op)) + self.codec.dumps({key: val})
+        return b"".join([bytes((self.codec.codec_id, op | compression.algorithm_id << 4)),
+                         *compression.encode({key: val}, self.codec)])
+
+    @staticmethod
+    def _decode_change(payload):
+        """
+        Decodes the payload of a record written with any codec (pickles start with the PROTO opcode 0x80)
+        :param payload: Payload of the record
+        :return: (operation, key, value)
+        """
+        if payload[0] == 0x80:
+            return pickle.loads(payload)
+        codec = db_codecs.get_codec_by_id(payload[0])
+        (key, val), = db_codecs.decode_body(memoryview(payload)[2:], codec, payload[1] >> 4).items()
+        return payload[1] & 0x0F, key, val
+
+    @staticmethod
+    def _apply(db, changes):
+        """
+        Applies changes to a dictionary
+        :param db: Dictionary to change
+        :param changes: Iterable of (operation, key, value)
+        """
+        for op, key, val in changes:
+            if op == SET:
+                db[key] = val
+            else:
+                db.pop(key, None)
+
+    def _replay(self, log, db, offset) -> int:
+        """
+        Applies log records from offset to the end of the log
+        :param log: Open log file
+        :param db: Dictionary to apply records to
+        :param offset: Where to start reading
+        :return: Offset after the last complete record
+        """
+        data = self._tail(log, offset)
+        start = time.perf_counter_ns()
+        end = offset
+        for pos, change in self._records(data):
+            self._apply(db, (change,))
+            end = offset + pos
+        if data:
+            self._measure("decode", start, len(data))
+        return end
+
+    def _full_load(self, repair=False):
+        """
+        Loads snapshot and the whole log.
+        The log is opened before the snapshot is read so a compaction in between only replays records
+        already included in the new snapshot, which leaves the same result
+        :param repair: Truncates a torn record at the end of the log (only safe while opening)
+        """
+        try:
+            log = open(self.log_name, 'rb')
+        except FileNotFoundError:
+            with open(self.log_name, 'ab'):
+                pass
+            log = open(self.log_name, 'rb')
+        try:
+            db = self.snapshot.read()
+            offset = self._replay(log, db, 0)
+            if repair and offset < os.fstat(log.fileno()).st_size:
+                logging.warning(f"Discarding torn record at the end of {self.log_name}")
+                os.truncate(self.log_name, offset)
+            self._db, self._offset, self._log_id = db, offset, self._file_id(log)
+        except BaseException:
+            log.close()
+            raise
+        if self._log is not None:
+            self._log.close()
+        self._log = log
+
+    def open(self) -> dict:
+        """
+        Opens the database replaying the log over the snapshot
+        :return: Dictionary database
+        """
+        self.snapshot.open()
+        self.snapshot.invalidate()                  # the dictionary is kept here, not in the snapshot
+        self._remove_stale_compactions()
+        with self._lock:
+            self._full_load(repair=True)
+            logging.debug(f"Log replayed up to byte {self._offset}")
+            return self._db
+
+    def load(self) -> dict:
+        """
+        Loads the current database, reading only records appended since the last load.
+        Appends only make the log grow, so its size tells if there is anything new to read
+        :return: Dictionary database
+        """
+        with self._lock:
+            try:
+                stat = os.stat(self.log_name)
+                log_id, size = (stat.st_dev, stat.st_ino), stat.st_size
+            except FileNotFoundError:
+                log_id, size = None, 0
+            if self._db is None or log_id != self._log_id:
+                self._full_load()
+            elif size > self._offset:
+                self._offset = self._replay(self._log, self._db, self._offset)
+            return self._db
+
+    def persist(self, db, changes):
+        """
+        Appends one record per change to the log
+        :param db: Dictionary with the changes already applied
+        :param changes: List of (operation, key, value) applied to db
+        """
+        if not changes:
+            return
+        start = time.perf_counter_ns()
+        data = bytearray()
+        for change in changes:
+            payload = self._encode_change(change)
+            data += self.RECORD_HEADER.pack(len(payload), zlib.crc32(payload))
+            data += payload
+        self._measure("encode", start, len(data))
+        with self._lock:
+            with open(self.log_name, 'ab') as log:
+                log.write(data)
+            self._offset += len(data)
+            if self._offset >= self.compact_size and not self._bulk:
+                self._start_compaction()
+        self._committed()
+
+    def version(self):
+        """
+        Log file and how much of it the dictionary has applied
+        :return: Hashable version or None if nothing is loaded
+        """
+        with self._lock:
+            return (self._log_id, self._offset) if self._db is not None else None
+
+    def invalidate(self):
+        """ Forgets the in-memory dictionary so next load reads everything from file """
+        with self._lock:
+            self._db = None
+
+    @contextmanager
+    def bulk(self):
+        """
+        Context to append many changes in a row compacting the log once at the end: each compaction
+        copies and rewrites the whole dictionary, so one every compact_size bytes would make it quadratic
+        """
+        with self._lock:
+            self._bulk = True
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._bulk = False
+                if self._offset >= self.compact_size:
+                    self._start_compaction()
+
+    def _start_compaction(self):
+        """ Starts a background compaction if there isn't one running (called holding _lock) """
+        if self._compactor is None or not self._compactor.is_alive():
+            self._compactor = threading.Thread(target=self.compact, name="log_compactor", daemon=True)
+            self._compactor.start()
+
+    def _remove_stale_compactions(self):
+        """
+        Removes the temporary snapshots ('<file_name>.<pid>.compact' and its own temporary file) left by
+        processes that exited in the middle of a compaction
+        """
+        directory = os.path.dirname(os.path.abspath(self.file_name))
+        prefix = os.path.basename(self.file_name) + "."
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            if not name.startswith(prefix):
+                continue
+            pid, _, rest = name[len(prefix):].partition(".")
+            if rest.startswith("compact") and pid.isdigit() and not _process_alive(int(pid)):
+                try:
+                    os.remove(os.path.join(directory, name))
+                    logging.warning(f"Removed {name}, left by a compaction that didn't finish")
+                except FileNotFoundError:               # another process removed it first
+                    pass
+
+    def compact(self):
+        """
+        Folds the log into a new snapshot.
+        The snapshot is written without blocking writers, then records appended meanwhile are moved to
+        a new log and both files are replaced while holding the writers exclusion
+        """
+        temp_snapshot = f"{self.file_name}.{os.getpid()}.compact"      # compactions of other processes use their own
+        held = None
+        try:
+            with self._lock:
+                if self._db is None:
+                    self._full_load()
+                db, mark, log_id = self._db.copy(), self._offset, self._log_id
+                held = os.dup(self._log.fileno())       # no new log can take its identity meanwhile
+            self.snapshot.write(db, temp_snapshot)
+            with self.exclusive(), self._lock:
+                if self._path_id() != log_id:           # someone else compacted meanwhile
+                    os.remove(temp_snapshot)
+                    return
+                temp_log = self.log_name + ".compact"
+                with open(self.log_name, 'rb') as log, open(temp_log, 'wb') as new_log:
+                    log.seek(mark)
+                    tail = log.read()
+                    new_log.write(tail)
+                if self.durability != "os":             # the new files must be complete before replacing
+                    self._fsync_path(temp_snapshot)
+                    self._fsync_path(temp_log)
+                os.replace(temp_snapshot, self.file_name)
+                os.replace(temp_log, self.log_name)
+                if self.durability != "os":
+                    self._fsync_path(os.path.dirname(os.path.abspath(self.file_name)))
+                self._db = None                         # reload from the new files on next load
+            logging.debug(f"Log compacted into {self.file_name}")
+        except Exception as err:
+            logging.error(f"There was a problem compacting the log: {err}")
+            if os.path.exists(temp_snapshot):
+                os.remove(temp_snapshot)
+        finally:
+            if held is not None:
+                os.close(held)
+
+    def close(self):
+        """ Waits for a running compaction to finish and closes the log """
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+            self._db, self._log = None, None
@@ -4,154 +4,523 @@ Date: 25/12/2022
 Description: Synchronized database class for threads and processes
 """
 from file_database import FileDataBase
-import threading
+from dict_database import BATCH
+from rw_lock import ThreadRWLock, ProcessRWLock
+from metrics import Metrics
+from expiry import REAP_BATCH, live
+from change_feed import ChangeFeed
+from lazy_dict import load_hot_keys, WARM_BATCH
+from itertools import islice
+import bulk
+from contextlib import contextmanager
 import multiprocessing
+import threading
 import logging
+import time
+import os
 
 
 class SyncDataBase(FileDataBase):
     """
     Simple database thread/process synchronized
     """
-    # All the not_reading event part was commented out because it didn't work.
-    READERS_BOUND = 10
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.DEBUG)              # set the minimum logger level
+    _file_handler = None                        # handler shared by every instance, added by the first one
 
-    def __init__(self, mode, file_name="dbfile.bin"):
+    def __init__(self, mode, file_name="dbfile.bin", engine="snapshot", metrics=True, reap_interval=1.0,
+                 reap_batch=REAP_BATCH, feed=False, feed_retain=1 << 22, bloom=False, bloom_keys=None,
+                 bloom_fp=0.01, warm=False, **options):
         """
         Initializer for synchronized database class
         :param mode: Takes a flag 1 or 0 where this means threading or multiprocessing correspondingly
         :param file_name: Name of file for the database
+        :param engine: Storage engine of the file (see FileDataBase)
+        :param metrics: If latencies, lock times and bytes decoded/encoded are recorded for stats()
+        :param reap_interval: Seconds between rounds of the background reaper of expired keys (None: no reaper)
+        :param reap_batch: Maximum keys deleted holding the writer access once
+        :param feed: If committed changes are recorded in a change feed for followers (see replication)
+        :param feed_retain: Bytes of changes the feed keeps at least (see ChangeFeed)
+        :param bloom: If a Bloom filter of the keys answers deletes (and gets, but for the snapshot engine whose
+        reads are cheaper) of missing keys before any lock or file access. It is saved to '<file_name>.bloom'
+        on close, and every writer of the file must use it
+        :param bloom_keys: Number of keys the filter is sized for (None: twice the keys in the file)
+        :param bloom_fp: Target false positive rate of the filter
+        :param warm: If a background thread decodes the values of the keys read before the file was last closed,
+        when it is opened lazily (lazy=True option of the storage engine)
+        :param options: Options for the storage engine
         """
         if mode != 0 and mode != 1:
             raise TypeError("Not Corresponding type")
-        super().__init__(file_name)
-        # self.counter_readers = 0                                      # readers count
+        super().__init__(file_name, engine, **options)
         if mode:
-            self.not_writing = threading.Event()                        # Event to check if there are writers
-            self.to_write_lock = threading.Lock()                       # Lock to writers
-            self.semaphore = threading.Semaphore(SyncDataBase.READERS_BOUND)    # Semaphore to limit readers
-            # self.count_lock = threading.Lock()                        # Lock to change readers count
-            # self.not_reading = threading.Event()                      # Event to check if there are readers
-            # logging format
-            formatter = logging.Formatter("[%(filename)s][%(threadName)s][%(asctime)s] %(message)s")
+            self.rw_lock = ThreadRWLock()                               # readers-writer lock between threads
         else:                       # same attributes but in the multiprocessing module
-            self.not_writing = multiprocessing.Event()
-            self.to_write_lock = multiprocessing.Lock()
-            self.semaphore = multiprocessing.Semaphore(10)
-            # self.count_lock = multiprocessing.Lock()
-            # self.not_reading = multiprocessing.Event()
-            # logging format
-            formatter = logging.Formatter("[%(filename)s][%(processName)s][%(asctime)s] %(message)s")
-        # logger configuration
-        file_handler = logging.FileHandler("file_database.log")         # file to save the log
-        file_handler.setFormatter(formatter)
-        SyncDataBase.logger.addHandler(file_handler)
+            self.rw_lock = ProcessRWLock()
+            self.storage.generation = multiprocessing.RawValue('Q', 0)  # counts writes of all processes
+        # shared memory in mode 0 so stats() sees the numbers of every process
+        self.metrics = Metrics(shared=not mode) if metrics else None
+        self.rw_lock.metrics = self.storage.metrics = self.metrics
+        SyncDataBase._configure_logger()
         SyncDataBase.logger.info(f"Start in mode {mode}")
-        # setting not-events
-        self.not_writing.set()
-        # self.not_reading.set()
+        # background work of the storage (log compaction) must exclude writers too
+        self.storage.exclusive = self.rw_lock.write_locked
+        self.reap_interval = reap_interval
+        self.reap_batch = reap_batch
+        self._reaper = None                 # background thread deleting expired keys (this process only)
+        self._reaper_pid = None             # process that started it, a forked child starts its own
+        self._closing = threading.Event()
+        if reap_interval:                   # keys set with a ttl before opening (or by exited processes)
+            self._seed_expiry()
+            if len(self._expiry):
+                self._start_reaper()
+        if bloom:                           # in shared memory in mode 0, so every process sees the keys added
+            self._open_bloom(bloom_keys, bloom_fp, shared=not mode)
+        if feed:                            # appended holding the writer access, durable as the storage is
+            self.feed = ChangeFeed(file_name, feed_retain, fsync=self.storage.durability != "os")
+        self._warmer = None
+        if warm and self.storage.lazy:
+            self._warmer = threading.Thread(target=self._warm_up, args=(load_hot_keys(self.hot_name),),
+                                            name="warmer", daemon=True)
+            self._warmer.start()
+
+    @classmethod
+    def _configure_logger(cls):
+        """
+        Adds the file handler of the logger once for all instances
+        """
+        if cls._file_handler is None:
+            cls._file_handler = logging.FileHandler("file_database.log")     # file to save the log
+            cls._file_handler.setFormatter(
+                logging.Formatter("[%(filename)s][%(processName)s][%(threadName)s][%(asctime)s] %(message)s"))
+            cls.logger.addHandler(cls._file_handler)
+
+    def stats(self) -> dict:
+        """
+        Metrics of the database (of all processes in mode 0): latency histograms of get, set, delete and
+        update (also increment and compare_and_set),
+        time waiting for the readers-writer lock separate from time holding it and time and bytes
+        decoding/encoding the database file
+        :return: Dictionary of histogram name: count, total_ms, mean_us, p50_us and p99_us, and byte counters
+        """
+        return self.metrics.stats() if self.metrics is not None else {}
 
-    def set_value(self, key, val) -> bool:
+    def _locked(self, name, write, method, *args):
+        """
+        Runs an operation holding the lock, recording its latency and the time waiting for the lock
+        and holding it. Writers wait for durability after releasing the lock to share a group commit
+        :param name: Histogram of the operation
+        :param write: If the writer access is needed (reader access otherwise)
+        :param method: Method doing the operation
+        :param args: Arguments of the method
+        :return: Result of the method
+        """
+        rw_lock = self.rw_lock
+        start = time.perf_counter_ns()
+        rw_lock.acquire_write() if write else rw_lock.acquire_read()
+        acquired = time.perf_counter_ns()
+        try:
+            result = method(*args)
+        finally:
+            released = time.perf_counter_ns()
+            rw_lock.release_write() if write else rw_lock.release_read()
+        if write:
+            self.storage.wait_durable()
+        if self.metrics is not None:
+            self.metrics.observe_locked(name, "write" if write else "read", start, acquired, released,
+                                        time.perf_counter_ns())
+        return result
+
+    def _unlocked(self, name, method, *args):
+        """
+        Runs a read without any lock (storage engines with lock_free_reads), recording its latency
+        :param name: Histogram of the operation
+        :param method: Method doing the operation
+        :param args: Arguments of the method
+        :return: Result of the method
+        """
+        start = time.perf_counter_ns()
+        result = method(*args)
+        if self.metrics is not None:
+            self.metrics.observe(name, time.perf_counter_ns() - start)
+        return result
+
+    def _absent(self, name, key) -> bool:
+        """
+        If the Bloom filter tells a key isn't in the database, recording the operation it answered
+        :param name: Histogram of the operation
+        :param key: Key for the database
+        :return: True if the key is certainly missing
+        """
+        bloom = self.bloom
+        if bloom is None:
+            return False
+        start = time.perf_counter_ns()
+        if bloom.may_contain(key):
+            return False
+        if self.metrics is not None:
+            self.metrics.observe(name, time.perf_counter_ns() - start)
+            self.metrics.add("bloom_skips", 1)
+        return True
+
+    def set_value(self, key, val, ttl=None) -> bool:
         """
         Sets new key:value to database in file synchronized
         :param key: Key for the database
         :param val: Value of the key
+        :param ttl: Seconds until the key expires (None: never), the reaper deletes it afterwards
         :return: If the operation was successful
         """
-        self.to_write_lock.acquire()                        # blocks for writers
-        self.not_writing.clear()                            # event: someone wants to write
-        for i in range(10):                                 # fills all the semaphore buffer to write
-            self.semaphore.acquire()
         try:
-            # self.not_reading.wait()                         # waits for readers to finish
-            is_set = super().set_value(key, val)
+            return self._locked("set", True, super().set_value, key, val, ttl)
         except Exception as err:
             SyncDataBase.logger.error(f"Error setting key<{key}> to value<{val}>: {err}")
             raise err
-        finally:
-            for i in range(10):                             # releases all the semaphore buffer
-                self.semaphore.release()
-            self.not_writing.set()                          # event: stopped writing
-            self.to_write_lock.release()                    # release for writers
-        return is_set
 
     def get_value(self, key):
         """
-        Gets value according to the key of the database in file synchronized
+        Gets value according to the key of the database in file synchronized.
+        With the snapshot engine it reads the last committed version without any lock, with others a key
+        the Bloom filter tells is missing is answered without the lock
         If key doesn't exist None is returned
         :param key: Key for the database element
         :return: Value from the database if found
         """
-        self.not_writing.wait()                             # wait for writer to finish
-        # self._update_counter(1)                           # increases reader counter
-        self.semaphore.acquire()                            # acquires semaphore to read
         try:
-            val = super().get_value(key)
+            if self.storage.lock_free_reads:      # cheaper than asking the Bloom filter
+                return live(self._unlocked("get", self.storage.load().get, key))
+            if self._absent("get", key):
+                return None
+            return self._locked("get", False, super().get_value, key)
         except Exception as err:
             SyncDataBase.logger.error(f"Error getting key<{key}>: {err}")
             raise err
-        finally:
-            self.semaphore.release()                        # releases semaphore
-            # self._update_counter(-1)                      # decreases reader counter
-        return val
 
     def delete_value(self, key):
         """
-        Deletes value from database in file synchronized
+        Deletes value from database in file synchronized. A key the Bloom filter tells is missing is
+        answered without the writer access
         :param key: Key for a database value
         :return: Deleted value if existed
         """
-        self.to_write_lock.acquire()                        # blocks for writers
-        for i in range(10):                                 # fills all the semaphore buffer to write
-            self.semaphore.acquire()
         try:
-            # self.not_reading.wait()                       # event: someone wants to write
-            self.not_writing.clear()                        # waits for readers to finish
-            deleted = super().delete_value(key)
+            if self._absent("delete", key):
+                return None
+            return self._locked("delete", True, super().delete_value, key)
         except Exception as err:
             SyncDataBase.logger.error(f"Error deleting key<{key}>: {err}")
             raise err
-        finally:
-            for i in range(10):                             # releases all the semaphore buffer
-                self.semaphore.release()
-            self.not_writing.set()                          # event: stopped writing
-            self.to_write_lock.release()                    # release for writers
-        return deleted
 
-    def _set_value_testing(self, key) -> bool:
-        """ Special set_value modification to change previous value of key in dictionary by one"""
-        self.to_write_lock.acquire()                        # blocks for writers
-        self.not_writing.clear()                            # event: someone wants to write
-        for i in range(10):                                 # fills all the semaphore buffer to write
-            self.semaphore.acquire()
+    def update(self, key, fn):
+        """
+        Sets a key to a function of its current value holding the writer access: one load and one persist
+        :param key: Key for the database
+        :param fn: Function taking the current value (None if the key doesn't exist) and returning the new one
+        :return: New value
+        """
         try:
-            # self.not_reading.wait()                       # waits for readers to finish
-            val = super().get_value(key)
-            is_set = super().set_value(key, val + 1)
+            return self._locked("update", True, super().update, key, fn)
         except Exception as err:
-            SyncDataBase.logger.error(f"Error setting (test) key<{key}>: {err}")
+            SyncDataBase.logger.error(f"Error updating key<{key}>: {err}")
             raise err
-        finally:
-            for i in range(10):                             # releases all the semaphore buffer
-                self.semaphore.release()
-            self.not_writing.set()                          # event: stopped writing
-            self.to_write_lock.release()                    # release for writers
-        return is_set
 
-    # Didn't work. Ignore it
-    # def _update_counter(self, factor: int):
-    #     """
-    #     Updates reading counter according to if reader will acquire or release
-    #     :param factor: 1 if acquired and -1 if released
-    #     """
-    #     self.count_lock.acquire()
-    #     try:
-    #         self.counter_readers += factor
-    #     finally:
-    #         self.count_lock.release()
-    #     if self.counter_readers:
-    #         self.not_reading.clear()
-    #     else:
-    #         self.not_reading.set()
+    def compare_and_set(self, key, expected, new) -> bool:
+        """
+        Sets a key only if its current value is the expected one, holding the writer access
+        :param key: Key for the database
+        :param expected: Value the key must have (None if it must not exist)
+        :param new: Value to set
+        :return: If the value was set
+        """
+        try:
+            return self._locked("update", True, super().compare_and_set, key, expected, new)
+        except Exception as err:
+            SyncDataBase.logger.error(f"Error comparing and setting key<{key}>: {err}")
+            raise err
+
+    def _await_durable(self):
+        """
+        Writers wait for durability after releasing the lock (see set_value), not while holding it
+        """
+
+    def get_many(self, keys) -> dict:
+        """
+        Gets values of several keys synchronized from one version of the database, acquiring the reader
+        access once (or none with the snapshot engine)
+        :param keys: Iterable of keys for the database
+        :return: Dictionary of key:value for each key
+        """
+        if self.storage.lock_free_reads:
+            try:
+                db = self.storage.load()
+                now = time.time()
+                return {key: live(db.get(key), now) for key in keys}
+            except Exception as err:
+                SyncDataBase.logger.error(f"Error getting many keys: {err}")
+                raise err
+        with self.rw_lock.read_locked():
+            try:
+                return super().get_many(keys)
+            except Exception as err:
+                SyncDataBase.logger.error(f"Error getting many keys: {err}")
+                raise err
+
+    def delete_many(self, keys) -> dict:
+        """
+        Deletes several values synchronized in one transaction, skipping the keys the Bloom filter
+        tells are missing (no transaction at all if none may exist)
+        :param keys: Iterable of keys for database values
+        :return: Dictionary of key:deleted value (None if it didn't exist)
+        """
+        if self.bloom is None:
+            return super().delete_many(keys)
+        keys = list(keys)
+        present = [key for key in keys if self.bloom.may_contain(key)]
+        if self.metrics is not None and len(present) < len(keys):
+            self.metrics.add("bloom_skips", len(keys) - len(present))
+        deleted = super().delete_many(present) if present else {}
+        return {key: deleted.get(key) for key in keys}
+
+    def _expire(self, key, deadline):
+        """
+        Records a key set with a ttl (holding the writer access) and starts the reaper of this process
+        :param key: Key for the database
+        :param deadline: time.time() when it expires
+        """
+        super()._expire(key, deadline)
+        self._start_reaper()
+
+    def _start_reaper(self):
+        """
+        Starts the background reaper of this process if it isn't running yet (and isn't disabled)
+        """
+        if self.reap_interval and self._reaper_pid != os.getpid() and not self._closing.is_set():
+            self._reaper_pid = os.getpid()
+            self._reaper = threading.Thread(target=self._reap_loop, name="reaper", daemon=True)
+            self._reaper.start()
+
+    def _seed_expiry(self):
+        """
+        Pushes to the expiry heap the expiring keys in the file, holding the reader access
+        (or none with the snapshot engine)
+        """
+        if self.storage.lock_free_reads:
+            super()._seed_expiry()
+        else:
+            with self.rw_lock.read_locked():
+                super()._seed_expiry()
+
+    def _warm(self, keys):
+        """
+        Decodes the values of some keys holding the reader access (or none with the snapshot engine)
+        :param keys: Iterable of keys
+        """
+        if self.storage.lock_free_reads:
+            super()._warm(keys)
+        else:
+            with self.rw_lock.read_locked():
+                super()._warm(keys)
+
+    def _warm_up(self, keys):
+        """
+        Background warm-up: decodes the values of hot keys in batches of WARM_BATCH until done or closed,
+        so readers are never kept waiting long
+        :param keys: List of keys
+        """
+        start = time.perf_counter()
+        keys = iter(keys)
+        warmed = 0
+        try:
+            while not self._closing.is_set():
+                batch = list(islice(keys, WARM_BATCH))
+                if not batch:
+                    break
+                self._warm(batch)
+                warmed += len(batch)
+        except Exception as err:
+            SyncDataBase.logger.error(f"Error warming up values: {err}")
+        SyncDataBase.logger.info(f"Warmed up {warmed} values in {time.perf_counter() - start:.2f} s")
+
+    def reap(self, limit=REAP_BATCH) -> int:
+        """
+        Deletes up to limit expired keys holding the writer access once (see DataBase.reap)
+        :param limit: Maximum number of keys to delete
+        :return: Number of keys deleted
+        """
+        try:
+            return super().reap(limit)
+        except Exception as err:
+            SyncDataBase.logger.error(f"Error reaping expired keys: {err}")
+            raise err
+
+    def _reap_loop(self):
+        """
+        Background reaper: every reap_interval seconds deletes the keys that expired, in batches of
+        reap_batch keys releasing the writer access between batches
+        """
+        while not self._closing.wait(self.reap_interval):
+            try:
+                reaped = self.reap(self.reap_batch)
+                while reaped and self._expiry.due(time.time()) and not self._closing.is_set():
+                    reaped = self.reap(self.reap_batch)
+            except Exception:
+                pass                        # logged by reap, tried again next round
+
+    def close(self):
+        """
+        Stops the reaper and the warm-up and releases resources of the storage engine
+        """
+        self._closing.set()
+        if self._reaper is not None and self._reaper_pid == os.getpid():
+            self._reaper.join()
+        if self._warmer is not None and self._warmer.is_alive():
+            self._warmer.join()
+        super().close()
+
+    def _consistent(self, name, scan, *args):
+        """
+        Streams a scan from one version of the database. The snapshot engine scans its last committed
+        version without any lock, other engines hold the reader access until the generator is exhausted
+        or closed, so writers wait for it (don't write from the thread while it is being consumed)
+        :param name: Name of the scan for the log
+        :param scan: Generator method of DataBase doing the scan
+        :param args: Arguments of the scan
+        :return: Generator of the results of the scan
+        """
+        try:
+            if self.storage.lock_free_reads:
+                yield from scan(*args)
+                return
+            with self.rw_lock.read_locked():
+                yield from scan(*args)
+        except Exception as err:
+            SyncDataBase.logger.error(f"Error in {name}: {err}")
+            raise err
+
+    def keys(self):
+        """
+        Streams the keys in order from one version of the database (see DataBase.keys and _consistent)
+        :return: Generator of keys
+        """
+        return self._consistent("keys", super().keys)
+
+    def items(self, batch=BATCH):
+        """
+        Streams the key:value pairs in order from one version of the database (see _consistent)
+        :param batch: Number of values read together
+        :return: Generator of (key, value)
+        """
+        return self._consistent("items", super().items, batch)
+
+    def scan(self, start=None, end=None, batch=BATCH):
+        """
+        Streams the key:value pairs with keys from start (included) to end (excluded) from one version
+        of the database (see DataBase.scan and _consistent)
+        :param start: First key or None from the first one
+        :param end: Key where to stop or None until the last one
+        :param batch: Number of values read together
+        :return: Generator of (key, value)
+        """
+        return self._consistent("scan", super().scan, start, end, batch)
+
+    def prefix(self, prefix, batch=BATCH):
+        """
+        Streams the key:value pairs with keys starting with a prefix from one version of the database
+        (see _consistent)
+        :param prefix: str or bytes the keys start with
+        :param batch: Number of values read together
+        :return: Generator of (key, value)
+        """
+        return self._consistent("prefix", super().prefix, prefix, batch)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups changes synchronized: the writer access is held for the whole block, the file
+        is read once and written once. If an exception is raised inside the block nothing is applied.
+        Inside the block the database must be used only through the transaction, not the database itself
+        :return: Transaction where to make the changes
+        """
+        with self.rw_lock.write_locked():
+            try:
+                with super().transaction() as txn:
+                    yield txn
+            except Exception as err:
+                SyncDataBase.logger.error(f"Error in transaction: {err}")
+                raise err
+        self.storage.wait_durable()
+
+    def import_from(self, source, format=None, chunk=bulk.CHUNK, workers=0) -> int:
+        """
+        Sets the records of a file or an iterable streaming them (see FileDataBase.import_from), holding the
+        writer access for the whole import
+        :param source: Path of a file, or an iterable of lines ('jsonl', 'csv') or of (key, value) pairs ('pickle')
+        :param format: 'jsonl', 'csv', 'pickle' or None to use the suffix of the path
+        :param chunk: Records applied together
+        :param workers: Processes parsing JSON lines (0: parses in this process)
+        :return: Number of records imported
+        """
+        with self.rw_lock.write_locked():
+            try:
+                count = super().import_from(source, format, chunk, workers)
+            except Exception as err:
+                SyncDataBase.logger.error(f"Error importing records: {err}")
+                raise err
+        self.storage.wait_durable()
+        return count
+
+    def export_to(self, path, format=None, chunk=bulk.CHUNK) -> int:
+        """
+        Writes the key:value pairs to a file streaming them from one version of the database, holding
+        the reader access (or none with the snapshot engine) until it is written
+        :param path: Path of the file
+        :param format: 'jsonl', 'csv', 'pickle' or None to use the suffix of the path
+        :param chunk: Records written together
+        :return: Number of records exported
+        """
+        try:
+            if self.storage.lock_free_reads:
+                return super().export_to(path, format, chunk)
+            with self.rw_lock.read_locked():
+                return super().export_to(path, format, chunk)
+        except Exception as err:
+            SyncDataBase.logger.error(f"Error exporting records: {err}")
+            raise err
+
+    def feed_snapshot(self):
+        """
+        Copy of the database with the sequence number of the last change of the feed included in it,
+        from which a new follower catches up. Stored values are copied as they are (with their expiry)
+        :return: (sequence number, dictionary)
+        """
+        if self.feed is None:
+            raise ValueError("The database has no change feed")
+        with self.rw_lock.read_locked():
+            try:
+                return self.feed.last_seq(), dict(self.storage.load().items())
+            except Exception as err:
+                SyncDataBase.logger.error(f"Error taking a feed snapshot: {err}")
+                raise err
+
+    def changes(self, after):
+        """
+        Reader of the changes committed after a sequence number, in order
+        :param after: Last sequence number the reader already has
+        :return: FeedCursor
+        :raise FeedTruncated: if those changes are no longer in the feed (a snapshot is needed)
+        """
+        if self.feed is None:
+            raise ValueError("The database has no change feed")
+        return self.feed.cursor(after)
+
+    def _set_value_testing(self, key) -> bool:
+        """ Special set_value modification to change previous value of key in dictionary by one"""
+        with self.rw_lock.write_locked():
+            try:
+                val = super().get_value(key)
+                is_set = super().set_value(key, val + 1)
+            except Exception as err:
+                SyncDataBase.logger.error(f"Error setting (test) key<{key}>: {err}")
+                raise err
+        self.storage.wait_durable()
+        return is_set
@@ -4,11 +4,32 @@ Date: 27/12/2022
 Description: Test file for threading and multiprocessing synchronized
 """
 from sync_database import SyncDataBase
+from file_database import FileDataBase
+from storage import SnapshotStorage, LogStorage, SET
+from sharded_database import ShardedSyncDataBase
+from async_database import AsyncDataBase
+from db_codecs import MAGIC, OUT_OF_BAND_SIZE, Compression
+import benchmark
+from db_server import DataBaseServer, pack_frame, read_frame, SET_VALUE, ERROR
+from db_client import DataBaseClient, connect
+from replication import Follower
+from change_feed import ChangeFeed, FeedTruncated
+from bloom_filter import BloomFilter, MIN_KEYS
+from lazy_dict import LazyDict
+from rw_lock import ThreadRWLock, ProcessRWLock, WAITING_WRITERS
+from unittest import mock
 from random import randint
 import multiprocessing
 import threading
 import unittest
+import logging
+import tempfile
+import asyncio
 import pickle
+import socket
+import json
+import csv
+import time
 import os
 
 
@@ -73,7 +94,7 @@ class TestThreadDB(unittest.TestCase):
 
     def test_general(self):
         """ Tests of 12 threads trying to read and write (9 read and 3 that do both) changes correctly """
-        randbers = [randint(21, 51)] * 3          # 1 random numbers between 21 and 50. 3 times in list
+        randbers = [randint(21, 50)] * 3          # 1 random numbers between 21 and 50. 3 times in list
         threads = []
         # append 9 reading threads between 3 random numbers
         for i in range(1, 10):
@@ -164,7 +185,7 @@ class TestProcessDB(unittest.TestCase):
 
     def test_general(self):
         """ Tests of 12 processes trying to read and write (9 read and 3 that do both) changes correctly """
-        randbers = [randint(21, 51)] * 3  # 1 random numbers between 21 and 50. 3 times in list
+        randbers = [randint(21, 50)] * 3  # 1 random numbers between 21 and 50. 3 times in list
         procs = []
         # append 9 reading processes between 3 random numbers
         for i in range(1, 10):
@@ -200,5 +221,1619 @@ class TestProcessDB(unittest.TestCase):
         self.__dict__.update(self_dict)
 
 
+class TestRWLock(unittest.TestCase):
+    """ Class to test the readers-writer lock """
+
+    def test_unlimited_readers(self):
+        """ Tests 20 readers hold the lock at the same time """
+        rw_lock = ThreadRWLock()
+        barrier = threading.Barrier(20, timeout=5)
+
+        def read():
+            with rw_lock.read_locked():
+                barrier.wait()
+        threads = [threading.Thread(target=read) for _ in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertFalse(barrier.broken)
+
+    def test_writer_preferred(self):
+        """ Tests a new reader waits behind a waiting writer, for threads and processes """
+        for rw_lock, worker in ((ThreadRWLock(), threading.Thread), (ProcessRWLock(), multiprocessing.Process)):
+            rw_lock.acquire_read()
+            writer = worker(target=rw_lock.acquire_write)
+            writer.start()
+            while not rw_lock._state[WAITING_WRITERS]:      # waits until the writer is waiting
+                time.sleep(0.001)
+            reader = threading.Thread(target=rw_lock.acquire_read)
+            reader.start()
+            reader.join(0.1)
+            self.assertTrue(reader.is_alive())              # reader blocked behind the writer
+            rw_lock.release_read()
+            writer.join()
+            rw_lock.release_write()                         # the writer exited holding it
+            reader.join(5)
+            self.assertFalse(reader.is_alive())
+
+
+class TestReadCache(unittest.TestCase):
+    """ Class to test that reads are served from memory until the file changes """
+    test_fname = "testfile.bin"
+
+    def setUp(self):
+        """
+        sets up the testing file with a specific dictionary
+        """
+        self.test_dict = {n: n * 100 for n in range(1, 51)}
+        with open(TestReadCache.test_fname, "wb") as f:
+            pickle.dump(self.test_dict, f)
+
+    def set_value(self, key, val):
+        """ Sets a value from another process """
+        self.sync_db.set_value(key, val)
+
+    def test_reads_do_not_unpickle(self):
+        """ Tests repeated reads without writes do not read the file again """
+        self.sync_db = SyncDataBase(1, TestReadCache.test_fname)
+        with mock.patch.object(SnapshotStorage, "read", autospec=True, side_effect=SnapshotStorage.read) as read:
+            for _ in range(100):
+                self.assertEqual(self.sync_db.get_value(40), 4000)
+            self.assertTrue(self.sync_db.set_value(40, 4001))
+            self.assertEqual(self.sync_db.get_value(40), 4001)
+        self.assertEqual(read.call_count, 0)
+
+    def test_write_from_other_process(self):
+        """ Tests a write of the same size from another process is seen by a cached reader """
+        self.sync_db = SyncDataBase(0, TestReadCache.test_fname)
+        self.assertEqual(self.sync_db.get_value(40), 4000)
+        for val in (4001, 4002, 4003):
+            proc = multiprocessing.Process(target=self.set_value, args=(40, val))
+            proc.start()
+            proc.join()
+            self.assertEqual(self.sync_db.get_value(40), val)
+
+    def tearDown(self):
+        """
+        Deletes the testing file
+        """
+        os.remove(TestReadCache.test_fname)
+
+    def __getstate__(self):
+        self_dict = self.__dict__.copy()
+        del self_dict['_outcome']
+        return self_dict
+
+
+class TestBatch(unittest.TestCase):
+    """ Class to test batch operations and transactions """
+    test_fname = "testfile.bin"
+    reps = 200
+
+    def increase_pair(self, first, second):
+        """ Increases two values by one in the same transaction reps times """
+        for _ in range(TestBatch.reps):
+            with self.sync_db.transaction() as txn:
+                values = txn.get_many([first, second])
+                txn.set_many({key: val + 1 for key, val in values.items()})
+
+    def setUp(self):
+        """
+        sets up the testing file with a specific dictionary
+        """
+        self.test_dict = {n: n * 100 for n in range(1, 51)}
+        with open(TestBatch.test_fname, "wb") as f:
+            pickle.dump(self.test_dict, f)
+
+    def test_many(self):
+        """ Tests set_many, get_many and delete_many write the file once """
+        self.sync_db = SyncDataBase(1, TestBatch.test_fname)
+        with mock.patch.object(SnapshotStorage, "write", autospec=True, side_effect=SnapshotStorage.write) as write:
+            self.assertTrue(self.sync_db.set_many({n: -n for n in range(1, 21)}))
+            self.assertEqual(self.sync_db.delete_many([1, 2, 100]), {1: -1, 2: -2, 100: None})
+        self.assertEqual(write.call_count, 2)
+        self.assertEqual(self.sync_db.get_many([2, 3, 30]), {2: None, 3: -3, 30: 3000})
+        self.test_dict.update({n: -n for n in range(3, 21)})
+        del self.test_dict[1], self.test_dict[2]
+        self.assertEqual(TestThreadDB.get_database_dict(), self.test_dict)
+
+    def test_rollback(self):
+        """ Tests an exception inside a transaction leaves the database untouched """
+        self.sync_db = SyncDataBase(1, TestBatch.test_fname)
+        with self.assertRaises(KeyError):
+            with self.sync_db.transaction() as txn:
+                txn.set_value(1, "a")
+                txn.delete_value(2)
+                raise KeyError(3)
+        self.assertEqual(self.sync_db.get_many([1, 2]), {1: 100, 2: 200})
+        self.assertEqual(TestThreadDB.get_database_dict(), self.test_dict)
+
+    def test_failed_set_many(self):
+        """ Tests a set_many or transaction with a value that can't be serialized changes nothing, with every engine """
+        for engine in ("snapshot", "log", "hash"):
+            with self.subTest(engine=engine):
+                self.setUp()
+                database = FileDataBase(TestBatch.test_fname, engine)
+                with self.assertRaises(TypeError):
+                    database.set_many([("x", 1), ("y", threading.Lock()), ("z", 3)])
+                with self.assertRaises(TypeError):
+                    with database.transaction() as txn:
+                        txn.delete_value(1)
+                        txn.set_value("y", threading.Lock())
+                self.assertEqual(database.get_many(["x", "z", 1]), {"x": None, "z": None, 1: 100})
+                database.close()
+                database = FileDataBase(TestBatch.test_fname, engine)
+                self.assertEqual(database.get_many(["x", "z", 1]), {"x": None, "z": None, 1: 100})
+                self.assertEqual(len(database.storage.load()), 50)
+                database.close()
+                if os.path.exists(TestBatch.test_fname + ".log"):
+                    os.remove(TestBatch.test_fname + ".log")
+
+    def test_transactions(self):
+        """ Tests 3 threads and 3 processes increasing a pair of values inside transactions """
+        for mode, worker in ((1, threading.Thread), (0, multiprocessing.Process)):
+            self.sync_db = SyncDataBase(mode, TestBatch.test_fname)
+            workers = [worker(target=self.increase_pair, args=(10, 20)) for _ in range(3)]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            self.test_dict[10] += 3 * TestBatch.reps
+            self.test_dict[20] += 3 * TestBatch.reps
+            self.assertEqual(TestThreadDB.get_database_dict(), self.test_dict)
+
+    def tearDown(self):
+        """
+        Deletes the testing file
+        """
+        os.remove(TestBatch.test_fname)
+
+    def __getstate__(self):
+        self_dict = self.__dict__.copy()
+        del self_dict['_outcome']
+        return self_dict
+
+
+class TestLogEngine(unittest.TestCase):
+    """ Class to test the append-only log storage engine under threads and processes """
+    test_fname = "testfile.bin"
+    reps = 500
+
+    def increase(self, key):
+        """ Increases value of key by one reps times """
+        for _ in range(TestLogEngine.reps):
+            self.sync_db._set_value_testing(key)
+
+    def setUp(self):
+        """
+        sets up the testing file with a specific dictionary
+        """
+        self.test_dict = {n: n * 100 for n in range(1, 51)}
+        with open(TestLogEngine.test_fname, "wb") as f:
+            pickle.dump(self.test_dict, f)
+
+    def reopened_dict(self):
+        """
+        Opens the database again from its files
+        :return: Dictionary replayed from snapshot and log
+        """
+        self.sync_db.close()
+        return FileDataBase(TestLogEngine.test_fname, engine="log").storage.load()
+
+    def test_threads_with_compaction(self):
+        """ Tests 3 threads increasing a value while the log is compacted several times """
+        self.sync_db = SyncDataBase(1, TestLogEngine.test_fname, engine="log", compact_size=4096)
+        threads = [threading.Thread(target=self.increase, args=(30,)) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.test_dict[30] += 3 * TestLogEngine.reps
+        self.assertEqual(self.sync_db.get_value(30), self.test_dict[30])
+        self.assertEqual(self.reopened_dict(), self.test_dict)
+        self.assertLess(os.path.getsize(TestLogEngine.test_fname + ".log"), 3 * TestLogEngine.reps * 20)
+
+    def test_processes(self):
+        """ Tests 3 processes increasing a value through the log """
+        self.sync_db = SyncDataBase(0, TestLogEngine.test_fname, engine="log", compact_size=4096)
+        procs = [multiprocessing.Process(target=self.increase, args=(30,)) for _ in range(3)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        self.test_dict[30] += 3 * TestLogEngine.reps
+        self.assertEqual(self.sync_db.get_value(30), self.test_dict[30])
+        self.assertEqual(self.reopened_dict(), self.test_dict)
+
+    def test_torn_record(self):
+        """ Tests a partially written record at the end of the log is discarded when opening """
+        self.sync_db = SyncDataBase(1, TestLogEngine.test_fname, engine="log")
+        self.sync_db.set_value(1, "a")
+        with open(TestLogEngine.test_fname + ".log", "ab") as f:
+            f.write(b"\x00\x00\x01")
+        self.test_dict[1] = "a"
+        self.assertEqual(self.reopened_dict(), self.test_dict)
+        self.assertTrue(self.sync_db.set_value(2, "b"))
+        self.test_dict[2] = "b"
+        self.assertEqual(self.reopened_dict(), self.test_dict)
+
+    def test_stale_compaction(self):
+        """ Tests opening removes the temporary snapshots of compactions of processes that exited """
+        exited = multiprocessing.Process(target=time.sleep, args=(0,))
+        exited.start()
+        exited.join()
+        stale = [f"{TestLogEngine.test_fname}.{exited.pid}.compact",
+                 f"{TestLogEngine.test_fname}.{exited.pid}.compact.{exited.pid}.tmp"]
+        running = f"{TestLogEngine.test_fname}.{os.getpid()}.compact"
+        for name in stale + [running]:
+            with open(name, "wb") as f:
+                f.write(b"snapshot")
+        self.sync_db = SyncDataBase(1, TestLogEngine.test_fname, engine="log")
+        self.assertEqual([os.path.exists(name) for name in stale + [running]], [False, False, True])
+        os.remove(running)
+        self.sync_db.close()
+
+    def tearDown(self):
+        """
+        Deletes the testing files
+        """
+        os.remove(TestLogEngine.test_fname)
+        os.remove(TestLogEngine.test_fname + ".log")
+
+    def __getstate__(self):
+        self_dict = self.__dict__.copy()
+        del self_dict['_outcome']
+        return self_dict
+
+
+class TestHashEngine(unittest.TestCase):
+    """ Class to test the memory-mapped hash storage engine """
+    test_fname = "testfile.bin"
+    reps = 300
+
+    def increase(self, key):
+        """ Increases value of key by one reps times """
+        for _ in range(TestHashEngine.reps):
+            self.sync_db._set_value_testing(key)
+
+    def setUp(self):
+        """
+        sets up the testing file with a pickled dictionary, converted to a hash file when opened
+        """
+        self.test_dict = {n: n * 100 for n in range(1, 51)}
+        with open(TestHashEngine.test_fname, "wb") as f:
+            pickle.dump(self.test_dict, f)
+
+    def reopened_dict(self):
+        """
+        Opens the database again from its file
+        :return: Dictionary in the hash file
+        """
+        self.sync_db.close()
+        database = FileDataBase(TestHashEngine.test_fname, engine="hash")
+        try:
+            return dict(database.db.items())
+        finally:
+            database.close()
+
+    def test_operations(self):
+        """ Tests conversion, set, get, delete and growing the table past its buckets """
+        self.sync_db = SyncDataBase(1, TestHashEngine.test_fname, engine="hash", buckets=16)
+        self.assertEqual(self.sync_db.get_value(40), 4000)
+        self.assertIsNone(self.sync_db.get_value(51))
+        self.assertEqual(self.sync_db.delete_value(40), 4000)
+        self.assertIsNone(self.sync_db.delete_value(40))
+        self.assertTrue(self.sync_db.set_many({f"key{n}": b"x" * n for n in range(2000)}))
+        self.assertTrue(self.sync_db.set_value(1, "one"))
+        del self.test_dict[40]
+        self.test_dict.update({f"key{n}": b"x" * n for n in range(2000)})
+        self.test_dict[1] = "one"
+        self.assertEqual(len(self.sync_db.db), len(self.test_dict))
+        self.assertEqual(self.reopened_dict(), self.test_dict)
+
+    def test_processes(self):
+        """ Tests 3 processes increasing a value in place while another process grows the file """
+        self.sync_db = SyncDataBase(0, TestHashEngine.test_fname, engine="hash", buckets=16)
+        procs = [multiprocessing.Process(target=self.increase, args=(30,)) for _ in range(3)]
+        procs.append(multiprocessing.Process(target=self.sync_db.set_many, args=({n: n for n in range(51, 500)},)))
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        self.test_dict[30] += 3 * TestHashEngine.reps
+        self.test_dict.update({n: n for n in range(51, 500)})
+        self.assertEqual(self.sync_db.get_value(30), self.test_dict[30])
+        self.assertEqual(self.reopened_dict(), self.test_dict)
+
+    def tearDown(self):
+        """
+        Deletes the testing file
+        """
+        os.remove(TestHashEngine.test_fname)
+
+    def __getstate__(self):
+        self_dict = self.__dict__.copy()
+        del self_dict['_outcome']
+        return self_dict
+
+
+class TestSharded(unittest.TestCase):
+    """ Class to test the sharded synchronized database """
+    test_fname = "testfile.bin"
+    reps = 300
+
+    def increase(self, key):
+        """ Increases value of key by one reps times """
+        for _ in range(TestSharded.reps):
+            with self.sharded_db._shard(key).transaction() as txn:
+                txn.set_value(key, txn.get_value(key) + 1)
+
+    def test_threads_and_processes(self):
+        """ Tests threads and then processes increasing values that live in different shards """
+        keys = list(range(1, 9))
+        for mode, worker in ((1, threading.Thread), (0, multiprocessing.Process)):
+            self.sharded_db = ShardedSyncDataBase(mode, TestSharded.test_fname, shards=4)
+            if mode:
+                self.assertTrue(self.sharded_db.set_many({key: 0 for key in keys}))
+            self.assertGreater(len({self.sharded_db._shard(key) for key in keys}), 1)
+            workers = [worker(target=self.increase, args=(key,)) for key in keys]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            self.sharded_db.close()
+        reopened = ShardedSyncDataBase(1, TestSharded.test_fname, shards=4)
+        self.assertEqual(reopened.snapshot(), {key: 2 * TestSharded.reps for key in keys})
+        self.assertEqual(sorted(reopened), keys)
+
+    def test_shard_count_mismatch(self):
+        """ Tests opening with another number of shards is refused """
+        ShardedSyncDataBase(1, TestSharded.test_fname, shards=4)
+        with self.assertRaises(ValueError):
+            ShardedSyncDataBase(1, TestSharded.test_fname, shards=2)
+
+    def tearDown(self):
+        """
+        Deletes the testing files
+        """
+        os.remove(TestSharded.test_fname)
+        for i in range(4):
+            os.remove(f"{TestSharded.test_fname}.{i}")
+
+    def __getstate__(self):
+        self_dict = self.__dict__.copy()
+        del self_dict['_outcome']
+        return self_dict
+
+
+class TestDurability(unittest.TestCase):
+    """ Class to test the durability policies """
+    test_fname = "testfile.bin"
+    reps = 50
+
+    def set_values(self, first):
+        """ Sets reps different keys """
+        for n in range(first, first + TestDurability.reps):
+            self.assertTrue(self.sync_db.set_value(n, n))
+
+    def write_with_threads(self, **options):
+        """
+        Writes with 4 threads counting the fsyncs made
+        :param options: Durability options for the database
+        :return: number of fsyncs
+        """
+        self.sync_db = SyncDataBase(1, TestDurability.test_fname, engine="log", **options)
+        threads = [threading.Thread(target=self.set_values, args=(n * 1000,)) for n in range(4)]
+        with mock.patch("os.fsync", wraps=os.fsync) as fsync:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(len(self.sync_db.storage.load()), 4 * TestDurability.reps)
+        return fsync.call_count
+
+    def test_always(self):
+        """ Tests 'always' fsyncs every commit """
+        self.assertEqual(self.write_with_threads(durability="always"), 4 * TestDurability.reps)
+
+    def test_interval(self):
+        """ Tests 'interval' shares fsyncs between writers and every write returns once it is durable """
+        fsyncs = self.write_with_threads(durability="interval", interval_ms=5, interval_ops=8)
+        self.assertLess(fsyncs, 4 * TestDurability.reps)
+        storage = self.sync_db.storage
+        self.assertEqual(storage._synced, storage._commits)
+
+    def test_interval_idle(self):
+        """ Tests the 'interval' flusher sleeps while no commit is pending and wakes for the next one """
+        self.write_with_threads(durability="interval", interval_ms=5, interval_ops=8)
+        storage = self.sync_db.storage
+        time.sleep(0.02)
+        with mock.patch.object(storage._commit_cond, "wait", wraps=storage._commit_cond.wait) as wait:
+            time.sleep(0.1)
+            self.assertEqual(wait.call_count, 0)                    # not woken every interval_ms
+            self.assertTrue(self.sync_db.set_value("k", "v"))       # returns once durable
+        self.assertEqual(storage._synced, storage._commits)
+
+    def test_os(self):
+        """ Tests 'os' never fsyncs """
+        self.assertEqual(self.write_with_threads(), 0)
+
+    def test_unknown_policy(self):
+        """ Tests an unknown policy is refused """
+        with self.assertRaises(ValueError):
+            FileDataBase(TestDurability.test_fname, durability="sometimes")
+
+    def tearDown(self):
+        """
+        Deletes the testing files
+        """
+        for file_name in (TestDurability.test_fname, TestDurability.test_fname + ".log"):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+
+class TestServer(unittest.TestCase):
+    """ Class to test the database server and its client """
+    test_fname = "testfile.bin"
+
+    def setUp(self):
+        """
+        Starts a server for a testing file on a Unix-domain socket
+        """
+        with open(TestServer.test_fname, 'wb') as f:
+            pickle.dump({n: n * 100 for n in range(1, 51)}, f)
+        self.socket_dir = tempfile.TemporaryDirectory()
+        self.address = os.path.join(self.socket_dir.name, "db.sock")
+        self.server = DataBaseServer(self.address, TestServer.test_fname)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = DataBaseClient(self.address)
+
+    def test_operations(self):
+        """ Tests single operations are served and persisted """
+        self.assertEqual(self.client.get_value(7), 700)
+        self.assertTrue(self.client.set_value("key", [1, 2]))
+        self.assertEqual(self.client.delete_value(7), 700)
+        self.assertIsNone(self.client.get_value(7))
+        self.assertEqual(TestThreadDB.get_database_dict()["key"], [1, 2])
+
+    def test_pipeline_and_batch(self):
+        """ Tests pipelined requests are answered in order and batches are applied together """
+        pipe = self.client.pipeline()
+        pipe.set_value(1, "a")
+        pipe.get_value(1)
+        pipe.delete_value(2)
+        pipe.get_value(51)
+        self.assertEqual(pipe.execute(), [True, "a", 200, None])
+        self.assertTrue(self.client.set_many({n: -n for n in range(60, 70)}))
+        self.assertEqual(self.client.get_many([60, 3]), {60: -60, 3: 300})
+        self.assertEqual(self.client.delete_many([60, 99]), {60: -60, 99: None})
+        self.assertEqual(self.client.get_many([60, 61]), {60: None, 61: -61})
+
+    def test_delete_many(self):
+        """ Tests keys deleted in a batch are gone from the server and from the file """
+        self.assertEqual(self.client.delete_many([4, 5, 99]), {4: 400, 5: 500, 99: None})
+        self.assertEqual(self.client.get_many([4, 5, 6]), {4: None, 5: None, 6: 600})
+        database = TestThreadDB.get_database_dict()
+        self.assertNotIn(4, database)
+        self.assertNotIn(5, database)
+
+    def test_error(self):
+        """ Tests a failing request raises in the client and the connection keeps working """
+        with self.assertRaises(RuntimeError):
+            self.client.set_value([], 1)            # unhashable key
+        self.assertEqual(self.client.get_value(1), 100)
+
+    def test_untrusted_request(self):
+        """ Tests a request naming a function is refused without calling it and the socket is the owner's only """
+        created = os.path.join(self.socket_dir.name, "created")
+
+        class Payload:
+            def __reduce__(self):
+                return os.mkdir, (created,)
+        sock = connect(self.address)
+        try:
+            sock.sendall(pack_frame(1, SET_VALUE, ("key", Payload())))
+            self.assertEqual(read_frame(sock)[1], ERROR)
+        finally:
+            sock.close()
+        self.assertFalse(os.path.exists(created))
+        self.assertTrue(self.client.set_value("key", {1: {2, 3}, "b": (b"x", bytearray(b"y"), 1j)}))
+        self.assertEqual(self.client.get_value("key"), {1: {2, 3}, "b": (b"x", bytearray(b"y"), 1j)})
+        self.assertEqual(os.stat(self.address).st_mode & 0o777, 0o600)
+
+    def test_closed_connection(self):
+        """ Tests a pooled connection closed by the server raises and is closed instead of reused """
+        pooled, server_end = socket.socketpair()
+        server_end.shutdown(socket.SHUT_WR)                                 # the request is sent, the answer is EOF
+        self.client.pool._idle.put(pooled)
+        with self.assertRaises(ConnectionError):
+            self.client.get_value(7)
+        server_end.close()
+        self.assertEqual(pooled.fileno(), -1)
+        self.assertEqual(self.client.get_value(7), 700)                     # through a new connection
+
+    def test_costly_request(self):
+        """ Tests a small request building a huge object is refused without building it """
+        class Huge:
+            def __init__(self, reduced):
+                self.reduced = reduced
+
+            def __reduce__(self):
+                return self.reduced
+        sock = connect(self.address)
+        try:
+            for n, reduced in enumerate([(bytearray, (2 ** 26,)), (set, (range(10 ** 9),)),
+                                         (frozenset, (range(10 ** 9),)), (slice, (0, 1))]):
+                sock.sendall(pack_frame(n, SET_VALUE, ("key", Huge(reduced))))
+                self.assertEqual(read_frame(sock)[:2], (n, ERROR))
+        finally:
+            sock.close()
+        self.assertIsNone(self.client.get_value("key"))
+
+    def test_processes(self):
+        """ Tests unrelated processes with their own clients share the database """
+        processes = [multiprocessing.Process(target=TestServer.write_keys, args=(self.address, n * 100))
+                     for n in range(1, 5)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        self.assertEqual(len(TestThreadDB.get_database_dict()), 50 + 4 * 20)
+
+    @staticmethod
+    def write_keys(address, first):
+        """ Writes 20 keys with a new client """
+        client = DataBaseClient(address, pool_size=2)
+        for n in range(first, first + 20):
+            client.set_value(n, n)
+        client.close()
+
+    def tearDown(self):
+        """
+        Stops the server and deletes the testing file
+        """
+        self.client.close()
+        self.server.shutdown()
+        self.socket_dir.cleanup()
+        os.remove(TestServer.test_fname)
+
+
+class TestCodecs(unittest.TestCase):
+    """ Class to test the serialization codecs """
+    test_fname = "testfile.bin"
+
+    def setUp(self):
+        """
+        Writes a legacy (plain pickle) testing file
+        """
+        with open(TestCodecs.test_fname, 'wb') as f:
+            pickle.dump({n: str(n) for n in range(1, 51)}, f)
+
+    def test_codecs(self):
+        """ Tests every codec with both engines and reopening with another codec """
+        for engine in ("snapshot", "log"):
+            for codec in ("pickle", "marshal", "tagged"):
+                database = FileDataBase(TestCodecs.test_fname, engine, codec=codec)
+                self.assertEqual(database.get_value(7), "7")
+                self.assertTrue(database.set_value(b"raw", bytes(OUT_OF_BAND_SIZE)))
+                self.assertEqual(database.delete_value(7), "7")
+                database.close()
+                reopened = FileDataBase(TestCodecs.test_fname, engine)
+                self.assertEqual(reopened.get_value(b"raw"), bytes(OUT_OF_BAND_SIZE))
+                self.assertIsNone(reopened.get_value(7))
+                self.assertTrue(reopened.set_value(7, "7"))
+                reopened.close()
+
+    def test_header(self):
+        """ Tests the codec is recorded in the file header """
+        database = FileDataBase(TestCodecs.test_fname, codec="marshal")
+        database.set_value(1, bytearray(b"x"))
+        with open(TestCodecs.test_fname, 'rb') as f:
+            self.assertEqual(f.read(len(MAGIC) + 1), MAGIC + b"\2")
+        with self.assertRaises(ValueError):
+            FileDataBase(TestCodecs.test_fname, codec="json")
+
+    def test_unsupported_type(self):
+        """ Tests a value the codec can't encode is refused and not applied """
+        database = FileDataBase(TestCodecs.test_fname, codec="tagged")
+        with self.assertRaises(TypeError):
+            database.set_value(1, 1.5)
+        self.assertEqual(database.get_value(1), "1")
+
+    def tearDown(self):
+        """
+        Deletes the testing files
+        """
+        for file_name in (TestCodecs.test_fname, TestCodecs.test_fname + ".log"):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+
+class TestCompression(unittest.TestCase):
+    """ Class to test compression of large values """
+    test_fname = "testfile.bin"
+    text = "the quick brown fox jumps over the lazy dog " * 100
+
+    def setUp(self):
+        """
+        Writes a legacy (plain pickle) testing file
+        """
+        with open(TestCompression.test_fname, 'wb') as f:
+            pickle.dump({n: str(n) for n in range(1, 51)}, f)
+
+    def test_algorithms(self):
+        """ Tests every algorithm with both engines, reopening with and without compression """
+        for engine in ("snapshot", "log"):
+            for algorithm in ("zlib", "lzma", "bz2"):
+                database = FileDataBase(TestCompression.test_fname, engine, compression=algorithm, compression_level=1)
+                self.assertEqual(database.get_value(7), "7")
+                self.assertTrue(database.set_many({"text": TestCompression.text, b"raw": TestCompression.text.encode(),
+                                                   "array": bytearray(TestCompression.text.encode())}))
+                self.assertEqual(database.delete_value(7), "7")
+                database.close()
+                size = os.path.getsize(TestCompression.test_fname + (".log" if engine == "log" else ""))
+                self.assertLess(size, len(TestCompression.text))
+                reopened = FileDataBase(TestCompression.test_fname, engine)
+                self.assertEqual(reopened.get_many(["text", b"raw", "array", 7]),
+                                 {"text": TestCompression.text, b"raw": TestCompression.text.encode(),
+                                  "array": bytearray(TestCompression.text.encode()), 7: None})
+                self.assertIsInstance(reopened.get_value("array"), bytearray)
+                self.assertTrue(reopened.set_value(7, "7"))
+                reopened.close()
+
+    def test_header_and_threshold(self):
+        """ Tests the algorithm is recorded in the header flags and values under the threshold stay uncompressed """
+        database = FileDataBase(TestCompression.test_fname, compression="bz2", compression_threshold=100)
+        database.set_value("small", "s" * 99)
+        database.set_value("large", "l" * 100)
+        with open(TestCompression.test_fname, 'rb') as f:
+            data = f.read()
+        self.assertEqual(data[:len(MAGIC) + 2], MAGIC + b"\1\3")
+        self.assertIn(b"s" * 99, data)
+        self.assertNotIn(b"l" * 100, data)
+        self.assertEqual(FileDataBase(TestCompression.test_fname).get_value("large"), "l" * 100)
+
+    def test_changed_values_only(self):
+        """ Tests rewriting the snapshot compresses only the values that changed """
+        database = FileDataBase(TestCompression.test_fname, compression="zlib")
+        database.set_many({n: TestCompression.text + str(n) for n in range(10)})
+        compress = mock.Mock(side_effect=database.storage.compression._compress)
+        database.storage.compression._compress = compress
+        database.set_value(3, TestCompression.text)
+        self.assertEqual(compress.call_count, 1)
+        database.storage.invalidate()                       # the values read from the file are kept too
+        database.set_value(4, TestCompression.text)
+        self.assertEqual(compress.call_count, 2)
+        with self.assertRaises(ValueError):
+            Compression("gzip")
+
+    def tearDown(self):
+        """
+        Deletes the testing files
+        """
+        for file_name in (TestCompression.test_fname, TestCompression.test_fname + ".log"):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+
+class TestBenchmark(unittest.TestCase):
+    """ Class to test the benchmark harness """
+
+    def test_workload(self):
+        """ Tests workloads are reproducible and zipfian keys are skewed """
+        config = {"ops": 2000, "keys": 100, "mix": [1, 1, 0], "distribution": "zipf", "zipf_s": 1.2, "seed": 3}
+        plan = benchmark.workload(config, 0)
+        self.assertEqual(plan, benchmark.workload(config, 0))
+        self.assertNotEqual(plan, benchmark.workload(config, 1))
+        self.assertNotIn("delete", {op for op, _ in plan})
+        keys = [key for _, key in plan]
+        self.assertGreater(keys.count(0), keys.count(99) * 10)
+
+    def test_baseline(self):
+        """ Tests a run reports every target and a slower run than the baseline is a regression """
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "report.json")
+            args = ["--ops", "50", "--keys", "20", "--workers", "2", "--output", output]
+            self.assertEqual(benchmark.main(args), 0)
+            with open(output) as f:
+                report = json.load(f)
+        self.assertEqual(set(report["results"]), set(benchmark.TARGETS))
+        self.assertEqual(report["results"]["sync0"]["ops"], 100)
+        self.assertEqual(benchmark.compare(report, report, 0.1), [])
+        slower = json.loads(json.dumps(report))
+        slower["results"]["file"]["ops_per_sec"] /= 2
+        self.assertEqual(len(benchmark.compare(slower, report, 0.1)), 1)
+
+
+class TestMetrics(unittest.TestCase):
+    """ Class to test the metrics of the synchronized database """
+    test_fname = "testfile.bin"
+
+    def setUp(self):
+        """
+        Writes the testing file
+        """
+        with open(TestMetrics.test_fname, 'wb') as f:
+            pickle.dump({n: n for n in range(1, 51)}, f)
+
+    def test_thread_stats(self):
+        """ Tests operations, lock times and bytes are recorded """
+        sync_db = SyncDataBase(1, TestMetrics.test_fname)
+        for n in range(1, 11):
+            sync_db.get_value(n)
+        sync_db.set_value(1, "a")
+        sync_db.delete_value(2)
+        sync_db.set_many({3: "c", 4: "d"})
+        stats = sync_db.stats()
+        self.assertEqual(stats["get"]["count"], 10)
+        self.assertEqual((stats["set"]["count"], stats["delete"]["count"]), (1, 1))
+        self.assertEqual(stats["read_wait"]["count"], 0)         # snapshot engine reads take no lock
+        self.assertEqual(stats["write_hold"]["count"], 3)
+        self.assertEqual(stats["encode"]["count"], 3)
+        self.assertGreater(stats["encode_bytes"], 0)
+        self.assertGreaterEqual(stats["get"]["p99_us"], stats["get"]["p50_us"])
+        self.assertEqual(SyncDataBase(1, TestMetrics.test_fname, metrics=False).stats(), {})
+
+    def test_process_stats(self):
+        """ Tests operations of child processes are seen by the parent """
+        sync_db = SyncDataBase(0, TestMetrics.test_fname)
+        processes = [multiprocessing.Process(target=sync_db.set_value, args=(n, n)) for n in range(4)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        self.assertEqual(sync_db.stats()["set"]["count"], 4)
+
+    def test_single_handler(self):
+        """ Tests the log file handler is added once for any number of instances """
+        for mode in (0, 1, 1):
+            SyncDataBase(mode, TestMetrics.test_fname)
+        handlers = [handler for handler in SyncDataBase.logger.handlers if isinstance(handler, logging.FileHandler)]
+        self.assertEqual(len(handlers), 1)
+
+    def tearDown(self):
+        """
+        Deletes the testing file
+        """
+        os.remove(TestMetrics.test_fname)
+
+    def __getstate__(self):
+        self_dict = self.__dict__.copy()
+        del self_dict['_outcome']
+        return self_dict
+
+
+class TestAtomic(unittest.TestCase):
+    """ Class to test the atomic read-modify-write methods """
+    test_fname = "testfile.bin"
+    reps = 50
+
+    def setUp(self):
+        """
+        Writes the testing file
+        """
+        with open(TestAtomic.test_fname, 'wb') as f:
+            pickle.dump({"counter": 0, "name": "a"}, f)
+
+    def increments(self, sync_db):
+        """ Increments the counter reps times """
+        for _ in range(TestAtomic.reps):
+            sync_db.increment("counter")
+
+    def count_with(self, sync_db, worker):
+        """
+        Increments the counter from 4 threads or processes
+        :return: final counter
+        """
+        workers = [worker(target=self.increments, args=(sync_db,)) for _ in range(4)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        return sync_db.get_value("counter")
+
+    def test_thread_counter(self):
+        """ Tests no increment is lost between threads """
+        self.assertEqual(self.count_with(SyncDataBase(1, TestAtomic.test_fname), threading.Thread),
+                         4 * TestAtomic.reps)
+
+    def test_process_counter(self):
+        """ Tests no increment is lost between processes """
+        self.assertEqual(self.count_with(SyncDataBase(0, TestAtomic.test_fname), multiprocessing.Process),
+                         4 * TestAtomic.reps)
+
+    def test_update_and_compare_and_set(self):
+        """ Tests update, increment of a new key and compare_and_set """
+        sync_db = SyncDataBase(1, TestAtomic.test_fname)
+        self.assertEqual(sync_db.update("name", str.upper), "A")
+        self.assertEqual(sync_db.increment("new", 5), 5)
+        self.assertFalse(sync_db.compare_and_set("name", "a", "b"))
+        self.assertTrue(sync_db.compare_and_set("name", "A", "b"))
+        self.assertTrue(sync_db.compare_and_set("missing", None, 1))
+        with self.assertRaises(TypeError):
+            sync_db.increment("name")
+        self.assertEqual(TestThreadDB.get_database_dict(), {"counter": 0, "name": "b", "new": 5, "missing": 1})
+
+    def tearDown(self):
+        """
+        Deletes the testing file
+        """
+        os.remove(TestAtomic.test_fname)
+
+    def __getstate__(self):
+        self_dict = self.__dict__.copy()
+        del self_dict['_outcome']
+        return self_dict
+
+
+class TestSnapshotReads(unittest.TestCase):
+    """ Class to test lock-free reads and atomic writes of the snapshot engine """
+    test_fname = "testfile.bin"
+
+    def setUp(self):
+        """
+        Writes the testing file
+        """
+        with open(TestSnapshotReads.test_fname, 'wb') as f:
+            pickle.dump({n: n for n in range(1, 51)}, f)
+
+    def test_read_while_writing(self):
+        """ Tests readers of threads and processes don't wait for a writer holding the lock """
+        for mode in (1, 0):
+            sync_db = SyncDataBase(mode, TestSnapshotReads.test_fname)
+            with sync_db.rw_lock.write_locked():
+                reader = threading.Thread(target=sync_db.get_many, args=([1, 2],))
+                reader.start()
+                reader.join(5)
+                self.assertFalse(reader.is_alive())
+                self.assertEqual(sync_db.get_value(3), 3)
+
+    def test_reader_keeps_version(self):
+        """ Tests a loaded version is never changed by writers """
+        sync_db = SyncDataBase(1, TestSnapshotReads.test_fname)
+        version = sync_db.storage.load()
+        sync_db.set_value(1, "new")
+        sync_db.delete_value(2)
+        self.assertEqual((version[1], version[2]), (1, 2))
+        self.assertEqual(sync_db.get_many([1, 2]), {1: "new", 2: None})
+
+    def test_failed_write(self):
+        """ Tests a write failing before the file is replaced leaves the previous version and no temporary file """
+        sync_db = SyncDataBase(1, TestSnapshotReads.test_fname)
+        with mock.patch("os.replace", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                sync_db.set_value(1, "new")
+        self.assertEqual(TestThreadDB.get_database_dict()[1], 1)
+        self.assertEqual(sync_db.get_value(1), 1)
+        self.assertFalse(os.path.exists(f"{TestSnapshotReads.test_fname}.{os.getpid()}.tmp"))
+
+    def tearDown(self):
+        """
+        Deletes the testing file
+        """
+        os.remove(TestSnapshotReads.test_fname)
+
+
+class TestScans(unittest.TestCase):
+    """ Class to test ordered scans over the sorted index of the keys """
+    test_fname = "testfile.bin"
+
+    def setUp(self):
+        """
+        Writes the testing file with number and string keys
+        """
+        self.test_dict = {n: n * 10 for n in range(1, 51)}
+        self.test_dict.update({f"key{n:02}": n for n in range(20)})
+        self.write_file()
+
+    def write_file(self):
+        """ Writes the testing dictionary to the testing file """
+        with open(TestScans.test_fname, 'wb') as f:
+            pickle.dump(self.test_dict, f)
+
+    def test_scans(self):
+        """ Tests keys, items, scan and prefix of every engine stay ordered and up to date with the writes """
+        for engine in ("snapshot", "log", "hash"):
+            with self.subTest(engine=engine):
+                self.write_file()
+                sync_db = SyncDataBase(1, TestScans.test_fname, engine)
+                self.assertEqual(list(sync_db.keys()), list(range(1, 51)) + [f"key{n:02}" for n in range(20)])
+                with mock.patch("file_database.KeyIndex") as build:
+                    sync_db.set_value(2.5, "x")
+                    sync_db.delete_value(3)
+                    sync_db.set_many({"key05a": "y", 60: 600})
+                    with sync_db.transaction() as txn:
+                        txn.delete_value("key01")
+                    self.assertEqual(list(sync_db.scan(2, 5)), [(2, 20), (2.5, "x"), (4, 40)])
+                    self.assertEqual(list(sync_db.prefix("key0"))[:3], [("key00", 0), ("key02", 2), ("key03", 3)])
+                    self.assertEqual(list(sync_db.scan(start=50)), [(50, 500), (60, 600)])
+                    self.assertEqual(len(list(sync_db.items(batch=7))), 71)
+                    build.assert_not_called()                   # kept up to date, not built again
+                sync_db.close()
+                if engine == "log":
+                    os.remove(TestScans.test_fname + ".log")
+
+    def test_consistent_scan(self):
+        """ Tests a scan sees one version: snapshot scans don't block writers, other engines make them wait """
+        for engine in ("snapshot", "log"):
+            with self.subTest(engine=engine):
+                self.write_file()
+                sync_db = SyncDataBase(1, TestScans.test_fname, engine)
+                scan = sync_db.scan(1, 51, batch=5)
+                self.assertEqual(next(scan), (1, 10))
+                writer = threading.Thread(target=sync_db.set_many, args=({n: -n for n in range(1, 51)},))
+                writer.start()
+                writer.join(0.2)
+                self.assertEqual(writer.is_alive(), engine != "snapshot")
+                self.assertEqual(list(scan), [(n, n * 10) for n in range(2, 51)])
+                writer.join(5)
+                self.assertFalse(writer.is_alive())
+                self.assertEqual(next(sync_db.scan(1)), (1, -1))
+                sync_db.close()
+        os.remove(TestScans.test_fname + ".log")
+
+    def test_write_while_loading(self):
+        """ Tests a write committed right after a lock-free scan loaded the database isn't left out of the index """
+        sync_db = SyncDataBase(1, TestScans.test_fname)
+        load_versioned = SnapshotStorage.load_versioned
+        written = []
+
+        def load_then_write(storage):
+            loaded = load_versioned(storage)
+            if not written:
+                written.append(True)
+                writer = threading.Thread(target=sync_db.set_value, args=("c", 3))
+                writer.start()
+                writer.join()
+            return loaded
+        with mock.patch.object(SnapshotStorage, "load_versioned", autospec=True, side_effect=load_then_write):
+            self.assertNotIn("c", list(sync_db.keys()))                     # the version loaded before the write
+        self.assertEqual(sync_db.get_value("c"), 3)
+        sync_db.set_value("d", 4)
+        self.assertEqual(list(sync_db.scan("a", "key")), [("c", 3), ("d", 4)])
+        sync_db.close()
+
+    def test_process_changes(self):
+        """ Tests scans of a process see keys written by another one """
+        for engine in ("snapshot", "log"):
+            with self.subTest(engine=engine):
+                self.write_file()
+                sync_db = SyncDataBase(0, TestScans.test_fname, engine)
+                self.assertEqual(list(sync_db.prefix("key1")), [(f"key{n}", n) for n in range(10, 20)])
+                p = multiprocessing.Process(target=sync_db.set_many, args=({"key1a": "new", "key10": None},))
+                p.start()
+                p.join()
+                self.assertEqual(list(sync_db.prefix("key1"))[:2], [("key10", None), ("key11", 11)])
+                self.assertEqual(list(sync_db.prefix("key1"))[-1], ("key1a", "new"))
+                sync_db.close()
+        os.remove(TestScans.test_fname + ".log")
+
+    def tearDown(self):
+        """
+        Deletes the testing file
+        """
+        os.remove(TestScans.test_fname)
+
+    def __getstate__(self):
+        self_dict = self.__dict__.copy()
+        del self_dict['_outcome']
+        return self_dict
+
+
+class TestExpiry(unittest.TestCase):
+    """ Class to test keys set with a time to live and their reaper """
+    test_fname = "testfile.bin"
+
+    def setUp(self):
+        """
+        Writes the testing file
+        """
+        with open(TestExpiry.test_fname, 'wb') as f:
+            pickle.dump({n: n for n in range(1, 51)}, f)
+
+    def test_invisible(self):
+        """ Tests expired keys are invisible to every read of every engine before they are reaped """
+        for engine in ("snapshot", "log", "hash"):
+            with self.subTest(engine=engine):
+                sync_db = SyncDataBase(1, TestExpiry.test_fname, engine, reap_interval=None)
+                self.assertTrue(sync_db.set_value(1, "short", ttl=0.05))
+                sync_db.set_value(2, "long", ttl=60)
+                with sync_db.transaction() as txn:
+                    txn.set_value(3, "txn", ttl=0.05)
+                self.assertEqual(sync_db.get_many([1, 2, 3]), {1: "short", 2: "long", 3: "txn"})
+                time.sleep(0.1)
+                self.assertIsNone(sync_db.get_value(1))
+                self.assertEqual(sync_db.get_many([1, 2, 3]), {1: None, 2: "long", 3: None})
+                self.assertEqual(list(sync_db.scan(1, 5)), [(2, "long"), (4, 4)])
+                self.assertEqual(sync_db.increment(1), 1)                  # an expired key counts as missing
+                self.assertIn(3, sync_db.storage.load())                   # still stored until reaped
+                self.assertEqual(sync_db.reap(), 1)
+                self.assertNotIn(3, sync_db.storage.load())
+                sync_db.close()
+                if engine == "log":
+                    os.remove(TestExpiry.test_fname + ".log")
+
+    def test_reaper(self):
+        """ Tests the background reaper deletes expired keys in bounded batches """
+        sync_db = SyncDataBase(1, TestExpiry.test_fname, reap_interval=0.05, reap_batch=10)
+        with mock.patch.object(SyncDataBase, "reap", autospec=True, side_effect=SyncDataBase.reap) as reap:
+            sync_db.set_many({n: n for n in range(100, 135)})
+            for n in range(100, 135):
+                sync_db.set_value(n, n, ttl=0.01)
+            for _ in range(100):
+                if len(sync_db.storage.load()) == 50:
+                    break
+                time.sleep(0.02)
+        self.assertEqual(TestThreadDB.get_database_dict(), {n: n for n in range(1, 51)})
+        self.assertGreaterEqual(reap.call_count, 4)                         # 35 keys in batches of 10
+        self.assertTrue(all(call.args[1] == 10 for call in reap.call_args_list))
+        sync_db.close()
+        self.assertFalse(sync_db._reaper.is_alive())
+
+    def test_persisted(self):
+        """ Tests the expiry persists in the file of every codec and is reaped after opening it again """
+        for codec in (None, "tagged"):
+            with self.subTest(codec=codec):
+                sync_db = SyncDataBase(1, TestExpiry.test_fname, codec=codec, reap_interval=None)
+                sync_db.set_value("k", "v", ttl=0.05)
+                sync_db.close()
+                sync_db = SyncDataBase(1, TestExpiry.test_fname, codec=codec, reap_interval=None)
+                self.assertEqual(sync_db.get_value("k"), "v")
+                time.sleep(0.1)
+                self.assertIsNone(sync_db.get_value("k"))
+                self.assertEqual(sync_db.reap(), 1)
+                sync_db.close()
+
+    def test_process_ttl(self):
+        """ Tests a key set with a ttl by a process that exits is reaped by another one """
+        sync_db = SyncDataBase(0, TestExpiry.test_fname, reap_interval=None)
+        p = multiprocessing.Process(target=sync_db.set_value, args=("k", "v", 0.05))
+        p.start()
+        p.join()
+        self.assertEqual(sync_db.get_value("k"), "v")
+        time.sleep(0.1)
+        self.assertIsNone(sync_db.get_value("k"))
+        self.assertEqual(sync_db.reap(), 1)
+        self.assertEqual(TestThreadDB.get_database_dict(), {n: n for n in range(1, 51)})
+
+    def test_reaper_on_open(self):
+        """ Tests the reaper starts on opening a file with keys set with a ttl, and only then """
+        sync_db = SyncDataBase(1, TestExpiry.test_fname, reap_interval=0.05)
+        self.assertIsNone(sync_db._reaper)                                  # nothing to expire
+        sync_db.close()
+        sync_db = SyncDataBase(1, TestExpiry.test_fname, reap_interval=None)
+        sync_db.set_value("k", "v", ttl=0.05)
+        sync_db.close()
+        sync_db = SyncDataBase(1, TestExpiry.test_fname, reap_interval=0.05)
+        self.assertTrue(sync_db._reaper.is_alive())
+        for _ in range(100):
+            if "k" not in sync_db.storage.load():
+                break
+            time.sleep(0.02)
+        sync_db.close()
+        self.assertEqual(TestThreadDB.get_database_dict(), {n: n for n in range(1, 51)})
+
+    def tearDown(self):
+        """
+        Deletes the testing file
+        """
+        os.remove(TestExpiry.test_fname)
+
+    def __getstate__(self):
+        self_dict = self.__dict__.copy()
+        del self_dict['_outcome']
+        return self_dict
+
+
+class TestReplication(unittest.TestCase):
+    """ Class to test the change feed and followers, with the primary server in another process """
+    test_fname = "testfile.bin"
+    replica_fname = "replica.bin"
+
+    @staticmethod
+    def serve(address, ready):
+        """ Serves the testing file with a small change feed until terminated """
+        server = DataBaseServer(address, TestReplication.test_fname, feed=True, feed_retain=4096)
+        ready.set()
+        server.serve_forever()
+
+    def setUp(self):
+        """
+        Writes the testing file and starts its primary server in another process
+        """
+        with open(TestReplication.test_fname, 'wb') as f:
+            pickle.dump({n: n * 100 for n in range(1, 51)}, f)
+        self.socket_dir = tempfile.TemporaryDirectory()
+        self.address = os.path.join(self.socket_dir.name, "primary.sock")
+        ready = multiprocessing.Event()
+        self.primary = multiprocessing.Process(target=TestReplication.serve, args=(self.address, ready))
+        self.primary.start()
+        ready.wait()
+        self.client = DataBaseClient(self.address)
+
+    def primary_dict(self) -> dict:
+        """ Content of the primary """
+        return {key: val for key, val in self.client.get_many(range(1, 200)).items() if val is not None}
+
+    def test_snapshot_and_resume(self):
+        """ Tests a new follower starts from a snapshot and resumes from its last change after a restart """
+        follower = Follower(self.address, TestReplication.replica_fname).start()
+        self.assertTrue(follower.wait_for(0, 5))
+        self.client.set_value(60, "a", 60)
+        self.client.delete_many([1, 2])
+        self.assertTrue(follower.wait_for(3, 5))
+        self.assertEqual(dict(follower.database.items()), self.primary_dict())
+        self.assertEqual(follower.stats()["snapshots"], 1)
+        follower.close()
+        self.client.set_many({n: -n for n in range(70, 80)})
+        follower = Follower(self.address, TestReplication.replica_fname)
+        self.assertEqual(follower.seq, 3)
+        follower.start()
+        self.assertTrue(follower.wait_for(13, 5))
+        stats = follower.stats()
+        self.assertEqual((stats["snapshots"], stats["applied"], stats["lag_changes"]), (0, 10, 0))
+        self.assertEqual(dict(follower.database.items()), self.primary_dict())
+        follower.close()
+
+    def test_truncated_feed(self):
+        """ Tests a follower behind the changes kept by the feed takes a snapshot again """
+        follower = Follower(self.address, TestReplication.replica_fname).start()
+        self.client.set_value(1, "first")
+        self.assertTrue(follower.wait_for(1, 5))
+        follower.stop()
+        for n in range(300):
+            self.client.set_value(n % 100 + 1, n)
+        follower.start()
+        self.assertTrue(follower.wait_for(301, 5))
+        self.assertEqual(follower.stats()["snapshots"], 2)
+        self.assertEqual(dict(follower.database.items()), self.primary_dict())
+        follower.close()
+
+    @staticmethod
+    def write_keys(sync_db, first):
+        """ Sets and deletes keys from another process """
+        for n in range(first, first + 50):
+            sync_db.set_value(n % 20, n)
+            if n % 3 == 0:
+                sync_db.delete_value(n % 20)
+
+    def test_feed_of_processes(self):
+        """ Tests the changes of several processes get consecutive sequence numbers in commit order """
+        sync_db = SyncDataBase(0, TestReplication.replica_fname, "log", feed=True)
+        processes = [multiprocessing.Process(target=TestReplication.write_keys, args=(sync_db, n * 100))
+                     for n in range(4)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        changes = sync_db.changes(0).read(1000)
+        self.assertEqual([change[0] for change in changes], list(range(1, len(changes) + 1)))
+        self.assertEqual(sync_db.feed.last_seq(), len(changes))
+        replayed = {}
+        for _, _, op, key, val in changes:
+            if op == SET:
+                replayed[key] = val
+            else:
+                replayed.pop(key, None)
+        self.assertEqual(replayed, dict(sync_db.storage.load()))
+        sync_db.close()
+
+    def test_failed_append(self):
+        """ Tests changes committed but missed by the feed leave a gap that sends readers to a snapshot """
+        sync_db = SyncDataBase(1, TestReplication.replica_fname, "log", feed=True)
+        sync_db.set_value("a", 1)
+        write = ChangeFeed._write
+        for failures in (1, 2):                 # the gap is written at once, or by the next append
+            with self.subTest(failures=failures):
+                seq = sync_db.feed.last_seq()
+                cursor = sync_db.changes(seq)
+                failed = []
+
+                def failing_write(feed, data):
+                    if len(failed) < failures:
+                        failed.append(data)
+                        raise OSError("disk full")
+                    write(feed, data)
+                with mock.patch.object(ChangeFeed, "_write", autospec=True, side_effect=failing_write):
+                    self.assertTrue(sync_db.set_many({"b": failures, "c": failures}))
+                self.assertEqual(sync_db.get_many(["b", "c"]), {"b": failures, "c": failures})
+                snapshot_seq, snapshot = sync_db.feed_snapshot()
+                self.assertEqual((snapshot_seq, snapshot["b"]), (seq + 2, failures))
+                sync_db.set_value("d", failures)
+                with self.assertRaises(FeedTruncated):
+                    cursor.read()
+                cursor.close()
+                cursor = sync_db.changes(snapshot_seq)
+                self.assertEqual([change[0::2] for change in cursor.read()], [(seq + 3, SET, failures)])
+                cursor.close()
+        sync_db.close()
+
+    def tearDown(self):
+        """
+        Stops the primary and deletes the testing files
+        """
+        self.client.close()
+        self.primary.terminate()
+        self.primary.join()
+        self.socket_dir.cleanup()
+        for file_name in (TestReplication.test_fname, TestReplication.replica_fname):
+            for suffix in ("", ".feed", ".feed.1", ".seq", ".log"):
+                if os.path.exists(file_name + suffix):
+                    os.remove(file_name + suffix)
+
+
+class TestBloom(unittest.TestCase):
+    """ Class to test the Bloom filter answering missing keys """
+    test_fname = "testfile.bin"
+
+    def setUp(self):
+        """
+        Writes the testing file
+        """
+        with open(TestBloom.test_fname, 'wb') as f:
+            pickle.dump({n: n * 100 for n in range(1, 51)}, f)
+
+    def test_misses_skip_lock(self):
+        """ Tests missing keys are answered without the lock and existing or new keys are still found """
+        for engine in ("snapshot", "log", "hash"):
+            with self.subTest(engine=engine):
+                self.setUp()
+                sync_db = SyncDataBase(1, TestBloom.test_fname, engine, bloom=True)
+                with mock.patch.object(sync_db.rw_lock, "acquire_write", wraps=sync_db.rw_lock.acquire_write) as write:
+                    self.assertIsNone(sync_db.delete_value(99))
+                    self.assertEqual(sync_db.delete_many([98, 97]), {98: None, 97: None})
+                    self.assertEqual(write.call_count, 0)
+                    self.assertEqual(sync_db.delete_many([96, 2]), {96: None, 2: 200})
+                    self.assertEqual(write.call_count, 1)
+                if engine != "snapshot":
+                    with mock.patch.object(sync_db.rw_lock, "acquire_read") as read:
+                        self.assertIsNone(sync_db.get_value("missing"))
+                        self.assertEqual(read.call_count, 0)
+                if engine != "hash":                                        # it finds keys by their bytes
+                    self.assertEqual(sync_db.get_value(1.0), 100)           # equal keys of other types
+                sync_db.set_value(("new", 1), "a")
+                with sync_db.transaction() as txn:
+                    txn.set_value("txn", "b")
+                self.assertEqual(sync_db.get_many([("new", 1), "txn"]), {("new", 1): "a", "txn": "b"})
+                self.assertEqual(sync_db.delete_value("txn"), "b")
+                self.assertGreaterEqual(sync_db.stats()["bloom_skips"], 4 if engine == "snapshot" else 5)
+                sync_db.close()
+                for suffix in (".bloom", ".log"):
+                    if os.path.exists(TestBloom.test_fname + suffix):
+                        os.remove(TestBloom.test_fname + suffix)
+
+    def test_persisted(self):
+        """ Tests the filter saved on close is used while the file doesn't change and built again if it does """
+        SyncDataBase(1, TestBloom.test_fname, bloom=True).close()
+        with mock.patch.object(BloomFilter, "add", autospec=True, side_effect=BloomFilter.add) as add:
+            sync_db = SyncDataBase(1, TestBloom.test_fname, bloom=True)
+            self.assertEqual(add.call_count, 0)
+            sync_db.close()
+            SyncDataBase(1, TestBloom.test_fname).set_value("other", 1)      # a writer without the filter
+            sync_db = SyncDataBase(1, TestBloom.test_fname, bloom=True)
+            self.assertEqual(add.call_count, 51)
+        self.assertEqual(sync_db.delete_value("other"), 1)
+        sync_db.close()
+
+    def test_grows(self):
+        """ Tests a filter of threads is built again bigger when it has more keys than its capacity """
+        sync_db = SyncDataBase(1, TestBloom.test_fname, "log", bloom=True, bloom_keys=100)
+        self.assertEqual(sync_db.bloom.capacity, MIN_KEYS)
+        sync_db.set_many({n: n for n in range(MIN_KEYS + 1)})
+        self.assertGreater(sync_db.bloom.capacity, 2 * MIN_KEYS)
+        self.assertFalse(sync_db.bloom.full)
+        self.assertEqual(sync_db.delete_value(MIN_KEYS), MIN_KEYS)
+        sync_db.close()
+        os.remove(TestBloom.test_fname + ".log")
+
+    @staticmethod
+    def set_keys(sync_db, first):
+        """ Sets keys from another process """
+        for n in range(first, first + 20):
+            sync_db.set_value(n, n)
+
+    def test_processes(self):
+        """ Tests keys set by any process are seen through the filter in shared memory """
+        sync_db = SyncDataBase(0, TestBloom.test_fname, "log", bloom=True)
+        processes = [multiprocessing.Process(target=TestBloom.set_keys, args=(sync_db, n * 100))
+                     for n in range(1, 4)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        self.assertEqual(sync_db.get_many(range(100, 320, 100)), {100: 100, 200: 200, 300: 300})
+        self.assertEqual(sync_db.delete_value(319), 319)
+        self.assertEqual(sync_db.get_value(219), 219)
+        sync_db.close()
+        os.remove(TestBloom.test_fname + ".log")
+
+    def tearDown(self):
+        """
+        Deletes the testing files
+        """
+        for suffix in ("", ".bloom"):
+            if os.path.exists(TestBloom.test_fname + suffix):
+                os.remove(TestBloom.test_fname + suffix)
+
+
+class TestBulk(unittest.TestCase):
+    """ Class to test streaming import and export of records """
+    test_fname = "testfile.bin"
+
+    def setUp(self):
+        """
+        Writes the testing file and a directory for the records
+        """
+        with open(TestBulk.test_fname, 'wb') as f:
+            pickle.dump({n: n * 100 for n in range(1, 51)}, f)
+        self.records_dir = tempfile.TemporaryDirectory()
+
+    def test_round_trip(self):
+        """ Tests every format exported by one engine is imported by another with the same records """
+        records = {f"key{n}": {"n": n, "list": [n, str(n)]} for n in range(2500)}
+        for format in ("jsonl", "pickle"):
+            for engine in ("snapshot", "log", "hash"):
+                with self.subTest(format=format, engine=engine):
+                    self.setUp()
+                    path = os.path.join(self.records_dir.name, f"records.{format}")
+                    sync_db = SyncDataBase(1, TestBulk.test_fname, engine)
+                    self.assertEqual(sync_db.import_from(records.items(), "pickle", chunk=1000), 2500)
+                    sync_db.set_value("gone", 1, ttl=0.01)
+                    time.sleep(0.02)
+                    self.assertEqual(sync_db.export_to(path, chunk=700), 2550)
+                    sync_db.close()
+                    other = SyncDataBase(1, TestBulk.test_fname + ".other", "snapshot")
+                    self.assertEqual(other.import_from(path), 2550)
+                    self.assertEqual(other.get_many(["key7", 50, "gone"]),
+                                     {"key7": {"n": 7, "list": [7, "7"]}, 50: 5000, "gone": None})
+                    other.close()
+                    for file_name in (TestBulk.test_fname + ".log", TestBulk.test_fname + ".other"):
+                        if os.path.exists(file_name):
+                            os.remove(file_name)
+
+    def test_csv_and_lines(self):
+        """ Tests CSV files and iterables of lines, with keys written by JSON as lists """
+        sync_db = SyncDataBase(1, TestBulk.test_fname)
+        self.assertEqual(sync_db.import_from(['{"key": ["a", 1], "value": 2}', "",
+                                              '{"key": 1, "value": "one"}'], "jsonl"), 2)
+        self.assertEqual(sync_db.get_many([("a", 1), 1]), {("a", 1): 2, 1: "one"})
+        self.assertEqual(sync_db.import_from(["key,value", "x,1", '"y,z","2"'], "csv"), 2)
+        self.assertEqual(sync_db.get_many(["x", "y,z"]), {"x": "1", "y,z": "2"})
+        path = os.path.join(self.records_dir.name, "records.csv")
+        self.assertEqual(sync_db.export_to(path), 53)
+        with open(path, newline="") as f:
+            self.assertIn("y,z,2", {",".join(row) for row in csv.reader(f)})
+        with self.assertRaises(ValueError):
+            sync_db.import_from(path, "xml")
+        sync_db.close()
+
+    def test_snapshot_all_or_nothing(self):
+        """ Tests the snapshot engine writes the file once and nothing if a record fails """
+        sync_db = SyncDataBase(1, TestBulk.test_fname)
+        with mock.patch.object(SnapshotStorage, "write", autospec=True, side_effect=SnapshotStorage.write) as write:
+            self.assertEqual(sync_db.import_from(((n, n) for n in range(100, 5100)), "pickle", chunk=100), 5000)
+            self.assertEqual(write.call_count, 1)
+        with self.assertRaises(json.JSONDecodeError):
+            sync_db.import_from(['{"key": 1, "value": 0}', "not json"], "jsonl")
+        self.assertEqual(sync_db.get_value(1), 100)
+        self.assertEqual(len(TestThreadDB.get_database_dict()), 5050)
+        sync_db.close()
+
+    def test_trailing_blank_lines(self):
+        """ Tests records followed by a chunk of blank lines are written (regression) """
+        path = os.path.join(self.records_dir.name, "records.jsonl")
+        with open(path, "w") as f:
+            f.write('{"key": "a", "value": 1}\n{"key": "b", "value": 2}\n\n\n')
+        for engine in ("snapshot", "log"):
+            with self.subTest(engine=engine):
+                sync_db = SyncDataBase(1, TestBulk.test_fname, engine)
+                self.assertEqual(sync_db.import_from(path, chunk=2), 2)
+                sync_db.close()
+                self.assertEqual(FileDataBase(TestBulk.test_fname, engine).get_many(["a", "b"]), {"a": 1, "b": 2})
+        os.remove(TestBulk.test_fname + ".log")
+
+    def test_parallel_parsing(self):
+        """ Tests JSON lines parsed by a pool of processes are applied in order, compacting the log once """
+        lines = [json.dumps({"key": n % 1000, "value": n}) for n in range(5000)]
+        sync_db = SyncDataBase(1, TestBulk.test_fname, "log", compact_size=4096)
+        with mock.patch.object(LogStorage, "compact", autospec=True, side_effect=LogStorage.compact) as compact:
+            self.assertEqual(sync_db.import_from(lines, "jsonl", chunk=300, workers=2), 5000)
+            sync_db.storage.close()
+            self.assertEqual(compact.call_count, 1)     # once at the end, not every 4096 bytes
+        self.assertEqual(sync_db.get_many([0, 999]), {0: 4000, 999: 4999})
+        sync_db.close()
+        os.remove(TestBulk.test_fname + ".log")
+
+    def tearDown(self):
+        """
+        Deletes the testing files
+        """
+        self.records_dir.cleanup()
+        os.remove(TestBulk.test_fname)
+
+
+class TestLazy(unittest.TestCase):
+    """ Class to test opening files lazily, decoding values when first read """
+    test_fname = "testfile.bin"
+
+    def setUp(self):
+        """
+        Writes the testing file
+        """
+        with open(TestLazy.test_fname, 'wb') as f:
+            pickle.dump({n: n * 100 for n in range(1, 51)}, f)
+
+    def test_lazy_open(self):
+        """ Tests a file opened lazily reads no value until asked for one, and keeps every change """
+        keys = {1: "one", ("a", 2): [1, 2], frozenset({3}): "set", b"bytes": None, "text": "t" * 5000}
+        for engine in ("snapshot", "log"):
+            with self.subTest(engine=engine):
+                self.setUp()
+                database = FileDataBase(TestLazy.test_fname, engine, lazy=True)
+                self.assertIsInstance(database.storage.load(), dict)       # written without the directory
+                database.set_many(keys)
+                database.set_value("gone", 1, ttl=0.05)
+                database.delete_value(2)
+                database.storage.close()
+                if engine == "log":
+                    database.storage.compact()
+                database.close()
+                database = FileDataBase(TestLazy.test_fname, engine, lazy=True)
+                db = database.storage.load()
+                self.assertIsInstance(db, LazyDict)
+                self.assertEqual((len(db._decoded), len(db)), (0, 54))
+                self.assertEqual(database.get_many([1.0, ("a", 2), frozenset({3}), "text", 2, 3]),
+                                 {1.0: "one", ("a", 2): [1, 2], frozenset({3}): "set", "text": "t" * 5000,
+                                  2: None, 3: 300})
+                self.assertEqual(len(db._decoded), 5)
+                time.sleep(0.06)
+                self.assertEqual(database.reap(), 1)
+                with database.transaction() as txn:
+                    txn.set_value("new", 1)
+                    txn.delete_value(3)
+                self.assertEqual(list(database.scan(1, 5)), [(1, "one"), (4, 400)])
+                self.assertEqual(FileDataBase(TestLazy.test_fname, engine).get_many(["new", 3, 50]),
+                                 {"new": 1, 3: None, 50: 5000})
+                database.close()
+                if engine == "snapshot":
+                    hash_db = FileDataBase(TestLazy.test_fname, "hash")        # converts the indexed file
+                    self.assertEqual(hash_db.get_many([("a", 2), "new"]), {("a", 2): [1, 2], "new": 1})
+                    hash_db.close()
+
+    def test_readers_keep_version(self):
+        """ Tests a lazy version read before a write keeps its values after the file is replaced """
+        database = FileDataBase(TestLazy.test_fname, lazy=True)
+        database.set_value(1, "first")
+        before = database.storage.load()
+        database.set_many({1: "second", 2: None})
+        other = FileDataBase(TestLazy.test_fname, lazy=True)
+        other.set_value(3, "third")
+        self.assertEqual((before.get(1), before.get(2), before.get(3)), ("first", 200, 300))
+        self.assertEqual(database.get_many([1, 2, 3]), {1: "second", 2: None, 3: "third"})
+        with self.assertRaises(ValueError):
+            FileDataBase(TestLazy.test_fname, lazy=True, codec="marshal")
+        with self.assertRaises(ValueError):
+            FileDataBase(TestLazy.test_fname, lazy=True, compression="zlib")
+
+    def test_none_key(self):
+        """ Tests a None key (without a canonical form) is kept apart from the expiry times when rewritten """
+        database = FileDataBase(TestLazy.test_fname, lazy=True)
+        database.set_many({None: 1, "a": 1})
+        database.set_value("b", 2, ttl=60)
+        database.close()
+        for n in range(3):
+            database = FileDataBase(TestLazy.test_fname, lazy=True)
+            self.assertIsInstance(database.storage.load(), LazyDict)
+            self.assertTrue(database.set_value(n, "new"))
+            self.assertEqual(database.get_many([None, "a", "b", n]), {None: 1, "a": 1, "b": 2, n: "new"})
+            self.assertEqual([key for key, _ in database.storage.load().expiring_items()], ["b"])
+            database.close()
+
+    def test_warm_up(self):
+        """ Tests the keys read before closing are decoded in background when opened again """
+        sync_db = SyncDataBase(1, TestLazy.test_fname, lazy=True)
+        sync_db.set_value(0, 0)
+        sync_db.close()
+        sync_db = SyncDataBase(1, TestLazy.test_fname, lazy=True)
+        self.assertEqual(sync_db.get_many([5, 7, 99]), {5: 500, 7: 700, 99: None})
+        sync_db.close()
+        sync_db = SyncDataBase(1, TestLazy.test_fname, lazy=True, warm=True)
+        sync_db._warmer.join()
+        self.assertEqual(list(sync_db.storage.load()._decoded), [5, 7])
+        self.assertEqual(sync_db.get_value(7), 700)
+        sync_db.close()
+        os.remove(TestLazy.test_fname + ".hot")
+
+    @staticmethod
+    def set_keys(sync_db, first):
+        """ Sets keys from another process """
+        for n in range(first, first + 20):
+            sync_db.set_value(n, n)
+
+    def test_processes(self):
+        """ Tests processes sharing a file opened lazily see the keys set by each other """
+        sync_db = SyncDataBase(0, TestLazy.test_fname, lazy=True)
+        sync_db.set_value(0, "zero")
+        processes = [multiprocessing.Process(target=TestLazy.set_keys, args=(sync_db, n * 100))
+                     for n in range(1, 4)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        self.assertEqual(sync_db.get_many([0, 50, 119, 219, 319]),
+                         {0: "zero", 50: 5000, 119: 119, 219: 219, 319: 319})
+        self.assertIsInstance(sync_db.storage.load(), LazyDict)
+        sync_db.close()
+
+    def tearDown(self):
+        """
+        Deletes the testing files
+        """
+        for suffix in ("", ".log", ".hot"):
+            if os.path.exists(TestLazy.test_fname + suffix):
+                os.remove(TestLazy.test_fname + suffix)
+
+
+class TestAsync(unittest.IsolatedAsyncioTestCase):
+    """ Class to test the asyncio front-end """
+    test_fname = "testfile.bin"
+
+    def setUp(self):
+        """
+        sets up the testing file with a specific dictionary and the async database over it
+        """
+        self.test_dict = {n: n * 100 for n in range(1, 51)}
+        with open(TestAsync.test_fname, "wb") as f:
+            pickle.dump(self.test_dict, f)
+        self.sync_db = SyncDataBase(1, TestAsync.test_fname)
+        self.async_db = AsyncDataBase(self.sync_db, window=0.01)
+
+    async def test_coalesced_writes(self):
+        """ Tests 100 concurrent writes are written in a few batches """
+        with mock.patch.object(SnapshotStorage, "write", autospec=True, side_effect=SnapshotStorage.write) as write:
+            results = await asyncio.gather(*[self.async_db.set_value(n, -n) for n in range(1, 101)],
+                                           self.async_db.delete_value(50))
+        self.assertTrue(all(results[:100]))
+        self.assertEqual(results[100], -50)
+        self.assertLessEqual(write.call_count, 2)
+        self.test_dict.update({n: -n for n in range(1, 101)})
+        del self.test_dict[50]
+        self.assertEqual(TestThreadDB.get_database_dict(), self.test_dict)
+        self.assertIsNone(await self.async_db.get_value(50))
+
+    async def test_shared_reads(self):
+        """ Tests concurrent reads of a key share one lookup """
+        with mock.patch.object(self.sync_db, "get_value", wraps=self.sync_db.get_value) as get_value:
+            values = await asyncio.gather(*[self.async_db.get_value(40) for _ in range(50)])
+        self.assertEqual(values, [4000] * 50)
+        self.assertEqual(get_value.call_count, 1)
+
+    async def test_failed_batch(self):
+        """ Tests a failing batch raises in every write of it and applies none """
+        with mock.patch.object(SnapshotStorage, "write", side_effect=OSError("disk full")):
+            results = await asyncio.gather(self.async_db.set_value(1, "a"), self.async_db.set_value(2, "b"),
+                                           return_exceptions=True)
+        self.assertTrue(all(isinstance(result, OSError) for result in results))
+        self.assertEqual(await self.async_db.get_value(1), 100)
+        await self.async_db.close()
+
+    async def test_bad_write(self):
+        """ Tests a write that can't be serialized fails alone and the rest of its batch is written """
+        results = await asyncio.gather(self.async_db.set_value(1, "a"), self.async_db.set_value(2, threading.Lock()),
+                                       self.async_db.delete_value(3), return_exceptions=True)
+        self.assertEqual((results[0], type(results[1]), results[2]), (True, TypeError, 300))
+        self.test_dict[1] = "a"
+        del self.test_dict[3]
+        self.assertEqual(TestThreadDB.get_database_dict(), self.test_dict)
+        await self.async_db.close()
+
+    def tearDown(self):
+        """
+        Deletes the testing file
+        """
+        os.remove(TestAsync.test_fname)
+
+
 if __name__ == "__main__":
     unittest.main()